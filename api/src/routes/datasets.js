@@ -609,6 +609,7 @@ router.post(
       md5: f.md5,
       size: BigInt(f.size),
       filetype: f.type,
+      metadata: f.metadata,
     }));
     datasetService.add_files({ dataset_id: req.params.id, data });
 
@@ -691,7 +692,10 @@ router.post(
   accessControl('workflow')('create'),
   validate([
     param('id').isInt().toInt(),
-    param('wf').isIn(['stage', 'integrated']),
+    param('wf').isIn(['stage', 'integrated', 'stage_files']),
+    // paths or glob patterns of the files to stage, relative to the dataset root
+    body('paths').if(param('wf').equals('stage_files')).isArray({ min: 1 }),
+    body('paths.*').if(param('wf').equals('stage_files')).isString(),
   ]),
   (req, res, next) => {
     // admin and operator roles can run stage and integrated workflows
@@ -712,7 +716,7 @@ router.post(
   asyncHandler(async (req, res, next) => {
     // #swagger.tags = ['datasets']
     // #swagger.summary = Create and start a workflow and associate it.
-    // Allowed names are stage, integrated
+    // Allowed names are stage, integrated, stage_files
 
     // Log the staging attempt first.
     if (req.params.wf === 'stage') {
@@ -734,6 +738,19 @@ router.post(
     });
 
     const wf_name = req.params.wf;
+    if (wf_name === 'stage_files') {
+      // the worker reads the requested paths from the dataset's metadata
+      // replaced instead of deep merged, so that paths of earlier requests do not linger
+      await prisma.dataset.update({
+        where: { id: dataset.id },
+        data: {
+          metadata: {
+            ...dataset.metadata,
+            stage_files_request: { paths: req.body.paths },
+          },
+        },
+      });
+    }
     const wf = await datasetService.create_workflow(dataset, wf_name, req.user.id);
     return res.json(wf);
   }),
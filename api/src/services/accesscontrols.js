@@ -76,7 +76,7 @@ const grantsObject = {
       'read:own': ['*'],
     },
     workflow: {
-      'create:any': ['stage'], // can only create a stage workflow
+      'create:any': ['stage', 'stage_files'], // can only create stage workflows
     },
     statistics: {
       'create:any': ['*'],
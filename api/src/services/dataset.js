@@ -106,6 +106,8 @@ async function get_dataset({
     select: {
       path: true,
       md5: true,
+      size: true,
+      metadata: true,
     },
     where: {
       NOT: {
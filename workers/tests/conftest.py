@@ -0,0 +1,28 @@
+import os
+from pathlib import Path
+
+import pytest
+
+# workers.config reads these from the environment (or .env) when it is imported
+for name in ['APP_API_TOKEN', 'QUEUE_URL', 'QUEUE_USER', 'QUEUE_PASS', 'MONGO_HOST', 'MONGO_PORT', 'MONGO_DB',
+             'MONGO_AUTH_SOURCE', 'MONGO_USER', 'MONGO_PASS', 'ALIAS_SALT']:
+    os.environ.setdefault(name, 'test')
+
+
+@pytest.fixture
+def sda_root(tmp_path: Path, monkeypatch):
+    """
+    an emulated SDA under tmp_path (see workers.sda_emulator)
+    """
+    import workers.hsi_session as hsi_session
+    import workers.sda_emulator as sda_emulator
+    from workers.config import config
+
+    root = tmp_path / 'sda'
+    root.mkdir()
+    monkeypatch.setitem(config['sda'], 'hsi_command', sda_emulator.hsi_command(root))
+    # sessions started by other tests run against another root
+    monkeypatch.setattr(hsi_session, '_pool', None)
+    yield root
+    if hsi_session._pool is not None:
+        hsi_session._pool.close()
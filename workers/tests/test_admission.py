@@ -0,0 +1,75 @@
+import shutil
+from collections import namedtuple
+from pathlib import Path
+
+import pytest
+
+import workers.admission as admission
+import workers.stage_cache as stage_cache
+from workers import exceptions as exc
+from workers.config import config
+
+Usage = namedtuple('Usage', ['total', 'used', 'free'])
+TOTAL = 1000 * 1024 * 1024 * 1024
+
+
+@pytest.fixture
+def stage_fs(tmp_path: Path, monkeypatch):
+    """
+    a stage filesystem at 90% use, with one idle staged dataset of 20% of the filesystem
+    """
+    monkeypatch.setitem(config['paths'], 'stage_reservations', str(tmp_path / 'reservations.json'))
+    monkeypatch.setitem(config['stage']['cache'], 'enabled', True)
+    monkeypatch.setitem(config['stage']['cache'], 'high_water_mark', 0.85)
+    monkeypatch.setitem(config['stage']['cache'], 'low_water_mark', 0.75)
+    stage_dir = tmp_path / 'stage'
+    stage_dir.mkdir()
+    state = {'used': int(0.9 * TOTAL), 'purged': []}
+
+    def disk_usage(path):
+        return Usage(TOTAL, state['used'], TOTAL - state['used'])
+
+    dev = stage_dir.stat().st_dev
+    idle = stage_cache.CachedDataset(dataset={'id': 1, 'name': 'idle'}, paths=[stage_dir / 'idle'],
+                                     bytes_by_device={dev: int(0.2 * TOTAL)}, last_access=0)
+
+    def purge(dataset):
+        state['purged'].append(dataset['id'])
+        state['used'] -= int(0.2 * TOTAL)
+        return int(0.2 * TOTAL)
+
+    monkeypatch.setattr(shutil, 'disk_usage', disk_usage)
+    monkeypatch.setattr(stage_cache, 'cached_datasets', lambda exclude=(): [idle])
+    monkeypatch.setattr(stage_cache, 'purge', purge)
+    return stage_dir, state
+
+
+@pytest.mark.parametrize('admission_enabled', [True, False])
+def test_reserve_evicts_above_high_water_mark(stage_fs, monkeypatch, admission_enabled):
+    stage_dir, state = stage_fs
+    monkeypatch.setitem(config['stage']['admission'], 'enabled', admission_enabled)
+    monkeypatch.setitem(config['stage']['admission'], 'min_free_fraction', 0.02)
+
+    # 1% of the filesystem fits in the free space, but takes it above the high water mark
+    with admission.reserve('stage:2', {stage_dir: int(0.01 * TOTAL)}, exclude=[2]):
+        pass
+
+    assert state['purged'] == [1]
+
+
+def test_reserve_does_not_evict_below_high_water_mark(stage_fs, monkeypatch):
+    stage_dir, state = stage_fs
+    state['used'] = int(0.5 * TOTAL)
+    monkeypatch.setitem(config['stage']['admission'], 'enabled', True)
+
+    with admission.reserve('stage:2', {stage_dir: int(0.01 * TOTAL)}, exclude=[2]):
+        pass
+
+    assert state['purged'] == []
+
+
+def test_deferred_can_be_rebuilt_from_its_message():
+    e = exc.Deferred('not enough space', countdown=300)
+    rebuilt = type(e)(*e.args)
+    assert str(rebuilt) == 'not enough space'
+    assert rebuilt.countdown is None
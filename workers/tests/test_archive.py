@@ -0,0 +1,50 @@
+import copy
+
+import workers.api as api
+import workers.tasks.archive as archive
+
+
+def merge(target, source):
+    """
+    the API's deep merge of metadata (lodash merge): objects and lists are merged key by key / index by index
+    """
+    if isinstance(target, dict) and isinstance(source, dict):
+        merged = dict(target)
+        for key, value in source.items():
+            merged[key] = merge(target.get(key), value)
+        return merged
+    if isinstance(target, list) and isinstance(source, list):
+        merged = list(target)
+        for i, value in enumerate(source):
+            if i < len(merged):
+                merged[i] = merge(merged[i], value)
+            else:
+                merged.append(value)
+        return merged
+    return copy.deepcopy(source)
+
+
+def volumes_attrs(count: int) -> dict:
+    return {
+        'manifest_path': '/archive/ds.tar.volumes.json',
+        'volume_size': 10,
+        'volumes': [{'name': f'ds.tar.vol{i:05d}', 'path': f'/archive/ds.tar.vol{i:05d}'} for i in range(count)],
+    }
+
+
+def test_rearchived_volumes_replace_the_earlier_ones(monkeypatch):
+    dataset = {'id': 1, 'name': 'ds', 'metadata': {'bundle_volumes': volumes_attrs(3)}}
+
+    def update_dataset(dataset_id, update_data):
+        dataset['metadata'] = merge(dataset['metadata'], update_data.get('metadata', {}))
+
+    monkeypatch.setattr(api, 'get_dataset', lambda dataset_id, bundle: dataset)
+    monkeypatch.setattr(api, 'update_dataset', update_dataset)
+    monkeypatch.setattr(api, 'add_state_to_dataset', lambda dataset_id, state: None)
+    monkeypatch.setattr(archive, 'archive',
+                        lambda celery_task, dataset: ('/archive/ds.tar', {}, None, None, volumes_attrs(2)))
+
+    archive.archive_dataset(None, 1)
+
+    assert dataset['metadata']['bundle_volumes'] == volumes_attrs(2)
+    assert dataset['metadata']['bundle_segments'] is None
@@ -0,0 +1,38 @@
+import os
+import tarfile
+from pathlib import Path, PurePosixPath
+
+import workers.bundle as bundle
+
+
+def test_indexer_reads_across_chunks(tmp_path: Path):
+    data = os.urandom(100_000)
+    indexer = bundle._Indexer(tmp_path / 'index.jsonl.gz', block_size=4096)
+    # 7 chunks and the end of the stream fit in the queue
+    for i in range(0, len(data), 15000):
+        indexer.chunks.put(data[i:i + 15000])
+    indexer.chunks.put(None)
+
+    parts = [indexer.read(10240), indexer.read(1), indexer.read(30000), indexer.read()]
+
+    assert b''.join(parts) == data
+    assert [len(p) for p in parts[:3]] == [10240, 1, 30000]
+    assert indexer.read(10) == b''
+
+
+def test_index_of_written_bundle(tmp_path: Path):
+    source = tmp_path / 'ds'
+    (source / 'sub').mkdir(parents=True)
+    (source / 'a').write_bytes(os.urandom(5 * 1024 * 1024 + 3))
+    (source / 'sub' / 'b').write_bytes(b'b')
+    tar_path = tmp_path / 'ds.tar'
+    index_path = bundle.get_index_path(tar_path)
+
+    bundle.write_bundle(tar_path, source, block_size=64 * 1024, index_path=index_path)
+
+    records = {r['path']: r for r in bundle.read_index(index_path)}
+    with tarfile.open(tar_path) as archive:
+        members = {str(PurePosixPath(m.name)): m for m in archive.getmembers()}
+    assert records.keys() == members.keys()
+    for name, member in members.items():
+        assert (records[name]['offset_data'], records[name]['size']) == (member.offset_data, member.size)
@@ -0,0 +1,67 @@
+import logging
+
+import pytest
+from celery.backends.base import DisabledBackend
+
+import workers.tasks.stage as stage
+from workers import exceptions as exc
+from workers.config import config
+from workers.tasks.declarations import stage_dataset
+
+
+@pytest.fixture
+def calls(monkeypatch):
+    """
+    the stage task body fails with the exceptions queued in calls['raise'] and then returns the dataset id
+    """
+    calls = {'raise': [], 'count': 0}
+
+    def task_body(celery_task, dataset_id, **kwargs):
+        calls['count'] += 1
+        if calls['raise']:
+            raise calls['raise'].pop(0)
+        return dataset_id,
+
+    monkeypatch.setattr(stage, 'stage_dataset', task_body)
+    monkeypatch.setitem(config['stage']['admission'], 'max_deferrals', 10)
+    # eager tasks do not store their results, but the configured result backend is still created
+    app = stage_dataset.app
+    monkeypatch.setattr(app._local, 'backend', DisabledBackend(app), raising=False)
+    # celery 5.2 logs task failures with a traceback that python 3.11's traceback module can not format
+    monkeypatch.setattr(logging.getLogger('celery.app.trace'), 'disabled', True)
+    return calls
+
+
+def test_deferrals_are_not_limited_by_max_retries(calls):
+    calls['raise'] = [exc.Deferred('no space', countdown=1) for _ in range(stage_dataset.max_retries + 3)]
+
+    result = stage_dataset.apply(args=(1,))
+
+    assert result.successful()
+    assert calls['count'] == stage_dataset.max_retries + 4
+
+
+def test_failures_after_deferrals_are_retried(calls):
+    calls['raise'] = [exc.Deferred('no space', countdown=1) for _ in range(5)] + \
+                     [RuntimeError('sda') for _ in range(stage_dataset.max_retries)]
+
+    assert stage_dataset.apply(args=(1,)).successful()
+
+
+def test_failures_are_limited_by_max_retries(calls):
+    calls['raise'] = [RuntimeError('sda') for _ in range(stage_dataset.max_retries + 1)]
+
+    result = stage_dataset.apply(args=(1,))
+
+    # not .get() - celery 5.2 can not re-raise the task's exception with its traceback on python 3.11
+    assert isinstance(result.result, RuntimeError)
+    assert calls['count'] == stage_dataset.max_retries + 1
+
+
+def test_deferrals_are_limited_by_max_deferrals(calls):
+    calls['raise'] = [exc.Deferred('no space', countdown=1) for _ in range(11)]
+
+    result = stage_dataset.apply(args=(1,))
+
+    assert isinstance(result.result, exc.Deferred)
+    assert calls['count'] == 11
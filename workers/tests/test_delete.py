@@ -0,0 +1,51 @@
+from pathlib import Path
+
+import pytest
+
+import workers.api as api
+from workers.tasks.delete import delete_dataset
+
+
+@pytest.fixture
+def updates(monkeypatch):
+    updates = []
+    monkeypatch.setattr(api, 'update_dataset', lambda dataset_id, update_data: updates.append(update_data))
+    monkeypatch.setattr(api, 'add_state_to_dataset', lambda dataset_id, state: updates.append(state))
+    return updates
+
+
+def test_bundle_and_index_are_deleted(sda_root: Path, updates, monkeypatch):
+    archive_dir = sda_root / 'archive'
+    archive_dir.mkdir()
+    (archive_dir / 'ds.tar').write_bytes(b'bundle')
+    (archive_dir / 'ds.tar.index.jsonl').write_bytes(b'index')
+    (archive_dir / 'other.tar').write_bytes(b'other')
+    dataset = {
+        'id': 1,
+        'name': 'ds',
+        'archive_path': '/archive/ds.tar',
+        'metadata': {
+            'bundle_index': {
+                'name': 'ds.tar.index.jsonl',
+                'sda_path': '/archive/ds.tar.index.jsonl',
+            }
+        }
+    }
+    monkeypatch.setattr(api, 'get_dataset', lambda dataset_id: dataset)
+
+    delete_dataset(None, 1)
+
+    assert sorted(p.name for p in archive_dir.iterdir()) == ['other.tar']
+    assert updates[-1] == 'DELETED'
+
+
+def test_dataset_without_index(sda_root: Path, updates, monkeypatch):
+    archive_dir = sda_root / 'archive'
+    archive_dir.mkdir()
+    (archive_dir / 'ds.tar').write_bytes(b'bundle')
+    dataset = {'id': 1, 'name': 'ds', 'archive_path': '/archive/ds.tar', 'metadata': {}}
+    monkeypatch.setattr(api, 'get_dataset', lambda dataset_id: dataset)
+
+    delete_dataset(None, 1)
+
+    assert list(archive_dir.iterdir()) == []
@@ -0,0 +1,71 @@
+import io
+import tarfile
+import threading
+import time
+from pathlib import Path
+
+import pytest
+
+import workers.extract as extract_lib
+from workers import exceptions as exc
+
+
+def make_tar(members: list[tuple[tarfile.TarInfo, bytes | None]]) -> bytes:
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode='w') as archive:
+        for info, data in members:
+            archive.addfile(info, io.BytesIO(data) if data is not None else None)
+    return buffer.getvalue()
+
+
+def directory(name: str) -> tarfile.TarInfo:
+    info = tarfile.TarInfo(name)
+    info.type = tarfile.DIRTYPE
+    info.mode = 0o755
+    return info
+
+
+def file(name: str, data: bytes) -> tuple[tarfile.TarInfo, bytes]:
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    return info, data
+
+
+def symlink(name: str, target: str) -> tarfile.TarInfo:
+    info = tarfile.TarInfo(name)
+    info.type = tarfile.SYMTYPE
+    info.linkname = target
+    return info
+
+
+def test_symlink_replacing_directory_does_not_redirect_queued_writes(tmp_path: Path, monkeypatch):
+    outside = tmp_path / 'outside'
+    outside.mkdir()
+    dest = tmp_path / 'dest'
+    dest.mkdir()
+    members = [(directory('x'), None)]
+    members += [file(f'x/f{i}', b'data' * 100) for i in range(20)]
+    members += [(symlink('x', str(outside)), None)]
+    tar = make_tar(members)
+
+    # directories created by the pool appear late, so that the link is read while x and its files are still queued
+    mkdir = Path.mkdir
+
+    def slow_mkdir(self, *args, **kwargs):
+        if threading.current_thread() is not threading.main_thread():
+            time.sleep(0.2)
+        return mkdir(self, *args, **kwargs)
+
+    monkeypatch.setattr(Path, 'mkdir', slow_mkdir)
+
+    list(extract_lib.extract_tar(io.BytesIO(tar), dest, max_workers=8))
+
+    assert list(outside.iterdir()) == []
+    assert (dest / 'x').is_dir() and not (dest / 'x').is_symlink()
+    assert len(list((dest / 'x').iterdir())) == 20
+
+
+def test_members_under_symlink_are_rejected(tmp_path: Path):
+    tar = make_tar([(symlink('x', '/tmp'), None), file('x/f', b'data')])
+    with pytest.raises(exc.ValidationFailed):
+        list(extract_lib.extract_tar(io.BytesIO(tar), tmp_path, max_workers=8))
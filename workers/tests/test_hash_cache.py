@@ -0,0 +1,40 @@
+import os
+import sqlite3
+from pathlib import Path
+
+import pytest
+
+import workers.hash_cache as hash_cache
+from workers.config import config
+
+
+@pytest.fixture
+def cache_db(tmp_path: Path, monkeypatch) -> Path:
+    db_path = tmp_path / 'hash_cache.sqlite3'
+    monkeypatch.setitem(config['paths'], 'hash_cache', str(db_path))
+    monkeypatch.setitem(config['hash_cache'], 'enabled', True)
+    # a connection to another database may be open in this thread
+    monkeypatch.setattr(hash_cache._local, 'pid', None, raising=False)
+    return db_path
+
+
+def last_used(db_path: Path) -> list[float]:
+    with sqlite3.connect(db_path) as conn:
+        return [row[0] for row in conn.execute('SELECT last_used FROM digests ORDER BY ino')]
+
+
+def test_hits_are_written_back_in_batches(cache_db: Path, tmp_path: Path, monkeypatch):
+    monkeypatch.setattr(hash_cache, 'TOUCH_BATCH_SIZE', 3)
+    stats = []
+    for i in range(3):
+        path = tmp_path / f'f{i}'
+        path.write_text(str(i))
+        stats.append(os.stat(path))
+        hash_cache.put(stats[-1], f'digest{i}')
+    written = last_used(cache_db)
+
+    assert [hash_cache.get(st) for st in stats[:2]] == ['digest0', 'digest1']
+    assert last_used(cache_db) == written
+
+    assert hash_cache.get(stats[2]) == 'digest2'
+    assert all(after > before for before, after in zip(written, last_used(cache_db)))
@@ -0,0 +1,66 @@
+from pathlib import Path
+
+import pytest
+
+import workers.api as api
+import workers.tasks.inspect as inspect
+import workers.treewalk as treewalk
+from workers import exceptions as exc
+from workers.config import config
+
+
+class Dataset:
+    """
+    the API's record of a dataset, updated like the API does for the metadata used here
+    """
+
+    def __init__(self, origin_path: Path):
+        self.record = {'id': 1, 'origin_path': str(origin_path), 'metadata': {}}
+        self.files = []
+
+    def update(self, dataset_id, update_data):
+        metadata = update_data.pop('metadata', {})
+        self.record.update(update_data)
+        self.record['metadata'].update(metadata)
+
+
+@pytest.fixture
+def dataset(tmp_path: Path, monkeypatch) -> Dataset:
+    source = tmp_path / 'source'
+    (source / 'sub').mkdir(parents=True)
+    (source / 'a.txt').write_text('a')
+    (source / 'sub' / 'b.txt').write_text('b')
+    monkeypatch.setitem(config['paths'], 'inspect_checkpoints', str(tmp_path / 'checkpoints'))
+    monkeypatch.setitem(config['hash_cache'], 'enabled', False)
+
+    ds = Dataset(source)
+    monkeypatch.setattr(api, 'get_dataset', lambda dataset_id: ds.record)
+    monkeypatch.setattr(api, 'update_dataset', ds.update)
+    monkeypatch.setattr(api, 'add_files_to_dataset', lambda dataset_id, files: ds.files.extend(files))
+    return ds
+
+
+def test_unreadable_files_fail_the_inspection_before_the_dataset_is_updated(dataset: Dataset, monkeypatch):
+    walk = treewalk.walk
+
+    def walk_with_error(root, onerror=None, **kwargs):
+        onerror(str(Path(root) / 'sub'), PermissionError())
+        yield from walk(root, onerror=onerror, **kwargs)
+
+    monkeypatch.setattr(treewalk, 'walk', walk_with_error)
+
+    with pytest.raises(exc.InspectionFailed):
+        inspect.inspect_dataset(None, 1)
+
+    assert 'num_files' not in dataset.record
+    assert len(dataset.record['metadata']['inspection_errors']) == 1
+
+
+def test_a_successful_inspection_clears_earlier_errors(dataset: Dataset):
+    dataset.record['metadata']['inspection_errors'] = ['sub is not readable/traversable']
+
+    inspect.inspect_dataset(None, 1)
+
+    assert dataset.record['num_files'] == 2
+    assert dataset.record['metadata']['inspection_errors'] is None
+    assert sorted(f['path'] for f in dataset.files) == ['a.txt', 'sub/b.txt']
@@ -0,0 +1,42 @@
+import hashlib
+import os
+from pathlib import Path
+
+import pytest
+
+import workers.sda as sda
+import workers.sda_parallel as sda_parallel
+from workers import exceptions as exc
+
+
+@pytest.fixture
+def bundle(tmp_path: Path) -> Path:
+    path = tmp_path / 'ds.tar'
+    path.write_bytes(os.urandom(10 * 1024))
+    return path
+
+
+def test_put_records_segment_checksums_in_sda(sda_root: Path, bundle: Path):
+    (sda_root / 'archive').mkdir()
+    md5 = hashlib.md5(bundle.read_bytes()).hexdigest()
+
+    manifest = sda_parallel.put(bundle, '/archive/ds.tar', md5=md5, segment_size=4096, max_workers=2)
+
+    assert len(manifest['segments']) == 3
+    hashes = sda.get_hashes([segment['path'] for segment in manifest['segments']])
+    assert [hashes[segment['path']] for segment in manifest['segments']] == \
+           [segment['md5'] for segment in manifest['segments']]
+    assert sda_parallel.read_manifest('/archive/ds.tar') == manifest
+
+
+def test_put_fails_without_a_matching_checksum_in_sda(sda_root: Path, bundle: Path, monkeypatch):
+    (sda_root / 'archive').mkdir()
+    put_stream = sda.put_stream
+    # segments put without -c on have no checksum in SDA
+    monkeypatch.setattr(sda, 'put_stream', lambda sda_file: put_stream(sda_file, verify_checksum=False))
+
+    with pytest.raises(exc.ValidationFailed):
+        sda_parallel.put(bundle, '/archive/ds.tar', md5='', segment_size=4096, max_workers=2)
+
+    # the manifest is not written, so the bundle is not taken as archived
+    assert not (sda_root / 'archive' / 'ds.tar.segments.json').exists()
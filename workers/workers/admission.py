@@ -0,0 +1,159 @@
+"""
+Stage admission control - reserve space on the stage filesystems before a dataset is fetched
+
+Stage tasks that start at the same time on a host would each see the same free space and together oversubscribe
+the bundle staging and stage filesystems. Before fetching, a stage task reserves the bytes it is going to write
+(the bundle and the extracted files). The reservations of the tasks running on this host are kept in a JSON ledger
+at config['paths']['stage_reservations'], which must be on a host-local filesystem - it is locked with flock.
+
+Before admitting, the water marks of the stage cache are enforced (see stage_cache.ensure_space), as they are when
+admission is disabled. A task is admitted if, on every filesystem it writes to, the free space less the reservations of the other tasks and
+the headroom (config['stage']['admission']['min_free_fraction'] of the filesystem) covers its reservation. If not, idle
+staged datasets are evicted (see stage_cache.ensure_space) and if that is not enough, the task is deferred
+(exceptions.Deferred) to be retried after config['stage']['admission']['defer_seconds'].
+
+A reservation is held until the task completes or fails. The bytes that a task has already written are counted
+both in its reservation and in the used space of the filesystem, so admission is conservative while tasks are in
+flight. Reservations of processes that are no longer running (e.g. a killed worker) are dropped.
+"""
+from __future__ import annotations
+
+import fcntl
+import json
+import logging
+import os
+import shutil
+import time
+from collections.abc import Iterator
+from contextlib import contextmanager
+from pathlib import Path
+
+import workers.stage_cache as stage_cache
+from workers import exceptions as exc
+from workers.config import config
+
+logger = logging.getLogger(__name__)
+
+
+def _is_live(reservation: dict) -> bool:
+    if time.time() - reservation['created'] > config['stage']['admission']['reservation_ttl_seconds']:
+        return False
+    try:
+        os.kill(reservation['pid'], 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # the process exists but belongs to another user
+        pass
+    return True
+
+
+@contextmanager
+def _ledger() -> Iterator[dict]:
+    """
+    yields the live reservations keyed by reservation key, with the ledger locked exclusively.
+    Changes to the dict are written back to the ledger.
+    """
+    ledger_path = Path(config['paths']['stage_reservations'])
+    ledger_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(ledger_path, 'a+') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.seek(0)
+        text = f.read()
+        reservations = json.loads(text) if text.strip() else {}
+        reservations = {key: r for key, r in reservations.items() if _is_live(r)}
+        yield reservations
+        f.seek(0)
+        f.truncate()
+        json.dump(reservations, f)
+        f.flush()
+
+
+def _by_device(required: dict[Path, int]) -> tuple[dict[str, int], dict[str, Path]]:
+    """
+    groups the required bytes by filesystem, returns the bytes and a path on each filesystem keyed by device
+    """
+    num_bytes = {}
+    paths = {}
+    for path, n in required.items():
+        path = stage_cache.filesystem_path(path)
+        # JSON object keys are strings
+        dev = str(os.stat(path).st_dev)
+        num_bytes[dev] = num_bytes.get(dev, 0) + n
+        paths[dev] = path
+    return num_bytes, paths
+
+
+def _try_admit(key: str, num_bytes: dict[str, int], paths: dict[str, Path]) -> dict[str, int]:
+    """
+    records the reservation if it fits on every filesystem.
+    returns the bytes that have to be free on the filesystems where it did not fit - empty if it was admitted
+    """
+    min_free_fraction = config['stage']['admission']['min_free_fraction']
+    with _ledger() as reservations:
+        reservations.pop(key, None)
+        shortfall = {}
+        for dev, n in num_bytes.items():
+            reserved = sum(r['bytes'].get(dev, 0) for r in reservations.values())
+            usage = shutil.disk_usage(paths[dev])
+            needed = reserved + n + int(min_free_fraction * usage.total)
+            if usage.free < needed:
+                shortfall[dev] = needed
+        if not shortfall:
+            reservations[key] = {
+                'pid': os.getpid(),
+                'created': time.time(),
+                'bytes': num_bytes,
+            }
+        return shortfall
+
+
+def _release(key: str) -> None:
+    with _ledger() as reservations:
+        reservations.pop(key, None)
+
+
+@contextmanager
+def reserve(key: str, required: dict[Path, int], exclude: list[int] = None) -> Iterator[None]:
+    """
+    Holds a reservation of the required bytes for the duration of the with block.
+
+    Raises exceptions.Deferred if there is not enough space even after evicting idle staged datasets.
+
+    @param key: unique key of the reservation, e.g. 'stage:<dataset id>'
+    @param required: bytes about to be written to each directory
+    @param exclude: ids of the datasets to not evict to make room, e.g. the dataset being staged
+    """
+    admission_config = config['stage']['admission']
+    if not admission_config['enabled']:
+        # the water marks of the stage cache are enforced regardless - raises RetryableException if the data does
+        # not fit even after evicting idle datasets
+        stage_cache.ensure_space(required, exclude=exclude or [])
+        yield
+        return
+
+    # keep the stage filesystems below the high water mark of the stage cache, whether or not the data fits now
+    try:
+        stage_cache.ensure_space(required, exclude=exclude or [])
+    except exc.RetryableException as e:
+        # whether the task waits for space is decided by admission below
+        logger.warning(str(e))
+
+    num_bytes, paths = _by_device(required)
+    shortfall = _try_admit(key, num_bytes, paths)
+    if shortfall:
+        logger.info(f'not enough space to admit {key}, making room: {shortfall}')
+        try:
+            stage_cache.ensure_space({paths[dev]: needed for dev, needed in shortfall.items()}, exclude=exclude or [])
+        except exc.RetryableException as e:
+            logger.warning(str(e))
+        shortfall = _try_admit(key, num_bytes, paths)
+    if shortfall:
+        raise exc.Deferred(f'not enough space to admit {key}: bytes needed by device {shortfall}',
+                           countdown=admission_config['defer_seconds'])
+
+    logger.info(f'admitted {key}, reserved bytes by device: {num_bytes}')
+    try:
+        yield
+    finally:
+        _release(key)
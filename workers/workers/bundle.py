@@ -0,0 +1,290 @@
+"""
+Bundle creation - tar a dataset directory, checksum the tar and index its members in a single pass
+
+A bundle can also be written as volumes: consecutive byte ranges of the tar of at most volume_size bytes,
+<bundle>.vol00000, <bundle>.vol00001, ... (see write_bundle_volumes). Concatenated, the volumes are the tar, so the
+md5 of the bundle and the offsets of its index apply to them as they do to a single tar file.
+"""
+from __future__ import annotations
+
+import gzip
+import hashlib
+import json
+import logging
+import queue
+import tarfile
+import threading
+from collections.abc import Iterator
+from pathlib import Path, PurePosixPath
+from typing import BinaryIO, TextIO
+
+from workers import cmd
+
+logger = logging.getLogger(__name__)
+
+BLOCK_SIZE = 4 * 1024 * 1024
+
+
+def get_index_path(tar_path: Path) -> Path:
+    return tar_path.with_name(f'{tar_path.name}.index.jsonl.gz')
+
+
+def write_bundle(tar_path: Path,
+                 source_dir: Path | str,
+                 block_size: int = BLOCK_SIZE,
+                 index_path: Path = None) -> tuple[str, int]:
+    """
+    Create a tar of source_dir at tar_path and compute its md5 while it is written.
+
+    GNU tar writes the archive to its stdout, which is hashed and written to tar_path as it is produced,
+    so the bundle does not have to be read again to compute the checksum.
+
+    If index_path is provided, the tar stream is also parsed (in a separate thread) as it is produced and an index
+    of its members is written to index_path (see build_index).
+
+    If tar fails, SubprocessError is raised (see cmd.execute) and the partially written tar_path is left as is.
+
+    @param tar_path: path of the tar file to create; overwritten if it exists
+    @param source_dir: directory to archive
+    @param block_size: number of bytes read from the tar process at a time
+    @param index_path: path of the member index to write, None to not write an index
+    @return: md5 hex digest and size in bytes of the tar file
+    """
+    with open(tar_path, 'wb') as tar_file:
+        return _write_tar(tar_file, source_dir, block_size, index_path)
+
+
+def get_volume_path(tar_path: Path, index: int) -> Path:
+    return tar_path.with_name(f'{tar_path.name}.vol{index:05d}')
+
+
+def get_volumes_manifest_path(tar_path: Path) -> Path:
+    return tar_path.with_name(f'{tar_path.name}.volumes.json')
+
+
+def write_bundle_volumes(tar_path: Path,
+                         source_dir: Path | str,
+                         volume_size: int,
+                         block_size: int = BLOCK_SIZE,
+                         index_path: Path = None) -> tuple[str, int, list[dict]]:
+    """
+    Same as write_bundle, but the tar is written as volumes of volume_size bytes (the last one may be smaller)
+    next to tar_path, each hashed as it is written. Volumes of an earlier bundle at tar_path are deleted first.
+
+    @return: md5 hex digest and size in bytes of the tar, and for each volume in order:
+             {"name": <file name>, "offset": <offset of the volume in the tar>, "size": <bytes>, "md5": <md5>}
+    """
+    for path in tar_path.parent.glob(f'{tar_path.name}.vol[0-9]*'):
+        path.unlink()
+    with _VolumeWriter(tar_path, volume_size) as writer:
+        md5, size = _write_tar(writer, source_dir, block_size, index_path)
+    return md5, size, writer.volumes
+
+
+def _write_tar(tar_file: BinaryIO,
+               source_dir: Path | str,
+               block_size: int,
+               index_path: Path | None) -> tuple[str, int]:
+    command = cmd.tar_command(tar_path='-', source_dir=source_dir)
+    m = hashlib.md5()
+    size = 0
+    buffer = memoryview(bytearray(block_size))
+    indexer = None
+    if index_path is not None:
+        indexer = _Indexer(index_path, block_size)
+        indexer.start()
+    try:
+        with cmd.stream_stdout(command) as stdout:
+            while True:
+                n = stdout.readinto(buffer)
+                if not n:
+                    break
+                chunk = buffer[:n]
+                m.update(chunk)
+                tar_file.write(chunk)
+                if indexer is not None:
+                    # the buffer is reused - the indexer gets a copy
+                    indexer.feed(bytes(chunk))
+                size += n
+    except BaseException:
+        # the error of the tar process takes precedence over that of the indexer
+        if indexer is not None:
+            indexer.finish(raise_error=False)
+        raise
+    if indexer is not None:
+        indexer.finish()
+    return m.hexdigest(), size
+
+
+def build_index(fileobj: BinaryIO, index_file: TextIO, block_size: int = BLOCK_SIZE) -> int:
+    """
+    Reads a tar from fileobj sequentially and writes a JSON line for every member to index_file:
+        {"path": <normalized member name>, "type": <tarfile type flag>, "offset": <offset of the member's first
+         header>, "offset_data": <offset of the member's data>, "end": <offset after the member's data>,
+         "size": <size of the file>, "mode": <permissions>, "md5": <md5 of the file's data, regular files only>,
+         "linkname": <target of hard and symbolic links>}
+
+    Offsets are in bytes from the start of the tar. The header offset includes any extended headers of the member
+    (long names, pax headers), so the bytes from offset to end form a valid tar of that member alone.
+
+    @return: number of members indexed
+    """
+    num_members = 0
+    # see extract.STREAM_BUFSIZE
+    with tarfile.open(fileobj=fileobj, mode='r|', bufsize=tarfile.RECORDSIZE) as archive:
+        for member in archive:
+            record = {
+                'path': str(PurePosixPath(member.name)),
+                'type': member.type.decode(),
+                'offset': member.offset,
+                'offset_data': member.offset_data,
+                # the offset of the next member's header
+                'end': archive.offset,
+                'size': member.size,
+                'mode': member.mode,
+            }
+            if member.islnk() or member.issym():
+                record['linkname'] = member.linkname
+            if member.isreg():
+                m = hashlib.md5()
+                with archive.extractfile(member) as f:
+                    while True:
+                        data = f.read(block_size)
+                        if not data:
+                            break
+                        m.update(data)
+                record['md5'] = m.hexdigest()
+            index_file.write(json.dumps(record) + '\n')
+            num_members += 1
+    return num_members
+
+
+def member_span(record: dict) -> tuple[int, int]:
+    """
+    returns the (start, end) byte range of the tar that holds the member described by an index record:
+    its headers and its data padded to the tar block size
+    """
+    return record['offset'], record['end']
+
+
+def read_index(index_path: Path) -> Iterator[dict]:
+    with gzip.open(index_path, 'rt') as f:
+        for line in f:
+            yield json.loads(line)
+
+
+class _VolumeWriter:
+    """
+    A writable file object that splits what is written to it into volumes of volume_size bytes
+    (see write_bundle_volumes) and hashes each of them
+    """
+
+    def __init__(self, tar_path: Path, volume_size: int):
+        self.tar_path = tar_path
+        self.volume_size = volume_size
+        self.volumes = []
+        self.file = None
+        self.md5 = None
+
+    def _next_volume(self):
+        self._close_volume()
+        offset = sum(v['size'] for v in self.volumes)
+        path = get_volume_path(self.tar_path, len(self.volumes))
+        self.volumes.append({'name': path.name, 'offset': offset, 'size': 0, 'md5': None})
+        self.file = open(path, 'wb')
+        self.md5 = hashlib.md5()
+
+    def _close_volume(self):
+        if self.file is not None:
+            self.file.close()
+            self.volumes[-1]['md5'] = self.md5.hexdigest()
+            self.file = None
+
+    def write(self, data) -> int:
+        data = memoryview(data)
+        written = 0
+        while written < len(data):
+            if self.file is None or self.volumes[-1]['size'] == self.volume_size:
+                self._next_volume()
+            n = min(len(data) - written, self.volume_size - self.volumes[-1]['size'])
+            chunk = data[written:written + n]
+            self.file.write(chunk)
+            self.md5.update(chunk)
+            self.volumes[-1]['size'] += n
+            written += n
+        return written
+
+    def close(self):
+        self._close_volume()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class _Indexer:
+    """
+    Runs build_index in a thread on the chunks of the tar stream fed to it.
+    The index is written gzip compressed.
+    """
+
+    def __init__(self, index_path: Path, block_size: int):
+        self.index_path = index_path
+        self.block_size = block_size
+        # bounds the memory used when the indexer falls behind the tar process
+        self.chunks = queue.Queue(maxsize=8)
+        # the chunk being read and the offset of the next byte in it - reads are sliced out of the chunks instead
+        # of being split off a buffer, which would copy the rest of the buffer on every read
+        self.chunk = memoryview(b'')
+        self.offset = 0
+        self.eof = False
+        self.error = None
+        self.num_members = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def feed(self, chunk: bytes):
+        self.chunks.put(chunk)
+
+    def finish(self, raise_error: bool = True):
+        # None marks the end of the stream
+        self.chunks.put(None)
+        self.thread.join()
+        if raise_error and self.error is not None:
+            raise self.error
+
+    def read(self, size: int = -1) -> bytes:
+        parts = []
+        num_read = 0
+        while size < 0 or num_read < size:
+            if self.offset == len(self.chunk):
+                if self.eof:
+                    break
+                chunk = self.chunks.get()
+                if chunk is None:
+                    self.eof = True
+                    break
+                self.chunk, self.offset = memoryview(chunk), 0
+                continue
+            available = len(self.chunk) - self.offset
+            n = available if size < 0 else min(available, size - num_read)
+            parts.append(self.chunk[self.offset:self.offset + n])
+            self.offset += n
+            num_read += n
+        return b''.join(parts)
+
+    def _run(self):
+        try:
+            with gzip.open(self.index_path, 'wt') as index_file:
+                self.num_members = build_index(self, index_file, self.block_size)
+        except Exception as e:
+            self.error = e
+        finally:
+            # consume the rest of the stream (the padding after the end of the archive, or everything after an
+            # error) so that feed does not block
+            while not self.eof:
+                self.read(self.block_size)
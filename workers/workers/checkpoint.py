@@ -0,0 +1,119 @@
+"""
+Checkpoints for resuming the inspection of a dataset after a failure
+
+The metadata of every inspected file is appended to a spool file (JSON lines) under
+config['paths']['inspect_checkpoints'] as soon as it is computed, along with markers for the number of files whose
+metadata was posted to the API. Files are inspected in a deterministic order, so the spool of an attempt is a prefix
+of the sequence of files the next attempt will produce.
+
+When the inspect task is retried, the previous spool is read back sequentially alongside the directory walk:
+files that match the spooled records (same path, inode, size and mtime) are not hashed again, and files that were
+already posted are not sent again. Memory use does not depend on the size of the spool.
+
+Spool line formats:
+    {"file": {<file metadata>}, "stat": [inode, size, mtime_ns]}
+    {"posted": <number of files posted to the API so far>}
+"""
+from __future__ import annotations
+
+import json
+import logging
+import os
+from collections.abc import Iterator
+from pathlib import Path
+
+from workers.config import config
+
+logger = logging.getLogger(__name__)
+
+
+def stat_signature(st: os.stat_result) -> list[int]:
+    return [st.st_ino, st.st_size, st.st_mtime_ns]
+
+
+def read_spool(path: Path) -> Iterator[dict]:
+    with open(path) as f:
+        for line in f:
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                # the last line may have been partially written when the previous attempt died
+                logger.warning(f'ignoring a malformed line in inspection checkpoint {path}')
+
+
+class InspectionCheckpoint:
+
+    def __init__(self, dataset_id: int, spool_dir: Path | str = None):
+        spool_dir = Path(spool_dir or config['paths']['inspect_checkpoints'])
+        spool_dir.mkdir(parents=True, exist_ok=True)
+        self.path = spool_dir / f'{dataset_id}.jsonl'
+        self.previous_path = spool_dir / f'{dataset_id}.previous.jsonl'
+        # number of files (in inspection order) whose metadata has been posted to the API
+        self.num_posted = 0
+        # number of files looked up so far, i.e. the position of the next file in inspection order
+        self._position = 0
+        self._previous = None
+
+        # the spool of the last attempt is read back while this attempt writes a new one
+        if self.path.exists():
+            os.replace(self.path, self.previous_path)
+        if self.previous_path.exists():
+            for record in read_spool(self.previous_path):
+                if 'posted' in record:
+                    self.num_posted = record['posted']
+            self._previous = (record for record in read_spool(self.previous_path) if 'file' in record)
+            logger.info(f'resuming inspection from checkpoint {self.previous_path}, '
+                        f'{self.num_posted} files were posted')
+
+        self._spool = open(self.path, 'w')
+        if self.num_posted > 0:
+            self._append({'posted': self.num_posted})
+
+    def _append(self, record: dict) -> None:
+        self._spool.write(json.dumps(record) + '\n')
+        self._spool.flush()
+
+    def lookup(self, relpath: str, st: os.stat_result) -> dict | None:
+        """
+        Must be called for every file in inspection order, before add_file.
+
+        returns the checkpointed metadata of the file if the previous attempt inspected the same file at this
+        position and the file has not changed since, else None.
+        """
+        position = self._position
+        self._position += 1
+        if self._previous is None:
+            return None
+        record = next(self._previous, None)
+        if record is not None and record['file']['path'] == relpath and record['stat'] == stat_signature(st):
+            return record['file']
+
+        if record is not None:
+            logger.warning(f'{relpath} has changed since the inspection checkpoint was created, '
+                           f'inspecting the remaining files from scratch')
+            # the files at and after this position may not be the ones that were posted
+            if self.num_posted > position:
+                self.mark_posted(position)
+        self._previous = None
+        return None
+
+    def add_file(self, metadata: dict, st: os.stat_result) -> None:
+        self._append({'file': metadata, 'stat': stat_signature(st)})
+
+    def mark_posted(self, num_posted: int) -> None:
+        self.num_posted = num_posted
+        self._append({'posted': num_posted})
+
+    def close(self) -> None:
+        if self._spool is not None:
+            self._spool.close()
+            self._spool = None
+        self._previous = None
+
+    def discard(self) -> None:
+        """
+        delete the spool files, called once the inspection is complete
+        """
+        self.close()
+        self.path.unlink(missing_ok=True)
+        self.previous_path.unlink(missing_ok=True)
@@ -4,13 +4,18 @@ import logging
 import os
 import socket
 import subprocess
+import tempfile
+import threading
 import time
 from collections import namedtuple
+from collections.abc import Callable, Iterator
 from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from email.message import EmailMessage
 from pathlib import Path
 from queue import Queue
 from subprocess import Popen, PIPE
+from typing import BinaryIO
 
 from sca_rhythm import WorkflowTask
 
@@ -50,6 +55,120 @@ def execute(cmd: list[str], **kwargs) -> tuple[str, str]:
     return p.stdout, p.stderr
 
 
+def execute_monitored(cmd: list[str], monitor: Callable[[int], None], interval: float = 5) -> tuple[str, str]:
+    """
+    Same as execute, but while cmd runs, monitor is called with its pid every interval seconds in a thread
+    (and once more after it exits). Exceptions raised by monitor are logged and do not stop the command.
+    """
+    p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    done = threading.Event()
+
+    def monitor_loop():
+        while True:
+            stop = done.wait(interval)
+            try:
+                monitor(p.pid)
+            except Exception as e:
+                # log the exception message without stacktrace
+                logger.warning('exception in process monitor: %s', e)
+            if stop:
+                return
+
+    thread = threading.Thread(target=monitor_loop, daemon=True)
+    thread.start()
+    try:
+        stdout, stderr = p.communicate()
+    except BaseException:
+        p.kill()
+        p.wait()
+        raise
+    finally:
+        done.set()
+        thread.join()
+    if p.returncode != 0:
+        msg = {
+            'return_code': p.returncode,
+            'stdout': stdout,
+            'stderr': stderr,
+            'args': p.args
+        }
+        raise SubprocessError(msg)
+    return stdout, stderr
+
+
+@contextmanager
+def stream_stdout(cmd: list[str], check: bool = True) -> Iterator[BinaryIO]:
+    """
+    Runs cmd and yields its stdout as a binary file object, to be read while the command runs.
+
+    stderr is spooled to a temporary file so that a chatty command does not block on a full pipe.
+    The command is waited for when the context exits. If its return code is not zero and check is True,
+    SubprocessError is raised as in execute (with stdout None). If the context exits with an exception,
+    the command is killed.
+
+    Set check to False to stop reading before the end of the output: stdout is closed when the context exits and
+    the command fails with a broken pipe.
+    """
+    with tempfile.TemporaryFile() as stderr_file:
+        p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=stderr_file)
+        try:
+            yield p.stdout
+        except BaseException:
+            p.kill()
+            p.wait()
+            p.stdout.close()
+            raise
+        p.stdout.close()
+        p.wait()
+        if check and p.returncode != 0:
+            stderr_file.seek(0)
+            msg = {
+                'return_code': p.returncode,
+                'stdout': None,
+                'stderr': stderr_file.read().decode(errors='replace'),
+                'args': p.args
+            }
+            raise SubprocessError(msg)
+
+
+@contextmanager
+def stream_stdin(cmd: list[str]) -> Iterator[BinaryIO]:
+    """
+    Runs cmd and yields its stdin as a binary file object, to be written to while the command runs.
+
+    stdout and stderr are spooled to a temporary file. When the context exits, stdin is closed and the command is
+    waited for. If its return code is not zero, SubprocessError is raised as in execute (with stdout None).
+    If the context exits with an exception, the command is killed.
+    """
+    with tempfile.TemporaryFile() as output_file:
+        p = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=output_file, stderr=subprocess.STDOUT)
+        try:
+            yield p.stdin
+        except BaseException:
+            p.kill()
+            p.wait()
+            try:
+                p.stdin.close()
+            except BrokenPipeError:
+                pass
+            raise
+        try:
+            p.stdin.close()
+        except BrokenPipeError:
+            # the command exited early, its return code tells why
+            pass
+        p.wait()
+        if p.returncode != 0:
+            output_file.seek(0)
+            msg = {
+                'return_code': p.returncode,
+                'stdout': None,
+                'stderr': output_file.read().decode(errors='replace'),
+                'args': p.args
+            }
+            raise SubprocessError(msg)
+
+
 Log = namedtuple('Log', ['timestamp', 'level', 'message'])
 
 
@@ -159,9 +278,15 @@ def total_size(dir_path: Path | str):
     return int(completed_proc.stdout.split()[0])
 
 
+def tar_command(tar_path: Path | str, source_dir: Path | str) -> list[str]:
+    """
+    tar_path can be '-' to write the archive to stdout
+    """
+    return ['tar', 'cf', str(tar_path), '--sparse', '-C', str(source_dir), '.']
+
+
 def tar(tar_path: Path | str, source_dir: Path | str) -> None:
-    command = ['tar', 'cf', str(tar_path), '--sparse', '-C', str(source_dir), '.']
-    execute(command)
+    execute(tar_command(tar_path=tar_path, source_dir=source_dir))
 
 
 def fastqc_parallel(fastq_files: list[Path | str], output_dir: Path | str, num_threads: int = 8) -> None:
@@ -56,6 +56,12 @@ config = {
             },
         },
         'download_dir': '/path/to/download_dir',
+        # must be on a host-local filesystem - the cache is a SQLite database in WAL mode, whose shared memory index
+        # does not work over network filesystems (see workers.hash_cache)
+        'hash_cache': '/var/tmp/bioloop/hash_cache.sqlite3',
+        # must be on a host-local filesystem (see workers.admission)
+        'stage_reservations': '/var/tmp/bioloop/stage_reservations.json',
+        'inspect_checkpoints': '/path/to/scratch/inspect_checkpoints',
         'root': '/path/to/root'
     },
     'registration': {
@@ -99,7 +105,35 @@ config = {
             'days_to_live': 20,
             'max_purges': 10
         },
-        'alias_salt': ALIAS_SALT
+        # evict the least recently used staged datasets and bundles when a stage filesystem is filling up
+        # (see workers.stage_cache). The water marks are fractions of the size of the filesystem.
+        'cache': {
+            'enabled': True,
+            'high_water_mark': 0.85,
+            'low_water_mark': 0.75,
+            'min_idle_seconds': ONE_HOUR  # datasets downloaded or staged more recently than this are not evicted
+        },
+        # reserve the space for the bundle and the extracted files before a stage task fetches them
+        # (see workers.admission)
+        'admission': {
+            'enabled': True,
+            'min_free_fraction': 0.02,  # fraction of each stage filesystem that is not reserved
+            'defer_seconds': FIVE_MINUTES,  # stage tasks that are not admitted are retried after this long
+            'max_deferrals': 288,
+            'reservation_ttl_seconds': 2 * 24 * ONE_HOUR  # reservations older than this are dropped
+        },
+        'alias_salt': ALIAS_SALT,
+        # hash the files while extracting the bundle and write a manifest that validate checks against
+        # instead of reading the staged files again
+        'manifest': True,
+        # stream the bundle from SDA straight into extraction instead of downloading it to bundle.stage first
+        # the bundle is then not available for download
+        'streaming': False,
+        'extract': {
+            'max_workers': 8,  # number of threads creating the extracted files and directories
+            'max_inflight_bytes': 256 * 1024 * 1024,  # cap on the file data read from the bundle and not yet written
+            'max_buffered_file_size': 16 * 1024 * 1024  # larger files are written by the thread reading the bundle
+        }
     },
     'workflow_registry': {
         'stage': {
@@ -110,7 +144,23 @@ config = {
                 },
                 {
                     'name': 'validate',
-                    'task': 'validate_dataset'
+                    'task': 'validate_dataset',
+                    # the checksum of the bundle is verified when it is staged
+                    'kwargs': {
+                        'level': 'sampled'
+                    }
+                },
+                {
+                    'name': 'setup_download',
+                    'task': 'setup_dataset_download'
+                }
+            ]
+        },
+        'stage_files': {
+            'steps': [
+                {
+                    'name': 'stage files',
+                    'task': 'stage_dataset_files'
                 },
                 {
                     'name': 'setup_download',
@@ -138,7 +188,11 @@ config = {
                 },
                 {
                     'name': 'validate',
-                    'task': 'validate_dataset'
+                    'task': 'validate_dataset',
+                    # first stage after archiving - every file of the new bundle is verified
+                    'kwargs': {
+                        'level': 'full'
+                    }
                 },
                 {
                     'name': 'setup_download',
@@ -184,7 +238,78 @@ config = {
             'max_purge_count': 10
         }
     },
+    'sda': {
+        # command line of hsi, the SDA command is appended as the last argument
+        # point this at workers/scripts/fake_hsi.py to run against a local directory (see that script)
+        'hsi_command': ['hsi', '-P'],
+        # how often the progress of a transfer is read from the hsi process (see workers.proc_io)
+        'progress_interval_seconds': 5,
+        'batch_size': 1000,  # number of metadata commands sent to hsi as one script (see sda.run_many)
+        # run metadata commands (ls, hashlist, mkdir, rm) in long-lived hsi sessions (see workers.hsi_session)
+        'session': {
+            'enabled': True,
+            'pool_size': 4,  # number of hsi sessions open at once per worker process
+            'timeout_seconds': 300,  # a session that does not answer a command in this long is replaced
+            'idle_seconds': 600,  # sessions idle for longer than this are replaced before they are used
+            'error_pattern': r'^\*\*\*'  # hsi prefixes error messages with ***
+        },
+        # store large bundles as segments moved by concurrent hsi transfers (see workers.sda_parallel)
+        'parallel': {
+            'enabled': True,
+            'min_size': 64 * ONE_GIGABYTE,  # bundles smaller than this are moved by a single hsi transfer
+            'segment_size': 16 * ONE_GIGABYTE,
+            'max_workers': 8,  # number of concurrent hsi transfers
+            'retries': 2  # number of times a failed segment transfer is retried
+        }
+    },
+    'archive': {
+        # write an index of the bundle's members (offsets, sizes, md5) while the bundle is created
+        'index': True,
+        # hash the bundle while tar writes it, instead of reading the bundle again after it is written
+        'stream_checksum': True,
+        # write the bundles of large datasets as volumes that are uploaded and downloaded independently
+        # (see bundle.write_bundle_volumes)
+        'split': {
+            'enabled': True,
+            'min_size': 4 * 1024 * ONE_GIGABYTE,  # datasets of this du_size or larger are split
+            'volume_size': 512 * ONE_GIGABYTE,  # a few hours of a single hsi transfer
+            'max_workers': 4  # number of volumes uploaded concurrently
+        }
+    },
+    'digest': {
+        # hashlib algorithms computed, in a single read, for every inspected file
+        # md5 is always computed - it is the checksum the API stores for files. Every other algorithm adds its own
+        # hashing time to the inspection, so none is computed by default.
+        'algorithms': ['md5'],
+        # algorithm used by internal fixity checks (validate) for files that have a stored digest of this algorithm,
+        # md5 otherwise. To make fixity checks faster, add an algorithm that is faster than md5 on the workers' CPUs
+        # to algorithms as well - e.g. sha256 with the SHA extensions of recent x86-64 CPUs runs at about twice the
+        # speed of md5 (measure with hashlib - blake2b is only about 20% faster than md5)
+        'fixity_algorithm': 'md5',
+        'block_size': 8 * 1024 * 1024,  # bytes read at a time when hashing a file
+        # drop the pages of hashed files from the page cache, so that hashing does not evict other tasks' data
+        'drop_cache': True
+    },
+    'hash_cache': {
+        'enabled': True,
+        'max_entries': 5_000_000  # least recently used digests are evicted beyond this
+    },
     'inspect': {
-        'file_metadata_batch_size': 25000
+        'file_metadata_batch_size': 25000,
+        'post_concurrency': 2,  # number of file metadata batches posted to the API concurrently
+        'checksum': {
+            'max_workers': 4,  # number of files hashed concurrently
+            'max_inflight_bytes': 64 * ONE_GIGABYTE  # cap on the total size of the files being hashed at once
+        }
+    },
+    'validate': {
+        'max_workers': 4,  # number of files checked concurrently
+        'max_inflight_bytes': 64 * ONE_GIGABYTE,  # cap on the total size of the files being hashed at once
+        'max_errors': 1000,  # stop validating a dataset after these many errors
+        # default validation level: manifest, sampled or full (see tasks.validate.validate_dataset)
+        # workflows set their own level with the kwargs of the validate step in workflow_registry
+        'level': 'full',
+        'sample_size': 100,  # number of files whose digests are verified at the sampled level
+        'sample_weighting': 'size'  # size: larger files are more likely to be sampled, uniform: all files alike
     }
 }
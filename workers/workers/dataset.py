@@ -35,6 +35,13 @@ def compute_staging_path(dataset: dict) -> tuple[Path, str]:
     return staging_dir / alias / dataset['name'], alias
 
 
+def get_stage_manifest_path(staged_path: Path) -> Path:
+    """
+    path of the manifest of the files extracted to staged_path (see stage.extract_tarfile_with_manifest)
+    """
+    return staged_path.parent / f'{staged_path.name}.manifest.jsonl'
+
+
 def get_bundle_staged_path(dataset: dict) -> str:
     return f'{config["paths"][dataset["type"]]["bundle"]["stage"]}/{get_bundle_name(dataset)}'
 
@@ -0,0 +1,80 @@
+"""
+Digest engine - compute checksums of many files concurrently
+
+hashlib releases the GIL while digesting large buffers and file reads release it while waiting on I/O,
+so a pool of threads is enough to keep several files in flight on a parallel filesystem.
+"""
+from __future__ import annotations
+
+import logging
+from collections import deque
+from collections.abc import Callable, Iterable, Iterator
+from concurrent.futures import ThreadPoolExecutor
+from typing import TypeVar
+
+from sca_rhythm.progress import Progress
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar('T')
+R = TypeVar('R')
+
+
+def map_bounded(fn: Callable[[T], R],
+                items: Iterable[tuple[T, int]],
+                max_workers: int = 4,
+                max_inflight_bytes: int = None,
+                progress: Progress = None) -> Iterator[tuple[T, R]]:
+    """
+    Call fn on every item using a bounded pool of threads.
+
+    Results are yielded in the same order as the input, irrespective of the order in which the calls finish.
+
+    Each item comes with a size in bytes (the amount of file data fn reads). An item is not submitted to the pool
+    while the sum of the sizes of the items in flight (submitted and not yet yielded) would exceed max_inflight_bytes.
+    A single item larger than max_inflight_bytes is processed alone.
+
+    @param fn: function to call on each item
+    @param items: iterable of (item, size in bytes) tuples
+    @param max_workers: number of items processed concurrently
+    @param max_inflight_bytes: cap on the total size of the items in flight. None disables the cap.
+    @param progress: if provided, updated with the number of bytes processed so far
+    @return: generator of (item, fn(item)) tuples
+    """
+    inflight = deque()  # (item, size, future) in submission order
+    inflight_bytes = 0
+    bytes_done = 0
+
+    def has_capacity(size: int) -> bool:
+        if len(inflight) == 0:
+            return True
+        # allow a few items to queue behind the ones being processed so that a slow item at the head of the queue
+        # does not leave the other threads idle
+        if len(inflight) >= 2 * max_workers:
+            return False
+        return max_inflight_bytes is None or inflight_bytes + size <= max_inflight_bytes
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        try:
+            for item, size in items:
+                while not has_capacity(size):
+                    done_item, done_size, future = inflight.popleft()
+                    inflight_bytes -= done_size
+                    bytes_done += done_size
+                    yield done_item, future.result()
+                    if progress is not None:
+                        progress.update(bytes_done)
+
+                inflight.append((item, size, pool.submit(fn, item)))
+                inflight_bytes += size
+
+            while inflight:
+                done_item, done_size, future = inflight.popleft()
+                bytes_done += done_size
+                yield done_item, future.result()
+                if progress is not None:
+                    progress.update(bytes_done)
+        finally:
+            # the consumer stopped early or a call failed - do not wait for the queued items
+            for _, _, future in inflight:
+                future.cancel()
@@ -8,3 +8,15 @@ class ValidationFailed(Exception):
 
 class InspectionFailed(Exception):
     pass
+
+
+class Deferred(Exception):
+    """
+    the task can not run now and should be retried after countdown seconds
+
+    countdown has a default so that the exception can be rebuilt from its message alone, as result backends do
+    """
+
+    def __init__(self, message, countdown: int = None):
+        super().__init__(message)
+        self.countdown = countdown
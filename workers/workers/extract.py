@@ -0,0 +1,345 @@
+"""
+Bundle extraction - extract a tar and compute the digests of the extracted files in a single pass
+
+The bytes of each regular file are hashed while they are written out, so the extracted files do not have to be read
+again to validate them. The archive is read sequentially (tarfile stream mode), which also allows extracting from a
+pipe.
+
+Members whose paths would be written outside the destination directory (absolute paths, '..' components, or paths
+under a symbolic link extracted earlier) are rejected.
+"""
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+import os
+import tarfile
+from collections import deque
+from collections.abc import Iterable, Iterator
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path, PurePosixPath
+from typing import BinaryIO
+
+from sca_rhythm.progress import Progress
+
+from workers import exceptions as exc
+from workers import utils
+
+logger = logging.getLogger(__name__)
+
+BLOCK_SIZE = 4 * 1024 * 1024
+MAX_INFLIGHT_BYTES = 256 * 1024 * 1024
+MAX_BUFFERED_FILE_SIZE = 16 * 1024 * 1024
+# buffer size of tarfile's stream mode. tarfile slices its whole buffer for every header it reads, so a large
+# buffer makes reading tars with many small members slow - file data is read in block_size chunks regardless.
+STREAM_BUFSIZE = tarfile.RECORDSIZE
+
+# extraction of links and special files is delegated to tarfile, after the member has been checked here
+_EXTRACT_KWARGS = {'filter': 'fully_trusted'} if hasattr(tarfile, 'fully_trusted_filter') else {}
+
+
+def member_path(name: str) -> str:
+    """
+    returns the normalized relative path of a member name (./a//b -> a/b)
+    raises ValidationFailed if the path is absolute or has '..' components
+    """
+    p = PurePosixPath(name)
+    if p.is_absolute() or '..' in p.parts:
+        raise exc.ValidationFailed(f'unsafe path in archive: {name}')
+    return str(p)
+
+
+def _under_symlink(path: str, symlinks: set[str]) -> bool:
+    parent = PurePosixPath(path).parent
+    return any(str(p) in symlinks for p in [parent, *parent.parents])
+
+
+def extract_tar(source: Path | BinaryIO,
+                dest_dir: Path,
+                algorithms: Iterable[str] = ('md5',),
+                block_size: int = BLOCK_SIZE,
+                max_workers: int = 1,
+                max_inflight_bytes: int = MAX_INFLIGHT_BYTES,
+                max_buffered_file_size: int = MAX_BUFFERED_FILE_SIZE) -> Iterator[dict]:
+    """
+    Extract the tar at source (a path or a readable file object) into dest_dir.
+
+    The tar is read sequentially. With max_workers > 1, creating the files and directories and setting their
+    attributes is done by a pool of threads, which hides the latency of metadata operations on parallel filesystems
+    when the tar has many small files. The data of files up to max_buffered_file_size is read into memory and
+    handed to the pool, with at most max_inflight_bytes of file data held at a time. Larger files are written by the
+    calling thread as they are read.
+
+    Yields a manifest record for every directory, regular file, hard link and symbolic link once it is extracted,
+    in the order of the archive:
+        {"path": <normalized member name>, "type": "file", "size": <bytes>, "<algorithm>": <hex digest>, ...}
+        {"path": <normalized member name>, "type": "directory" | "symbolic link"}
+    The permissions and modification times of files and directories are restored like tarfile.extractall does.
+
+    @param source: path of the tar file or a file object to read the tar from, read sequentially
+    @param dest_dir: directory to extract into, must exist
+    @param algorithms: hashlib algorithms to compute the digests of the files with, none to not hash the files
+    @param block_size: number of bytes read from the tar at a time
+    @param max_workers: number of threads creating files and directories
+    @param max_inflight_bytes: cap on the size of the file data read from the tar and not yet written out
+    @param max_buffered_file_size: files larger than this are written by the calling thread
+    @return: generator of manifest records
+    """
+    algorithms = list(algorithms)
+    dest_dir = Path(dest_dir)
+    buffer = memoryview(bytearray(block_size))
+    restore_owner = hasattr(os, 'geteuid') and os.geteuid() == 0
+    symlinks = set()
+    directories = []
+    # (path, future of the manifest record, bytes of file data held) in archive order
+    pending = deque()
+    pending_paths = {}
+    inflight_bytes = 0
+
+    def set_attrs(archive: tarfile.TarFile, member: tarfile.TarInfo, target: Path) -> None:
+        if restore_owner:
+            archive.chown(member, str(target), False)
+        archive.chmod(member, str(target))
+        archive.utime(member, str(target))
+
+    def write_buffered(member: tarfile.TarInfo, target: Path, data: bytes, record: dict) -> dict:
+        hashers = [(algorithm, hashlib.new(algorithm)) for algorithm in algorithms]
+        with open(_create_file(target), 'wb') as dst:
+            dst.write(data)
+        for _, m in hashers:
+            m.update(data)
+        set_attrs(archive, member, target)
+        return record | {'size': len(data)} | {algorithm: m.hexdigest() for algorithm, m in hashers}
+
+    def make_dir(target: Path, record: dict) -> dict:
+        target.mkdir(parents=True, exist_ok=True)
+        return record
+
+    def done(record: dict) -> Future:
+        future = Future()
+        future.set_result(record)
+        return future
+
+    def pop_oldest() -> dict:
+        nonlocal inflight_bytes
+        path, future, size = pending.popleft()
+        record = future.result()
+        inflight_bytes -= size
+        if pending_paths.get(path) is future:
+            del pending_paths[path]
+        return record
+
+    if isinstance(source, (str, Path)):
+        archive = tarfile.open(source, mode='r|', bufsize=STREAM_BUFSIZE)
+    else:
+        archive = tarfile.open(fileobj=source, mode='r|', bufsize=STREAM_BUFSIZE)
+
+    with archive, ThreadPoolExecutor(max_workers=max_workers) as pool:
+        try:
+            for member in archive:
+                path = member_path(member.name)
+                if _under_symlink(path, symlinks):
+                    raise exc.ValidationFailed(f'unsafe path in archive: {member.name} is under a symbolic link')
+                target = dest_dir / path
+                if path in pending_paths:
+                    # the archive has several members with the same name - the last one wins
+                    pending_paths[path].result()
+
+                if member.isreg() and member.size <= max_buffered_file_size and max_workers > 1:
+                    with archive.extractfile(member) as src:
+                        data = src.read()
+                    while pending and inflight_bytes + len(data) > max_inflight_bytes:
+                        yield pop_oldest()
+                    record = {'path': path, 'type': utils.FileType.FILE.value}
+                    future = pool.submit(write_buffered, member, target, data, record)
+                    pending.append((path, future, len(data)))
+                    pending_paths[path] = future
+                    inflight_bytes += len(data)
+
+                elif member.isreg():
+                    record = {'path': path, 'type': utils.FileType.FILE.value}
+                    record.update(_write_file(archive, member, target, algorithms, buffer))
+                    set_attrs(archive, member, target)
+                    pending.append((path, done(record), 0))
+
+                elif member.isdir():
+                    record = {'path': path, 'type': utils.FileType.DIRECTORY.value}
+                    pending.append((path, pool.submit(make_dir, target, record), 0))
+                    # attributes of directories are set once their contents are extracted
+                    directories.append((member, target))
+
+                else:
+                    if member.islnk():
+                        link_path = member_path(member.linkname)
+                        if _under_symlink(link_path, symlinks):
+                            raise exc.ValidationFailed(f'unsafe hard link in archive: {member.name} -> '
+                                                       f'{member.linkname}')
+                    # the target of a hard link has to be written out completely, and a symbolic link may replace
+                    # a directory that queued files and directories are still being created under
+                    while pending:
+                        yield pop_oldest()
+                    target.parent.mkdir(parents=True, exist_ok=True)
+                    archive.extract(member, path=str(dest_dir), set_attrs=not member.issym(), **_EXTRACT_KWARGS)
+                    if member.issym():
+                        symlinks.add(path)
+                        pending.append((path, done({'path': path, 'type': utils.FileType.SYMBOLIC_LINK.value}), 0))
+                    elif member.islnk():
+                        record = {'path': path, 'type': utils.FileType.FILE.value, 'size': target.stat().st_size}
+                        if algorithms:
+                            record.update(utils.file_digests(target, algorithms, block_size=block_size))
+                        pending.append((path, done(record), 0))
+
+                while pending and pending[0][1].done():
+                    yield pop_oldest()
+
+            while pending:
+                yield pop_oldest()
+
+            # deepest directories first, like tarfile.extractall
+            # directories are independent of each other once all files are written
+            for future in [pool.submit(set_attrs, archive, member, target) for member, target in reversed(directories)]:
+                future.result()
+        finally:
+            for _, future, _ in pending:
+                future.cancel()
+
+
+def _create_file(target: Path) -> int:
+    """
+    creates or truncates target for writing without following a symbolic link at target, returns the fd
+    """
+    flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_NOFOLLOW', 0)
+    try:
+        return os.open(target, flags, 0o600)
+    except FileNotFoundError:
+        # the archive does not list the parent directory before the file, or it is still being created
+        target.parent.mkdir(parents=True, exist_ok=True)
+        return os.open(target, flags, 0o600)
+    except OSError:
+        # a member with the same name was extracted earlier as a symbolic link - replace it instead of following it
+        target.unlink()
+        return os.open(target, flags, 0o600)
+
+
+def _write_file(archive: tarfile.TarFile,
+                member: tarfile.TarInfo,
+                target: Path,
+                algorithms: list[str],
+                buffer: memoryview) -> dict:
+    """
+    copies the member's data to target, hashing it on the way. returns size and digests.
+    """
+    hashers = [(algorithm, hashlib.new(algorithm)) for algorithm in algorithms]
+    size = 0
+    with archive.extractfile(member) as src, open(_create_file(target), 'wb') as dst:
+        while True:
+            n = src.readinto(buffer)
+            if not n:
+                break
+            chunk = buffer[:n]
+            for _, m in hashers:
+                m.update(chunk)
+            dst.write(chunk)
+            size += n
+    return {'size': size} | {algorithm: m.hexdigest() for algorithm, m in hashers}
+
+
+def read_manifest(manifest_path: Path) -> Iterator[dict]:
+    with open(manifest_path) as f:
+        for line in f:
+            yield json.loads(line)
+
+
+class HashingReader:
+    """
+    Wraps a binary file object and computes the digest of the bytes read through it.
+    Used to verify the checksum of a bundle while it is streamed into extract_tar.
+
+    With algorithm None, nothing is hashed and the reader only counts the bytes read (and reports them to progress).
+    """
+
+    def __init__(self, fileobj: BinaryIO, algorithm: str | None = 'md5', progress: Progress = None):
+        self.fileobj = fileobj
+        self.hasher = hashlib.new(algorithm) if algorithm is not None else None
+        self.bytes_read = 0
+        self.progress = progress
+
+    def read(self, size: int = -1) -> bytes:
+        data = self.fileobj.read(size)
+        if self.hasher is not None:
+            self.hasher.update(data)
+        self.bytes_read += len(data)
+        if self.progress is not None:
+            self.progress.update(self.bytes_read)
+        return data
+
+    def drain(self, block_size: int = BLOCK_SIZE) -> None:
+        """
+        reads the rest of the stream, e.g. the zero padding after the end of a tar archive
+        """
+        while self.read(block_size):
+            pass
+
+    def hexdigest(self) -> str:
+        return self.hasher.hexdigest()
+
+
+class SpanReader:
+    """
+    Reads only the given byte ranges of a file object, as if they were one contiguous stream.
+
+    Used to extract a few members of a tar: the concatenation of the members' spans (see bundle.build_index)
+    is a valid tar stream. Seekable file objects are seeked to the start of each span; from streams, the bytes
+    between the spans are read and discarded, and nothing is read after the end of the last span.
+    """
+
+    def __init__(self, fileobj: BinaryIO, spans: Iterable[tuple[int, int]], progress: Progress = None):
+        self.fileobj = fileobj
+        self.spans = deque(merge_spans(spans))
+        self.seekable = fileobj.seekable() if hasattr(fileobj, 'seekable') else False
+        self.position = 0
+        self.bytes_read = 0
+        self.progress = progress
+
+    def _skip_to(self, offset: int) -> None:
+        if self.seekable:
+            self.fileobj.seek(offset)
+            self.position = offset
+            return
+        while self.position < offset:
+            data = self.fileobj.read(min(BLOCK_SIZE, offset - self.position))
+            if not data:
+                raise EOFError(f'stream ended at offset {self.position} before offset {offset}')
+            self.position += len(data)
+
+    def read(self, size: int = -1) -> bytes:
+        while self.spans and self.position >= self.spans[0][1]:
+            self.spans.popleft()
+        if not self.spans:
+            return b''
+        start, end = self.spans[0]
+        if self.position < start:
+            self._skip_to(start)
+        remaining = end - self.position
+        data = self.fileobj.read(remaining if size < 0 else min(size, remaining))
+        if not data:
+            raise EOFError(f'stream ended at offset {self.position} before offset {end}')
+        self.position += len(data)
+        self.bytes_read += len(data)
+        if self.progress is not None:
+            self.progress.update(self.bytes_read)
+        return data
+
+
+def merge_spans(spans: Iterable[tuple[int, int]]) -> list[tuple[int, int]]:
+    """
+    sorts (start, end) byte ranges and merges the ones that overlap or touch
+    """
+    merged = []
+    for start, end in sorted(spans):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
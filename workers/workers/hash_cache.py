@@ -0,0 +1,198 @@
+"""
+Persistent cache of file digests
+
+Digests are keyed on (device, inode, size, mtime_ns, ctime_ns, algorithm). Any write to a file changes its mtime
+and ctime, and replacing a file changes its inode, so a cached digest is only returned for the exact bytes it was
+computed from.
+
+The cache is a SQLite database in WAL mode shared by all worker processes on the host; it has to be on a host-local
+filesystem. Entries are evicted in least recently used order once the number of entries exceeds
+config['hash_cache']['max_entries']. The last use of the entries that are read is written back in batches (see
+touch), so that reading the digests of many files does not write to the database for each of them.
+
+The cache is best effort: if the database cannot be opened or written, digests are computed as if there was no
+cache.
+"""
+from __future__ import annotations
+
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections.abc import Iterable
+from pathlib import Path
+
+from workers.config import config
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS digests (
+    dev INTEGER NOT NULL,
+    ino INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    ctime_ns INTEGER NOT NULL,
+    algorithm TEXT NOT NULL,
+    digest TEXT NOT NULL,
+    last_used REAL NOT NULL,
+    PRIMARY KEY (dev, ino, size, mtime_ns, ctime_ns, algorithm)
+);
+CREATE INDEX IF NOT EXISTS digests_last_used ON digests (last_used);
+"""
+
+# evict down to this fraction of max_entries so that eviction does not run on every insert
+EVICTION_LOW_WATER_MARK = 0.9
+# counting the rows is a full index scan - check the size of the cache once every these many inserts
+EVICTION_CHECK_INTERVAL = 1000
+# number of cache hits whose last use is written back in one transaction
+TOUCH_BATCH_SIZE = 1000
+
+_local = threading.local()
+
+
+def stat_key(st: os.stat_result) -> tuple[int, int, int, int, int]:
+    return st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns
+
+
+def _connect() -> sqlite3.Connection | None:
+    """
+    returns a connection to the cache database that is private to the calling thread
+    or None if the cache is disabled or unavailable
+    """
+    if not config['hash_cache']['enabled']:
+        return None
+    pid = os.getpid()
+    # celery forks worker processes - sqlite connections must not be shared across a fork
+    if getattr(_local, 'pid', None) != pid:
+        _local.pid = pid
+        _local.conn = None
+        _local.failed = False
+        _local.num_puts = 0
+        _local.touched = {}
+    if _local.conn is None and not _local.failed:
+        db_path = Path(config['paths']['hash_cache'])
+        try:
+            db_path.parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(str(db_path), timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.executescript(SCHEMA)
+            _local.conn = conn
+        except (sqlite3.Error, OSError) as e:
+            logger.warning('hash cache at %s is unavailable: %s', db_path, e)
+            _local.failed = True
+    return _local.conn
+
+
+def get(st: os.stat_result, algorithm: str = 'md5') -> str | None:
+    """
+    returns the cached digest of the file described by st or None
+    """
+    conn = _connect()
+    if conn is None:
+        return None
+    key = stat_key(st) + (algorithm,)
+    try:
+        row = conn.execute('SELECT digest FROM digests '
+                           'WHERE dev=? AND ino=? AND size=? AND mtime_ns=? AND ctime_ns=? AND algorithm=?',
+                           key).fetchone()
+        if row is None:
+            return None
+        touch(conn, key)
+        return row[0]
+    except sqlite3.Error as e:
+        logger.warning('unable to read from hash cache: %s', e)
+        return None
+
+
+def touch(conn: sqlite3.Connection, key: tuple) -> None:
+    """
+    records the use of the entry with key, written to the database with the next TOUCH_BATCH_SIZE - 1 uses or
+    before the cache is evicted. Uses that are not written when the process exits are lost, which only makes their
+    entries look older than they are.
+    """
+    _local.touched[key] = time.time()
+    if len(_local.touched) >= TOUCH_BATCH_SIZE:
+        flush_touched(conn)
+
+
+def flush_touched(conn: sqlite3.Connection) -> None:
+    """
+    writes the last use of the entries recorded by touch in one transaction
+    """
+    touched, _local.touched = _local.touched, {}
+    if not touched:
+        return
+    conn.execute('BEGIN')
+    try:
+        conn.executemany('UPDATE digests SET last_used=? '
+                         'WHERE dev=? AND ino=? AND size=? AND mtime_ns=? AND ctime_ns=? AND algorithm=?',
+                         [(last_used,) + key for key, last_used in touched.items()])
+        conn.execute('COMMIT')
+    except sqlite3.Error:
+        conn.execute('ROLLBACK')
+        raise
+
+
+def put(st: os.stat_result, digest: str, algorithm: str = 'md5') -> None:
+    """
+    stores the digest of the file described by st
+    """
+    conn = _connect()
+    if conn is None:
+        return
+    try:
+        conn.execute('INSERT OR REPLACE INTO digests '
+                     '(dev, ino, size, mtime_ns, ctime_ns, algorithm, digest, last_used) '
+                     'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                     stat_key(st) + (algorithm, digest, time.time()))
+        _local.num_puts += 1
+        if _local.num_puts % EVICTION_CHECK_INTERVAL == 0:
+            evict(conn)
+    except sqlite3.Error as e:
+        logger.warning('unable to write to hash cache: %s', e)
+
+
+def evict(conn: sqlite3.Connection) -> None:
+    """
+    deletes the least recently used entries when the cache has grown beyond max_entries
+    """
+    max_entries = config['hash_cache']['max_entries']
+    flush_touched(conn)
+    count = conn.execute('SELECT COUNT(*) FROM digests').fetchone()[0]
+    if count > max_entries:
+        num_evict = count - int(max_entries * EVICTION_LOW_WATER_MARK)
+        conn.execute('DELETE FROM digests WHERE rowid IN '
+                     '(SELECT rowid FROM digests ORDER BY last_used LIMIT ?)',
+                     (num_evict,))
+        logger.info(f'evicted {num_evict} entries from hash cache')
+
+
+def cached_digests(fname: Path | str, algorithms: Iterable[str], compute) -> dict[str, str]:
+    """
+    returns the digests of fname for each of the algorithms from the cache if the file has not changed since they
+    were cached. The missing ones are computed with compute(fname, missing_algorithms), in a single read of the file,
+    and cached.
+
+    The file is stat-ed again after computing the digests and the result is cached only if the file was not modified
+    while it was being read.
+    """
+    st = os.stat(fname)
+    found = {}
+    missing = []
+    for algorithm in algorithms:
+        digest = get(st, algorithm)
+        if digest is not None:
+            found[algorithm] = digest
+        else:
+            missing.append(algorithm)
+    if not missing:
+        return found
+
+    computed = compute(fname, missing)
+    if stat_key(os.stat(fname)) == stat_key(st):
+        for algorithm, digest in computed.items():
+            put(st, digest, algorithm)
+    return found | computed
@@ -0,0 +1,228 @@
+"""
+Long-lived hsi sessions for SDA metadata commands
+
+Every hsi process authenticates to HPSS before it runs its command, which costs more than the metadata commands
+themselves (ls, hashlist, mkdir, rm). A Session keeps one interactive hsi process (config['sda']['hsi_command']
+without a command) and drives it over stdin/stdout. Each command is followed by a shell escape that echoes a unique
+marker, so the output of the command is the text up to the marker. hsi reports errors on lines that match
+config['sda']['session']['error_pattern'] instead of an exit status; a command whose output has such a line
+fails with cmd.SubprocessError, like a failed hsi process. Many commands can be sent at once as one script
+(see Session.run_many); their outputs are told apart by their markers.
+
+A Pool hands out up to pool_size sessions to threads. Sessions that died, timed out or were idle for longer than
+idle_seconds are replaced by new ones, and a command that was interrupted by the death of its session is run once
+more on a new session. Pools are per process (see get_pool), so forked workers do not share hsi processes.
+
+Transfers (sda.put, sda.get and the streams) still run one hsi process each.
+"""
+from __future__ import annotations
+
+import atexit
+import logging
+import os
+import queue
+import re
+import subprocess
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Iterator
+
+import workers.cmd as cmd
+from workers.config import config
+
+logger = logging.getLogger(__name__)
+
+
+class SessionError(Exception):
+    """
+    the hsi session died or did not answer in time - the command may or may not have run
+    """
+    pass
+
+
+class Session:
+    def __init__(self, timeout: float = None):
+        session_config = config['sda']['session']
+        self.args = list(config['sda']['hsi_command'])
+        self.timeout = timeout or session_config['timeout_seconds']
+        self.error_pattern = re.compile(session_config['error_pattern'], re.MULTILINE)
+        self.lines = queue.Queue()
+        self.process = subprocess.Popen(self.args,
+                                        stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE,
+                                        stderr=subprocess.STDOUT,
+                                        text=True,
+                                        bufsize=1)
+        # stdout is read by a thread, so that a command that hangs can be timed out
+        self.reader = threading.Thread(target=self._read_lines, daemon=True)
+        self.reader.start()
+        self.last_used = time.monotonic()
+        logger.debug(f'started hsi session pid {self.process.pid}')
+
+    def _read_lines(self):
+        for line in self.process.stdout:
+            self.lines.put(line)
+        self.lines.put(None)  # EOF
+
+    def is_alive(self) -> bool:
+        return self.process.poll() is None
+
+    def run(self, command: str) -> str:
+        """
+        runs the hsi command in the session and returns its output
+
+        raises cmd.SubprocessError if hsi reported an error and SessionError if the session died or timed out
+        (the session is closed then)
+        """
+        result = self.run_many([command])[0]
+        if isinstance(result, cmd.SubprocessError):
+            raise result
+        return result
+
+    def run_many(self, commands: list[str]) -> list[str | cmd.SubprocessError]:
+        """
+        sends the hsi commands to the session as one script and returns, for each command in order, its output or
+        the cmd.SubprocessError it failed with
+
+        The timeout applies to each command. Raises SessionError as run does.
+        """
+        markers = [f'__hsi_session_{uuid.uuid4().hex}__' for _ in commands]
+        script = ''.join(f'{command}\n! echo {marker}\n' for command, marker in zip(commands, markers))
+        try:
+            self.process.stdin.write(script)
+            self.process.stdin.flush()
+        except (BrokenPipeError, OSError) as e:
+            self.close()
+            raise SessionError(f'hsi session pid {self.process.pid} is gone: {e}') from e
+
+        results = []
+        for command, marker in zip(commands, markers):
+            stdout = self._read_until(marker, command)
+            if self.error_pattern.search(stdout):
+                results.append(cmd.SubprocessError({
+                    'return_code': None,
+                    'stdout': stdout,
+                    'stderr': None,
+                    'args': [*self.args, command]
+                }))
+            else:
+                results.append(stdout)
+        self.last_used = time.monotonic()
+        return results
+
+    def _read_until(self, marker: str, command: str) -> str:
+        output = []
+        deadline = time.monotonic() + self.timeout
+        while True:
+            try:
+                line = self.lines.get(timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                self.close()
+                raise SessionError(f'hsi command {command!r} did not finish in {self.timeout} seconds')
+            if line is None:
+                self.close()
+                raise SessionError(f'hsi session pid {self.process.pid} exited while running {command!r}')
+            if line.strip() == marker:
+                return ''.join(output)
+            output.append(line)
+
+    def close(self):
+        if self.is_alive():
+            try:
+                self.process.stdin.write('quit\n')
+                self.process.stdin.close()
+                self.process.wait(timeout=5)
+            except (OSError, subprocess.TimeoutExpired):
+                self.process.kill()
+                self.process.wait()
+
+
+class Pool:
+    def __init__(self, size: int = None, idle_seconds: float = None):
+        session_config = config['sda']['session']
+        self.size = size or session_config['pool_size']
+        self.idle_seconds = idle_seconds or session_config['idle_seconds']
+        self.idle = queue.LifoQueue()
+        # bounds the number of sessions that are open at once
+        self.slots = threading.BoundedSemaphore(self.size)
+
+    def _acquire(self) -> Session:
+        while True:
+            try:
+                session = self.idle.get_nowait()
+            except queue.Empty:
+                return Session()
+            if session.is_alive() and time.monotonic() - session.last_used < self.idle_seconds:
+                return session
+            # HPSS may have dropped the connection of a session that was idle for long
+            session.close()
+
+    @contextmanager
+    def session(self) -> Iterator[Session]:
+        with self.slots:
+            session = self._acquire()
+            try:
+                yield session
+            finally:
+                if session.is_alive():
+                    self.idle.put(session)
+
+    def run(self, command: str) -> str:
+        """
+        runs the hsi command in a session of the pool, see Session.run
+
+        if the session dies while the command runs, the command is run once more on a new session
+        """
+        try:
+            with self.session() as session:
+                return session.run(command)
+        except SessionError as e:
+            logger.warning(f'{e}, retrying on a new hsi session')
+            with self.session() as session:
+                return session.run(command)
+
+    def run_many(self, commands: list[str]) -> list[str | cmd.SubprocessError]:
+        """
+        runs the hsi commands as one script in a session of the pool, see Session.run_many
+
+        if the session dies while the script runs, the script is run once more on a new session
+        """
+        try:
+            with self.session() as session:
+                return session.run_many(commands)
+        except SessionError as e:
+            logger.warning(f'{e}, retrying on a new hsi session')
+            with self.session() as session:
+                return session.run_many(commands)
+
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+_pool: Pool | None = None
+_pool_pid: int | None = None
+_pool_lock = threading.Lock()
+
+
+def get_pool() -> Pool:
+    """
+    returns the pool of the current process, a forked process gets a pool of its own
+    """
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = Pool()
+            _pool_pid = os.getpid()
+        return _pool
+
+
+@atexit.register
+def _close_pool():
+    if _pool is not None and _pool_pid == os.getpid():
+        _pool.close()
@@ -0,0 +1,97 @@
+"""
+Local observation of the I/O of a running process through /proc
+
+Used to report the progress of an hsi transfer without asking SDA for the size of the file being written
+(see workflow_utils.upload_file_to_sda): the file offset of the local file in the hsi process is the number of bytes
+it has read from (put) or written to (get) that file. hsi may hand the transfer to child processes, so they are
+looked at too. Where /proc is not available, the functions return None.
+"""
+from __future__ import annotations
+
+import os
+from pathlib import Path
+
+
+def descendants(pid: int) -> list[int]:
+    """
+    returns pid and the pids of its descendants that are found through /proc/<pid>/task/<tid>/children
+    """
+    pids = [pid]
+    i = 0
+    while i < len(pids):
+        try:
+            tasks = os.listdir(f'/proc/{pids[i]}/task')
+        except OSError:
+            tasks = []
+        for tid in tasks:
+            try:
+                children = Path(f'/proc/{pids[i]}/task/{tid}/children').read_text().split()
+            except OSError:
+                continue
+            pids.extend(int(child) for child in children if int(child) not in pids)
+        i += 1
+    return pids
+
+
+def file_position(pid: int, path: Path | str) -> int | None:
+    """
+    returns the largest offset at which pid or its descendants have path open, None if none of them has it open
+    """
+    target = os.path.realpath(path)
+    position = None
+    for p in descendants(pid):
+        try:
+            fds = os.listdir(f'/proc/{p}/fd')
+        except OSError:
+            continue
+        for fd in fds:
+            try:
+                if os.readlink(f'/proc/{p}/fd/{fd}') != target:
+                    continue
+                with open(f'/proc/{p}/fdinfo/{fd}') as fdinfo:
+                    for line in fdinfo:
+                        if line.startswith('pos:'):
+                            position = max(position or 0, int(line.split()[1]))
+                            break
+            except OSError:
+                # the file was closed since the directory was listed
+                continue
+    return position
+
+
+def io_counters(pid: int) -> dict[str, int] | None:
+    """
+    returns the I/O counters of /proc/<pid>/io (rchar, wchar, read_bytes, ...) summed over pid and its descendants
+    """
+    counters = None
+    for p in descendants(pid):
+        try:
+            with open(f'/proc/{p}/io') as f:
+                lines = f.readlines()
+        except OSError:
+            continue
+        counters = counters or {}
+        for line in lines:
+            key, value = line.split(':')
+            counters[key] = counters.get(key, 0) + int(value)
+    return counters
+
+
+def bytes_transferred(pid: int, local_file: Path | str, direction: str) -> int | None:
+    """
+    returns the number of bytes of local_file the transfer process pid has read (direction 'read') or written
+    (direction 'write'), None if it can not be observed
+
+    The offset of local_file in the process is used while it is open. Before it is opened and after it is closed,
+    the process' rchar counter (read) or the size of local_file (write) is used instead.
+    """
+    position = file_position(pid, local_file)
+    if position is not None:
+        return position
+    if direction == 'write':
+        try:
+            return os.stat(local_file).st_size
+        except FileNotFoundError:
+            return None
+    counters = io_counters(pid)
+    return counters.get('rchar') if counters else None
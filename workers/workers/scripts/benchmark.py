@@ -0,0 +1,268 @@
+"""
+Benchmarks the data path of the inspect, archive, stage and validate steps on synthetic datasets
+
+For each dataset profile, a dataset is created under work_dir (see create_dummy_dataset.create_dummy_tree)
+and the following steps are timed:
+    inspect: tasks.inspect.generate_metadata
+    archive: tasks.archive.make_tarfile and the checksum of the tar
+    stage: tasks.stage.extract_tarfile_with_manifest (tasks.stage.extract_tarfile if config['stage']['manifest'] is off)
+    validate: tasks.validate.check_files, which reads every staged file
+    validate manifest: tasks.validate.check_manifest, if config['stage']['manifest'] is on - it compares the stage
+                       manifest with the inspected digests and reads no file data
+
+None of these steps talk to the SDA, so no hsi is needed. The results are written as JSON
+(one record per profile and step, with MB/s and files/s) to be compared across releases.
+
+With --sda_root, the transfers of the tar to and from SDA are timed too, against the SDA emulator
+(see workers.sda_emulator) at the given bandwidth and latency:
+    sda put, sda get: workflow_utils.upload_file_to_sda / download_file_from_sda, one hsi transfer
+    sda put xN, sda get xN: sda_parallel.put / get with N concurrent transfers, for each N in sda_streams
+
+The hash cache is disabled while benchmarking unless use_hash_cache is set,
+otherwise the checksums of the inspect step would be served from the cache on the next run.
+The datasets are read right after they are written, so the numbers include the effects of the page cache.
+
+Usage:
+    python -m workers.scripts.benchmark WORK_DIR [--profiles=small_files,large_files,deep_tree] [--scale=1.0]
+                                                 [--output=results.json] [--keep] [--use_hash_cache]
+                                                 [--sda_root=DIR] [--sda_streams=1,4,8] [--sda_segment_mb=64]
+                                                 [--sda_stream_bandwidth=MBPS] [--sda_total_bandwidth=MBPS]
+                                                 [--sda_latency=S]
+"""
+from __future__ import annotations
+
+import json
+import platform
+import shutil
+import socket
+import time
+from datetime import datetime
+from pathlib import Path
+
+import fire
+
+import workers.sda as sda
+import workers.sda_emulator as sda_emulator
+import workers.sda_parallel as sda_parallel
+import workers.tasks.archive as archive
+import workers.tasks.inspect as inspect
+import workers.tasks.stage as stage
+import workers.tasks.validate as validate
+import workers.utils as utils
+import workers.workflow_utils as wf_utils
+from workers.config import config
+from workers.dataset import get_stage_manifest_path
+from workers.scripts.create_dummy_dataset import create_dummy_tree
+
+# keyword arguments of create_dummy_tree, num_files or file_size_mb are multiplied by scale
+PROFILES = {
+    'small_files': {'num_files': 20000, 'file_size_mb': 0.01, 'depth': 2, 'fanout': 10},
+    'large_files': {'num_files': 4, 'file_size_mb': 512, 'depth': 0, 'fanout': 1},
+    'deep_tree': {'num_files': 2000, 'file_size_mb': 0.1, 'depth': 40, 'fanout': 1},
+}
+
+
+def scaled(profile: dict, scale: float) -> dict:
+    """
+    profiles with many files are scaled by the number of files, the others by the size of the files
+    """
+    profile = dict(profile)
+    if profile['num_files'] >= 100:
+        profile['num_files'] = max(1, int(profile['num_files'] * scale))
+    else:
+        profile['file_size_mb'] = profile['file_size_mb'] * scale
+    return profile
+
+
+def result(profile: str, step: str, seconds: float, num_bytes: int, num_files: int) -> dict:
+    mb = num_bytes / (1024 * 1024)
+    return {
+        'profile': profile,
+        'step': step,
+        'seconds': round(seconds, 3),
+        'bytes': num_bytes,
+        'files': num_files,
+        'mb_per_s': round(mb / seconds, 2) if seconds > 0 else None,
+        'files_per_s': round(num_files / seconds, 2) if seconds > 0 else None,
+    }
+
+
+def run_transfers(name: str, tar_path: Path, tar_checksum: str, streams: list[int], segment_size: int,
+                  num_files: int) -> list[dict]:
+    """
+    times the transfers of the tar to and from SDA, config['sda']['hsi_command'] has to point at the emulator
+    """
+    results = []
+    tar_size = tar_path.stat().st_size
+    sda.ensure_directory(name)
+    sda_path = f'{name}/{tar_path.name}'
+    download_path = tar_path.with_name(f'{tar_path.name}.downloaded')
+
+    start = time.perf_counter()
+    wf_utils.upload_file_to_sda(local_file_path=tar_path, sda_file_path=sda_path, preflight_check=False)
+    results.append(result(name, 'sda put', time.perf_counter() - start, tar_size, num_files))
+
+    start = time.perf_counter()
+    wf_utils.download_file_from_sda(sda_file_path=sda_path, local_file_path=download_path)
+    results.append(result(name, 'sda get', time.perf_counter() - start, tar_size, num_files))
+    sda.delete(sda_path)
+
+    for n in streams:
+        start = time.perf_counter()
+        sda_parallel.put(local_file=tar_path, sda_file=sda_path, md5=tar_checksum, segment_size=segment_size,
+                         max_workers=n)
+        results.append(result(name, f'sda put x{n}', time.perf_counter() - start, tar_size, num_files))
+
+        start = time.perf_counter()
+        sda_parallel.get(sda_file=sda_path, local_file=download_path, max_workers=n)
+        results.append(result(name, f'sda get x{n}', time.perf_counter() - start, tar_size, num_files))
+        sda_parallel.delete(sda_path)
+
+    download_path.unlink(missing_ok=True)
+    return results
+
+
+def run_profile(name: str, profile: dict, work_dir: Path, sda_streams: list[int] = None,
+                sda_segment_size: int = None) -> list[dict]:
+    profile_dir = work_dir / name
+    if profile_dir.exists():
+        shutil.rmtree(profile_dir)
+    source = profile_dir / 'source'
+    tar_path = profile_dir / f'{name}.tar'
+    staged = profile_dir / 'staged' / name
+    manifest_path = get_stage_manifest_path(staged)
+    create_dummy_tree(str(source), **profile)
+
+    results = []
+
+    summary = {}
+    start = time.perf_counter()
+    files_metadata = list(inspect.generate_metadata(None, source, summary))
+    elapsed = time.perf_counter() - start
+    results.append(result(name, 'inspect', elapsed, summary['size'], summary['num_files']))
+
+    start = time.perf_counter()
+    tar_checksum = archive.make_tarfile(celery_task=None,
+                                        tar_path=tar_path,
+                                        source_dir=str(source),
+                                        source_size=summary['du_size'],
+                                        compute_checksum=config['archive']['stream_checksum'])
+    if tar_checksum is None:
+        tar_checksum = utils.checksum(tar_path)
+    elapsed = time.perf_counter() - start
+    tar_size = tar_path.stat().st_size
+    results.append(result(name, 'archive', elapsed, tar_size, summary['num_files']))
+
+    if sda_streams is not None:
+        results.extend(run_transfers(name, tar_path, tar_checksum, sda_streams, sda_segment_size,
+                                     summary['num_files']))
+
+    start = time.perf_counter()
+    if config['stage']['manifest']:
+        stage.extract_tarfile_with_manifest(source=tar_path, target_dir=staged, manifest_path=manifest_path,
+                                            override_arcname=True)
+    else:
+        stage.extract_tarfile(tar_path=tar_path, target_dir=staged, override_arcname=True)
+    elapsed = time.perf_counter() - start
+    results.append(result(name, 'stage', elapsed, tar_size, summary['num_files']))
+
+    start = time.perf_counter()
+    validation_errors = validate.check_files(celery_task=None, dataset_dir=staged, files_metadata=files_metadata)
+    elapsed = time.perf_counter() - start
+    if validation_errors:
+        raise Exception(f'{len(validation_errors)} validation errors in benchmark profile {name}')
+    results.append(result(name, 'validate', elapsed, summary['size'], summary['num_files']))
+
+    if config['stage']['manifest']:
+        start = time.perf_counter()
+        validation_errors = validate.check_manifest(celery_task=None, dataset_dir=staged, manifest_path=manifest_path,
+                                                    files_metadata=files_metadata)
+        elapsed = time.perf_counter() - start
+        if validation_errors:
+            raise Exception(f'{len(validation_errors)} manifest validation errors in benchmark profile {name}')
+        results.append(result(name, 'validate manifest', elapsed, summary['size'], summary['num_files']))
+
+    return results
+
+
+def main(work_dir: str,
+         profiles: str | tuple = tuple(PROFILES.keys()),
+         scale: float = 1.0,
+         output: str = None,
+         keep: bool = False,
+         use_hash_cache: bool = False,
+         sda_root: str = None,
+         sda_streams: str | int | tuple = (1, 4, 8),
+         sda_segment_mb: float = 64,
+         sda_stream_bandwidth: float = None,
+         sda_total_bandwidth: float = None,
+         sda_latency: float = 0):
+    """
+    @param work_dir: directory to create the datasets, tar files and staged copies in
+    @param profiles: names of the dataset profiles to run (comma separated), see PROFILES
+    @param scale: multiplier of the number of files (or the size of the files) of each profile
+    @param output: path of the JSON file to write the results to. The results are always printed.
+    @param keep: do not delete the datasets after the benchmark
+    @param use_hash_cache: keep the hash cache enabled
+    @param sda_root: directory of the SDA emulator, also time the transfers of the tar to and from SDA if provided
+    @param sda_streams: numbers of concurrent transfers (comma separated) to time the segmented transfers with
+    @param sda_segment_mb: size of the segments of the segmented transfers
+    @param sda_stream_bandwidth: MB/s of a single emulated transfer, unlimited if not provided
+    @param sda_total_bandwidth: MB/s shared by the emulated transfers running at once, unlimited if not provided
+    @param sda_latency: seconds spent by the emulator on every hsi command
+    """
+    if isinstance(profiles, str):
+        profiles = profiles.split(',')
+    unknown = [p for p in profiles if p not in PROFILES]
+    if unknown:
+        raise ValueError(f'unknown profiles: {unknown}, available profiles: {list(PROFILES.keys())}')
+
+    config['hash_cache']['enabled'] = use_hash_cache
+    work_dir = Path(work_dir).resolve()
+    work_dir.mkdir(parents=True, exist_ok=True)
+
+    emulator_settings = None
+    streams = None
+    if sda_root is not None:
+        emulator_settings = sda_emulator.Settings(latency=sda_latency,
+                                                  stream_bandwidth=sda_stream_bandwidth,
+                                                  total_bandwidth=sda_total_bandwidth)
+        Path(sda_root).mkdir(parents=True, exist_ok=True)
+        config['sda']['hsi_command'] = sda_emulator.hsi_command(Path(sda_root).resolve(), emulator_settings)
+        if isinstance(sda_streams, int):
+            sda_streams = (sda_streams,)
+        streams = [int(n) for n in (sda_streams.split(',') if isinstance(sda_streams, str) else sda_streams)]
+
+    results = []
+    for name in profiles:
+        profile = scaled(PROFILES[name], scale)
+        results.extend(run_profile(name, profile, work_dir, sda_streams=streams,
+                                   sda_segment_size=int(sda_segment_mb * 1024 * 1024)))
+        if not keep:
+            shutil.rmtree(work_dir / name)
+
+    report = {
+        'timestamp': datetime.now().isoformat(),
+        'host': socket.getfqdn(),
+        'python': platform.python_version(),
+        'scale': scale,
+        'config': {
+            'digest': config['digest'],
+            'inspect': config['inspect'],
+            'archive': config['archive'],
+            'stage': {'manifest': config['stage']['manifest']},
+            'validate': config['validate'],
+            'hash_cache': config['hash_cache'],
+            'sda_emulator': vars(emulator_settings) if emulator_settings is not None else None,
+        },
+        'profiles': {name: scaled(PROFILES[name], scale) for name in profiles},
+        'results': results,
+    }
+    report_json = json.dumps(report, indent=2)
+    print(report_json)
+    if output is not None:
+        Path(output).write_text(report_json)
+
+
+if __name__ == '__main__':
+    fire.Fire(main)
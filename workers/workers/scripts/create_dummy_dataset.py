@@ -5,8 +5,14 @@ import fire
 
 
 def create_dummy_file(path, size_mb):
+    # size_mb can be fractional to create files smaller than 1MB
+    size = int(size_mb * 1024 * 1024)
     with open(path, 'wb') as f:
-        f.write(os.urandom(size_mb * 1024 * 1024))
+        # write in 64MB chunks to keep the memory use bounded for huge files
+        while size > 0:
+            chunk_size = min(size, 64 * 1024 * 1024)
+            f.write(os.urandom(chunk_size))
+            size -= chunk_size
 
 
 def random_string(length):
@@ -65,6 +71,31 @@ def create_dummy_directory(dir_path: str, subdirs: int = 3, size_gb: float = 1):
     print(f"Finished creating dummy directory at {dir_path}")
 
 
+def create_dummy_tree(dir_path: str, num_files: int, file_size_mb: float, depth: int = 0, fanout: int = 1):
+    """
+    Creates a directory tree that is depth levels deep, where each directory has fanout sub-directories,
+    and spreads num_files files of file_size_mb each across all the directories of the tree.
+
+    Examples:
+        many small files: num_files=100000, file_size_mb=0.01, depth=2, fanout=10
+        a few huge files: num_files=4, file_size_mb=10240
+        a deep tree: num_files=1000, file_size_mb=0.1, depth=30, fanout=1
+    """
+    dirs = [dir_path]
+    level = [dir_path]
+    for d in range(depth):
+        level = [os.path.join(parent, f"level_{d + 1}_{i + 1}") for parent in level for i in range(fanout)]
+        dirs.extend(level)
+    for d in dirs:
+        os.makedirs(d, exist_ok=True)
+
+    for i in range(num_files):
+        file_path = os.path.join(dirs[i % len(dirs)], f"file_{i + 1}.bin")
+        create_dummy_file(file_path, file_size_mb)
+
+    print(f"Created {num_files} files of {file_size_mb}MB in {len(dirs)} directories at {dir_path}")
+
+
 """
     Creates a dummy directory with the specified number of subdirectories,
     each containing the specified amount of data.
@@ -0,0 +1,90 @@
+"""
+A stand-in for hsi that keeps the SDA in a local directory (see workers.sda_emulator)
+
+Implements the hsi commands the workers use (see workers.sda), with SDA paths resolved under ROOT:
+    put [-c on] LOCAL : SDA     LOCAL is - to read the file from stdin
+    get [-c on] LOCAL : SDA     LOCAL is - to write the file to stdout
+    ls [-s1] SDA
+    hashlist SDA                prints the md5 recorded by put -c on, (none) if there is none
+    mkdir -p SDA
+    rm SDA
+
+Without COMMAND, commands are read from stdin one per line, as by an interactive hsi session (see
+workers.hsi_session). There, '! SHELL_COMMAND' runs a shell command and 'quit' ends the session.
+Errors are reported on stderr on lines starting with ***.
+
+The options after --root set the bandwidth, latency and failures of the emulated archive (see
+sda_emulator.Settings). Point the workers at it with:
+    config['sda']['hsi_command'] = sda_emulator.hsi_command(ROOT, sda_emulator.Settings(...))
+
+Usage:
+    python -m workers.scripts.fake_hsi --root ROOT [--connect_latency=S] [--latency=S] [--stream_bandwidth=MBPS]
+                                       [--total_bandwidth=MBPS] [--error_rate=P] [--fail_pattern=REGEX] ['COMMAND']
+"""
+from __future__ import annotations
+
+import argparse
+import subprocess
+import sys
+from pathlib import Path
+
+from workers.sda_emulator import Backend, Settings
+
+
+def run(backend: Backend, command: str) -> bool:
+    """
+    runs the command, returns False if it failed
+    """
+    try:
+        backend.run(command, stdin=sys.stdin.buffer, stdout=sys.stdout.buffer)
+        return True
+    except Exception as e:
+        sys.stdout.flush()
+        print(f'*** fake_hsi: {command}: {e}', file=sys.stderr)
+        return False
+    finally:
+        sys.stdout.flush()
+
+
+def interactive(backend: Backend):
+    for line in iter(sys.stdin.readline, ''):
+        command = line.strip()
+        if not command:
+            continue
+        if command in ('quit', 'exit', 'bye'):
+            return
+        if command.startswith('!'):
+            subprocess.run(command[1:], shell=True, stdout=sys.stdout, stderr=sys.stderr)
+            continue
+        run(backend, command)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='hsi against a local directory')
+    parser.add_argument('--root', required=True, help='directory that holds the SDA files')
+    parser.add_argument('-P', action='store_true', help='accepted for compatibility with hsi, ignored')
+    parser.add_argument('--connect_latency', type=float, default=0, help='seconds spent when the process starts')
+    parser.add_argument('--latency', type=float, default=0, help='seconds spent on every command')
+    parser.add_argument('--stream_bandwidth', type=float, help='MB/s of a transfer')
+    parser.add_argument('--total_bandwidth', type=float, help='MB/s shared by the transfers running at once')
+    parser.add_argument('--error_rate', type=float, default=0, help='probability that a command fails')
+    parser.add_argument('--fail_pattern', help='regular expression, matching commands fail')
+    parser.add_argument('command', nargs='?', help='hsi command, e.g. "ls -s1 path", read from stdin if omitted')
+    args = parser.parse_args()
+
+    settings = Settings(connect_latency=args.connect_latency,
+                        latency=args.latency,
+                        stream_bandwidth=args.stream_bandwidth,
+                        total_bandwidth=args.total_bandwidth,
+                        error_rate=args.error_rate,
+                        fail_pattern=args.fail_pattern)
+    backend = Backend(Path(args.root), settings)
+    backend.connect()
+    if args.command is None:
+        interactive(backend)
+    elif not run(backend, args.command):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
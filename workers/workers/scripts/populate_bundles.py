@@ -25,10 +25,14 @@ class BundleSyncManager:
     def __init__(self, dry_run, app_id):
         self.dry_run = dry_run
         self.app_id = app_id
+        self.bundle_hashes = {}
 
 
     def populate_bundles(self):
         archived_datasets = api.get_all_datasets(archived=True, bundle=True)
+        # the hashes of the bundles are fetched from SDA in batches rather than with one hsi call per dataset
+        self.bundle_hashes = sda.get_hashes([dataset['archive_path'] for dataset in archived_datasets
+                                             if dataset['bundle'] is None], missing_ok=True)
 
         processed_datasets = []
         unprocessed_datasets = []
@@ -66,7 +70,10 @@ class BundleSyncManager:
     def populate_bundle_metadata(self, dataset: dict) -> bool:
         logger.info(f'populating dataset {dataset["id"]}')
 
-        bundle_md5 = sda.get_hash(dataset['archive_path'])
+        if self.bundle_hashes.get(dataset['archive_path']) is not None:
+            bundle_md5 = self.bundle_hashes[dataset['archive_path']]
+        else:
+            bundle_md5 = sda.get_hash(dataset['archive_path'])
         bundle_metadata = {
             'name': f'{dataset["name"]}.tar',
             'size': dataset['bundle_size'],
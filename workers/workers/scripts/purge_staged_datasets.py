@@ -1,10 +1,8 @@
 import logging
-import shutil
-from pathlib import Path
 
 import workers.api as api
+import workers.stage_cache as stage_cache
 from workers.config import config
-from workers.dataset import get_bundle_staged_path
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -21,29 +19,19 @@ def main():
             f"Number of staged datasets to purge is more than {MAX_PURGES} MAX_PURGES. "
             f"Only the first {MAX_PURGES} staged datasets will be purged")
 
-    update_data = {
-        'is_staged': False,
-        'staged_path': None
-    }
     for dataset in datasets[:MAX_PURGES]:
         try:
-            staged_path = Path(dataset['staged_path'])
-            bundle_path = Path(get_bundle_staged_path(dataset=dataset))
-
-            if staged_path.exists():
-                shutil.rmtree(staged_path)
-            if bundle_path.exists():
-                bundle_path.unlink()
-
-            api.update_dataset(dataset_id=dataset['id'], update_data=update_data)
-            api.add_state_to_dataset(dataset_id=dataset['id'], state='PURGED')
-
+            purged_size = stage_cache.purge(dataset)
             logger.info(
-                f'Purged staged dataset id:{dataset["id"]} name:{dataset["name"]} staged_path:{staged_path}')
+                f'Purged staged dataset id:{dataset["id"]} name:{dataset["name"]} staged_path:{dataset["staged_path"]} '
+                f'bytes freed:{purged_size}')
 
         except Exception as e:
             logger.error(f'Error purging staged dataset #{dataset["id"]} {dataset["name"]}', exc_info=e)
 
+    # then evict the least recently used datasets from the stage filesystems that are above the high water mark
+    stage_cache.enforce()
+
 
 if __name__ == "__main__":
     main()
@@ -3,13 +3,13 @@ from pathlib import Path
 import fire
 import shutil
 import os
-import hashlib
 from typing import List, Tuple, Dict
 import time
 import traceback
 
 from workers.scripts.register_ondemand import Registration
 import workers.api as api
+import workers.utils as utils
 
 
 # 60 seconds
@@ -34,15 +34,6 @@ def all_subdirs_processed(dir_path: Path, project_name: str) -> bool:
     return True
 
 
-def calculate_file_hash(filepath: str, block_size: int = 65536) -> str:
-    """Calculate the MD5 hash of a file."""
-    file_hash = hashlib.md5()
-    with open(filepath, "rb") as f:
-        for block in iter(lambda: f.read(block_size), b""):
-            file_hash.update(block)
-    return file_hash.hexdigest()
-
-
 def directories_are_equal(dir1: Path, dir2: Path) -> bool:
     """
     Compare two directories by calculating and comparing checksums of all files.
@@ -73,7 +64,7 @@ def directories_are_equal(dir1: Path, dir2: Path) -> bool:
                 return False
 
             # If file sizes are same, compare checksums
-            if calculate_file_hash(file1) != calculate_file_hash(file2):
+            if utils.checksum(file1) != utils.checksum(file2):
                 return False
 
     return True
@@ -1,14 +1,69 @@
 from __future__ import annotations
 
+from collections.abc import Callable
+
 import workers.cmd as cmd
+import workers.hsi_session as hsi_session
+from workers.config import config
+
+
+def hsi(command: str) -> list[str]:
+    """
+    returns the command line that runs an hsi command, e.g. hsi('ls -s1 path')
+
+    The hsi executable and its options are taken from config['sda']['hsi_command'], which allows pointing the workers
+    at a different hsi build or at a fake hsi that works on a local directory.
+    """
+    return [*config['sda']['hsi_command'], command]
+
+
+def run(command: str) -> str:
+    """
+    runs an hsi metadata command and returns its output
+
+    The command runs in a long-lived hsi session (see workers.hsi_session) if config['sda']['session']['enabled'],
+    else in an hsi process of its own. Either way, cmd.SubprocessError is raised if the command failed.
+    """
+    if config['sda']['session']['enabled']:
+        return hsi_session.get_pool().run(command)
+    stdout, stderr = cmd.execute(hsi(command))
+    return stdout
 
 
-def put(local_file: str, sda_file: str, verify_checksum: bool = True):
+def run_many(commands: list[str]) -> list[str | cmd.SubprocessError]:
+    """
+    runs hsi metadata commands as scripts of up to config['sda']['batch_size'] commands, and returns, for each command
+    in order, its output or the cmd.SubprocessError it failed with
+
+    The scripts run in the long-lived hsi sessions if they are enabled, else in an hsi session that is started for
+    this call (see workers.hsi_session).
+    """
+    batch_size = config['sda']['batch_size']
+    batches = [commands[i:i + batch_size] for i in range(0, len(commands), batch_size)]
+    results = []
+    if config['sda']['session']['enabled']:
+        for batch in batches:
+            results.extend(hsi_session.get_pool().run_many(batch))
+        return results
+    if batches:
+        session = hsi_session.Session()
+        try:
+            for batch in batches:
+                results.extend(session.run_many(batch))
+        finally:
+            session.close()
+    return results
+
+
+def put(local_file: str, sda_file: str, verify_checksum: bool = True, monitor: Callable[[int], None] = None):
     """
     Transfer a local file to SDA
 
     If sda_file exists, it will be overwritten
 
+    If monitor is provided, it is called with the pid of the hsi process periodically during the transfer
+    (see cmd.execute_monitored)
+
     The checksum algorithms that are used are very CPU-intensive.
     Although the checksum code is compiled with a high level of compiler optimization,
     transfer rates can be significantly reduced when checksum creation or verification is in effect.
@@ -17,22 +72,25 @@ def put(local_file: str, sda_file: str, verify_checksum: bool = True):
     """
     # -c flag enables checksum creation
     put_cmd = 'put -c on' if verify_checksum else 'put'
-    command = ['hsi', '-P', f'{put_cmd} {local_file} : {sda_file}']
+    command = hsi(f'{put_cmd} {local_file} : {sda_file}')
+    if monitor is not None:
+        return cmd.execute_monitored(command, monitor, interval=config['sda']['progress_interval_seconds'])
     return cmd.execute(command)
 
 
 def get_size(sda_path: str):
-    command = ['hsi', '-P', f'ls -s1 {sda_path}']
-    stdout, stderr = cmd.execute(command)
+    stdout = run(f'ls -s1 {sda_path}')
     return int(stdout.strip().split()[0])
 
 
-def get(sda_file: str, local_file: str, verify_checksum=True):
+def get(sda_file: str, local_file: str, verify_checksum=True, monitor: Callable[[int], None] = None):
     """
     Transfer a file from SDA to local disk.
 
     If the local_file exists, it will be overwritten.
 
+    monitor: see put
+
     Transfer speeds are around 56 MBps
 
     The checksum algorithms that are used are very CPU-intensive.
@@ -42,18 +100,43 @@ def get(sda_file: str, local_file: str, verify_checksum=True):
     network transfer speed, and speed of the local filesystem.
     """
     get_cmd = 'get -c on' if verify_checksum else 'get'
-    command = ['hsi', '-P', f'{get_cmd} {local_file} : {sda_file}']
+    command = hsi(f'{get_cmd} {local_file} : {sda_file}')
+    if monitor is not None:
+        return cmd.execute_monitored(command, monitor, interval=config['sda']['progress_interval_seconds'])
     return cmd.execute(command)
 
 
+def get_stream(sda_file: str, check: bool = True):
+    """
+    Stream a file from SDA without writing it to local disk.
+
+    Returns a context manager that yields a binary file object to read the contents of sda_file from
+    (see cmd.stream_stdout). SubprocessError is raised when the context exits if the transfer failed.
+    The file object has to be read to the end before the context exits, unless check is False.
+    """
+    command = hsi(f'get - : {sda_file}')
+    return cmd.stream_stdout(command, check=check)
+
+
+def put_stream(sda_file: str, verify_checksum: bool = True):
+    """
+    Write a file to SDA from a stream.
+
+    Returns a context manager that yields a binary file object to write the contents of sda_file to
+    (see cmd.stream_stdin). SubprocessError is raised when the context exits if the transfer failed.
+    If sda_file exists, it will be overwritten.
+
+    With verify_checksum, HPSS computes the md5 of the data it receives (see put), which get_hash reports.
+    """
+    put_cmd = 'put -c on' if verify_checksum else 'put'
+    command = hsi(f'{put_cmd} - : {sda_file}')
+    return cmd.stream_stdin(command)
+
+
 def get_hash(sda_path: str, missing_ok: bool = False) -> str | None:
-    command = ['hsi', '-P', f'hashlist {sda_path}']
     try:
-        stdout, stderr = cmd.execute(command)
-        checksum = stdout.strip().split()[0]
-        if checksum == '(none)':
-            return None
-        return checksum
+        stdout = run(f'hashlist {sda_path}')
+        return parse_hash(stdout)
     except cmd.SubprocessError:
         if missing_ok:
             return None
@@ -61,21 +144,64 @@ def get_hash(sda_path: str, missing_ok: bool = False) -> str | None:
             raise
 
 
+def parse_hash(stdout: str) -> str | None:
+    checksum = stdout.strip().split()[0]
+    if checksum == '(none)':
+        return None
+    return checksum
+
+
+def get_hashes(sda_paths: list[str], missing_ok: bool = False) -> dict[str, str | None]:
+    """
+    returns the hashes of many SDA files (see get_hash) with one hsi script per config['sda']['batch_size'] files
+    """
+    results = run_many([f'hashlist {path}' for path in sda_paths])
+    hashes = {}
+    for path, result in zip(sda_paths, results):
+        if isinstance(result, cmd.SubprocessError):
+            if not missing_ok:
+                raise result
+            hashes[path] = None
+        else:
+            hashes[path] = parse_hash(result)
+    return hashes
+
+
+def stat_many(sda_paths: list[str]) -> dict[str, int | None]:
+    """
+    returns the sizes of many SDA files, None for the ones that do not exist, with one hsi script per
+    config['sda']['batch_size'] files
+    """
+    results = run_many([f'ls -s1 {path}' for path in sda_paths])
+    return {
+        path: None if isinstance(result, cmd.SubprocessError) else int(result.strip().split()[0])
+        for path, result in zip(sda_paths, results)
+    }
+
+
 def delete(path: str) -> None:
     if exists(path):
-        command = ['hsi', '-P', f'rm {path}']
-        cmd.execute(command)
+        run(f'rm {path}')
+
+
+def delete_many(paths: list[str]) -> None:
+    """
+    deletes the SDA files that exist among paths, with one hsi script to find them and one to delete them
+    per config['sda']['batch_size'] files
+    """
+    existing = [path for path, size in stat_many(paths).items() if size is not None]
+    for result in run_many([f'rm {path}' for path in existing]):
+        if isinstance(result, cmd.SubprocessError):
+            raise result
 
 
 def exists(path: str) -> bool:
-    command = ['hsi', '-P', f'ls {path}']
     try:
-        cmd.execute(command)
+        run(f'ls {path}')
         return True
     except cmd.SubprocessError:
         return False
 
 
 def ensure_directory(dir_path: str) -> None:
-    command = ['hsi', '-P', f'mkdir -p {dir_path}']
-    cmd.execute(command)
+    run(f'mkdir -p {dir_path}')
@@ -0,0 +1,229 @@
+"""
+A filesystem-backed emulation of SDA, used by scripts/fake_hsi.py in place of hsi
+
+The files are kept under a root directory, at their SDA paths. The md5s created by 'put -c on' are kept under
+root/.emulator/hashes and are what 'hashlist' reports and 'get -c on' verifies, as with hsi.
+
+The emulator can be made to behave like a remote archive:
+    connect_latency     seconds spent when an hsi process starts (hsi authenticates to HPSS then)
+    latency             seconds spent on every command
+    stream_bandwidth    MB/s of a single transfer
+    total_bandwidth     MB/s shared by all the transfers running at once against the same root
+    error_rate          probability that a command fails
+    fail_pattern        regular expression, the commands that match it always fail
+
+Transfers that run at once are counted with one file per transfer under root/.emulator/active, so that
+total_bandwidth applies across hsi processes.
+"""
+from __future__ import annotations
+
+import hashlib
+import os
+import random
+import re
+import sys
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import BinaryIO
+
+BLOCK_SIZE = 1024 * 1024
+MB = 1024 * 1024
+
+
+class EmulatedError(Exception):
+    pass
+
+
+@dataclass
+class Settings:
+    connect_latency: float = 0
+    latency: float = 0
+    stream_bandwidth: float = None
+    total_bandwidth: float = None
+    error_rate: float = 0
+    fail_pattern: str = None
+
+    def to_args(self) -> list[str]:
+        """
+        returns the command line options of fake_hsi for these settings
+        """
+        args = []
+        for name, value in vars(self).items():
+            if value is not None and value != 0:
+                args.extend([f'--{name}', str(value)])
+        return args
+
+
+def hsi_command(root: Path | str, settings: Settings = None) -> list[str]:
+    """
+    returns the value of config['sda']['hsi_command'] that runs fake_hsi against root
+    """
+    settings = settings or Settings()
+    return [sys.executable, '-m', 'workers.scripts.fake_hsi', '--root', str(root), *settings.to_args()]
+
+
+class Backend:
+    def __init__(self, root: Path, settings: Settings = None):
+        self.root = Path(root)
+        self.settings = settings or Settings()
+        self.state_dir = self.root / '.emulator'
+        (self.state_dir / 'hashes').mkdir(parents=True, exist_ok=True)
+        (self.state_dir / 'active').mkdir(parents=True, exist_ok=True)
+        self.commands = {
+            'put': self.put,
+            'get': self.get,
+            'ls': self.ls,
+            'hashlist': self.hashlist,
+            'mkdir': self.mkdir,
+            'rm': self.rm,
+        }
+
+    def connect(self):
+        time.sleep(self.settings.connect_latency)
+
+    def resolve(self, sda_path: str) -> Path:
+        return self.root / sda_path.lstrip('/')
+
+    def hash_path(self, sda_path: str) -> Path:
+        return self.state_dir / 'hashes' / sda_path.lstrip('/')
+
+    def run(self, command: str, stdin: BinaryIO, stdout: BinaryIO):
+        """
+        runs an hsi command, raises an exception if it fails
+        """
+        name, *args = command.split()
+        if name not in self.commands:
+            raise EmulatedError(f'unsupported command {name}')
+        time.sleep(self.settings.latency)
+        if self.settings.fail_pattern is not None and re.search(self.settings.fail_pattern, command):
+            raise EmulatedError('injected failure (fail_pattern)')
+        if self.settings.error_rate and random.random() < self.settings.error_rate:
+            raise EmulatedError('injected failure (error_rate)')
+        self.commands[name](args, stdin, stdout)
+
+    # transfers
+
+    @staticmethod
+    def parse_transfer(args: list[str]) -> tuple[bool, str, str]:
+        """
+        returns whether checksums are on, and the local and SDA paths of 'put/get [-c on] LOCAL : SDA'
+        """
+        checksum = args[:2] == ['-c', 'on']
+        if checksum:
+            args = args[2:]
+        if len(args) != 3 or args[1] != ':':
+            raise EmulatedError(f'expected LOCAL : SDA, got {" ".join(args)}')
+        return checksum, args[0], args[2]
+
+    def active_transfers(self) -> int:
+        count = 0
+        for entry in (self.state_dir / 'active').iterdir():
+            try:
+                os.kill(int(entry.name.split('.')[0]), 0)
+                count += 1
+            except (ProcessLookupError, ValueError):
+                # left behind by a transfer that was killed
+                entry.unlink(missing_ok=True)
+            except PermissionError:
+                count += 1
+        return count
+
+    def copy(self, src: BinaryIO, dst: BinaryIO) -> str:
+        """
+        copies src to dst at the emulated bandwidth and returns the md5 of the data
+        """
+        marker = self.state_dir / 'active' / f'{os.getpid()}.{id(src)}'
+        marker.touch()
+        m = hashlib.md5()
+        try:
+            while data := src.read(BLOCK_SIZE):
+                start = time.monotonic()
+                m.update(data)
+                dst.write(data)
+                rate = self.rate()
+                if rate is not None:
+                    time.sleep(max(0.0, len(data) / rate - (time.monotonic() - start)))
+        finally:
+            marker.unlink(missing_ok=True)
+        return m.hexdigest()
+
+    def rate(self) -> float | None:
+        """
+        returns the bytes per second the current transfer may run at, None if it is not limited
+        """
+        rates = []
+        if self.settings.stream_bandwidth:
+            rates.append(self.settings.stream_bandwidth * MB)
+        if self.settings.total_bandwidth:
+            rates.append(self.settings.total_bandwidth * MB / max(1, self.active_transfers()))
+        return min(rates) if rates else None
+
+    def put(self, args: list[str], stdin: BinaryIO, stdout: BinaryIO):
+        checksum, local, sda_path = self.parse_transfer(args)
+        target = self.resolve(sda_path)
+        if not target.parent.is_dir():
+            raise EmulatedError(f'{target.parent} does not exist')
+        # written to a temp file and renamed, so that a failed put does not leave a partial file
+        tmp = target.with_name(f'.{target.name}.part')
+        with open(tmp, 'wb') as dst:
+            if local == '-':
+                digest = self.copy(stdin, dst)
+            else:
+                with open(local, 'rb') as src:
+                    digest = self.copy(src, dst)
+        tmp.replace(target)
+        hash_path = self.hash_path(sda_path)
+        if checksum:
+            hash_path.parent.mkdir(parents=True, exist_ok=True)
+            hash_path.write_text(digest)
+        else:
+            hash_path.unlink(missing_ok=True)
+
+    def get(self, args: list[str], stdin: BinaryIO, stdout: BinaryIO):
+        checksum, local, sda_path = self.parse_transfer(args)
+        with open(self.resolve(sda_path), 'rb') as src:
+            if local == '-':
+                digest = self.copy(src, stdout)
+            else:
+                with open(local, 'wb') as dst:
+                    digest = self.copy(src, dst)
+        if checksum:
+            stored = self.stored_hash(sda_path)
+            if stored is not None and stored != digest:
+                raise EmulatedError(f'checksum verification failed for {sda_path}: expected {stored}, got {digest}')
+
+    # metadata
+
+    def stored_hash(self, sda_path: str) -> str | None:
+        try:
+            return self.hash_path(sda_path).read_text().strip()
+        except FileNotFoundError:
+            return None
+
+    def ls(self, args: list[str], stdin: BinaryIO, stdout: BinaryIO):
+        with_size = args[:1] == ['-s1']
+        sda_path = args[-1]
+        target = self.resolve(sda_path)
+        if not target.exists():
+            raise EmulatedError(f'{sda_path}: No such file or directory')
+        line = f'{target.stat().st_size} {sda_path}' if with_size else sda_path
+        stdout.write(f'{line}\n'.encode())
+
+    def hashlist(self, args: list[str], stdin: BinaryIO, stdout: BinaryIO):
+        sda_path = args[-1]
+        if not self.resolve(sda_path).is_file():
+            raise EmulatedError(f'{sda_path}: No such file')
+        stdout.write(f'{self.stored_hash(sda_path) or "(none)"} md5 {sda_path}\n'.encode())
+
+    def mkdir(self, args: list[str], stdin: BinaryIO, stdout: BinaryIO):
+        parents = args[:1] == ['-p']
+        self.resolve(args[-1]).mkdir(parents=parents, exist_ok=parents)
+
+    def rm(self, args: list[str], stdin: BinaryIO, stdout: BinaryIO):
+        sda_path = args[-1]
+        target = self.resolve(sda_path)
+        if not target.is_file():
+            raise EmulatedError(f'{sda_path}: No such file')
+        target.unlink()
+        self.hash_path(sda_path).unlink(missing_ok=True)
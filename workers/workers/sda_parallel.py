@@ -0,0 +1,359 @@
+"""
+Parallel transfer of large bundles to and from SDA
+
+A single hsi transfer runs at around 56 MBps (see sda.get), so a bundle of tens of TB takes days to move. Bundles of
+at least config['sda']['parallel']['min_size'] bytes are stored in SDA as segments of segment_size bytes:
+
+    <sda_file>.seg00000, <sda_file>.seg00001, ...   consecutive byte ranges of the bundle
+    <sda_file>.segments.json                        the manifest: the size and md5 of the bundle and of every segment
+
+The segments are uploaded (hsi put -c on - : <segment>, read from the bundle with pread) and downloaded
+(hsi get - : <segment>, written to the bundle with pwrite) by max_workers concurrent hsi processes. The md5 of each
+segment is computed while it is transferred; a segment is retried on failure and, when downloading, on a checksum
+mismatch. After an upload, the md5s HPSS computed for the segments are compared with the local ones before the
+manifest is written.
+
+The dataset's archive_path still names the bundle; metadata.bundle_segments records that it is segmented
+(see is_segmented). Readers that stream the bundle use open_bundle, which reads the segments in order.
+
+Bundles written as volumes at archive time (see bundle.write_bundle_volumes) are read the same way: the volumes
+recorded in metadata.bundle_volumes are the segments of their manifest (see bundle_manifest).
+"""
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+import os
+import threading
+from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing, contextmanager
+from pathlib import Path
+from typing import BinaryIO
+
+from glom import glom
+from sca_rhythm.progress import Progress
+
+import workers.sda as sda
+from workers import exceptions as exc
+from workers.config import config
+
+logger = logging.getLogger(__name__)
+
+BLOCK_SIZE = 4 * 1024 * 1024
+
+
+def manifest_path(sda_file: str) -> str:
+    return f'{sda_file}.segments.json'
+
+
+def segment_path(sda_file: str, index: int) -> str:
+    return f'{sda_file}.seg{index:05d}'
+
+
+def split(size: int, segment_size: int) -> list[tuple[int, int]]:
+    """
+    returns the (offset, size) of the segments of a file of size bytes, at least one
+    """
+    if size == 0:
+        return [(0, 0)]
+    return [(offset, min(segment_size, size - offset)) for offset in range(0, size, segment_size)]
+
+
+def is_segmented(dataset: dict) -> bool:
+    return glom(dataset, 'metadata.bundle_segments', default=None) is not None
+
+
+def is_split(dataset: dict) -> bool:
+    return glom(dataset, 'metadata.bundle_volumes', default=None) is not None
+
+
+def bundle_manifest(dataset: dict) -> dict | None:
+    """
+    returns the manifest of the segments of the dataset's bundle in SDA - its volumes if it was split, its segments
+    if it was segmented - None if the bundle is a single file
+    """
+    if is_split(dataset):
+        return {
+            'size': int(dataset['bundle']['size']),
+            'md5': dataset['bundle']['md5'],
+            'segments': dataset['metadata']['bundle_volumes']['volumes'],
+        }
+    if is_segmented(dataset):
+        return read_manifest(dataset['archive_path'])
+    return None
+
+
+def should_segment(size: int) -> bool:
+    parallel_config = config['sda']['parallel']
+    return parallel_config['enabled'] and size >= parallel_config['min_size']
+
+
+class _Counter:
+    """
+    sums the bytes transferred by the threads and reports the total to progress
+    """
+
+    def __init__(self, progress: Progress = None):
+        self.progress = progress
+        self.total = 0
+        self.lock = threading.Lock()
+
+    def add(self, n: int):
+        with self.lock:
+            self.total += n
+            if self.progress is not None:
+                self.progress.update(self.total)
+
+
+def _with_retries(fn, description: str):
+    retries = config['sda']['parallel']['retries']
+    for attempt in range(retries + 1):
+        try:
+            return fn()
+        except Exception as e:
+            if attempt == retries:
+                raise
+            logger.warning(f'{description} failed (attempt {attempt + 1} of {retries + 1}), retrying: {e}')
+
+
+def _put_segment(fd: int, sda_segment: str, offset: int, size: int, counter: _Counter) -> str:
+    m = hashlib.md5()
+    sent = 0
+    with sda.put_stream(sda_segment) as stdin:
+        while sent < size:
+            data = os.pread(fd, min(BLOCK_SIZE, size - sent), offset + sent)
+            if not data:
+                raise EOFError(f'file ended at offset {offset + sent} before the end of segment {sda_segment}')
+            m.update(data)
+            stdin.write(data)
+            sent += len(data)
+    counter.add(sent)
+    return m.hexdigest()
+
+
+def put(local_file: Path,
+        sda_file: str,
+        md5: str,
+        segment_size: int = None,
+        max_workers: int = None,
+        progress: Progress = None) -> dict:
+    """
+    Uploads local_file to SDA as segments and writes the manifest.
+
+    @param md5: md5 of local_file, recorded in the manifest - the segments are checked individually
+    @param segment_size: defaults to config['sda']['parallel']['segment_size']
+    @param max_workers: number of concurrent hsi transfers, defaults to config['sda']['parallel']['max_workers']
+    @return: the manifest
+    """
+    parallel_config = config['sda']['parallel']
+    segment_size = segment_size or parallel_config['segment_size']
+    max_workers = max_workers or parallel_config['max_workers']
+    size = local_file.stat().st_size
+    segments = split(size, segment_size)
+    counter = _Counter(progress)
+    logger.info(f'putting {local_file} on SDA at {sda_file} as {len(segments)} segments with {max_workers} streams')
+
+    fd = os.open(local_file, os.O_RDONLY)
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            futures = [
+                pool.submit(_with_retries,
+                            lambda i=i, offset=offset, n=n: _put_segment(fd, segment_path(sda_file, i), offset, n,
+                                                                         counter),
+                            f'put of segment {i} of {sda_file}')
+                for i, (offset, n) in enumerate(segments)
+            ]
+            digests = [f.result() for f in futures]
+    finally:
+        os.close(fd)
+
+    paths = [segment_path(sda_file, i) for i in range(len(segments))]
+    sda_hashes = sda.get_hashes(paths)
+    for path, digest in zip(paths, digests):
+        if sda_hashes[path] != digest:
+            raise exc.ValidationFailed(f'Expected checksum of segment {path} in SDA to be {digest}, '
+                                       f'but SDA reports {sda_hashes[path]}')
+
+    manifest = {
+        'size': size,
+        'md5': md5,
+        'segment_size': segment_size,
+        'segments': [
+            {'path': segment_path(sda_file, i), 'offset': offset, 'size': n, 'md5': digest}
+            for i, ((offset, n), digest) in enumerate(zip(segments, digests))
+        ]
+    }
+    with sda.put_stream(manifest_path(sda_file)) as stdin:
+        stdin.write(json.dumps(manifest).encode())
+    return manifest
+
+
+def read_manifest(sda_file: str) -> dict:
+    with sda.get_stream(manifest_path(sda_file)) as stdout:
+        return json.loads(stdout.read())
+
+
+def _get_segment(fd: int, segment: dict, counter: _Counter) -> None:
+    m = hashlib.md5()
+    received = 0
+    with sda.get_stream(segment['path']) as stdout:
+        while True:
+            data = stdout.read(BLOCK_SIZE)
+            if not data:
+                break
+            if received + len(data) > segment['size']:
+                raise exc.ValidationFailed(f'segment {segment["path"]} is larger than {segment["size"]} bytes')
+            m.update(data)
+            os.pwrite(fd, data, segment['offset'] + received)
+            received += len(data)
+    if received != segment['size'] or m.hexdigest() != segment['md5']:
+        raise exc.ValidationFailed(f'segment {segment["path"]}: expected {segment["size"]} bytes with md5 '
+                                   f'{segment["md5"]}, got {received} bytes with md5 {m.hexdigest()}')
+    counter.add(received)
+
+
+def get(sda_file: str,
+        local_file: Path,
+        max_workers: int = None,
+        progress: Progress = None,
+        manifest: dict = None) -> dict:
+    """
+    Downloads the segments of sda_file into local_file, which is overwritten.
+
+    @param max_workers: number of concurrent hsi transfers, defaults to config['sda']['parallel']['max_workers']
+    @param manifest: the manifest of the segments (see bundle_manifest), read from SDA if not provided
+    @return: the manifest
+    """
+    max_workers = max_workers or config['sda']['parallel']['max_workers']
+    manifest = manifest or read_manifest(sda_file)
+    counter = _Counter(progress)
+    logger.info(f'getting {sda_file} from SDA to {local_file} from {len(manifest["segments"])} segments '
+                f'with {max_workers} streams')
+
+    fd = os.open(local_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        os.ftruncate(fd, manifest['size'])
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            futures = [
+                pool.submit(_with_retries,
+                            lambda segment=segment: _get_segment(fd, segment, counter),
+                            f'get of {segment["path"]}')
+                for segment in manifest['segments']
+            ]
+            for f in futures:
+                f.result()
+    finally:
+        os.close(fd)
+    return manifest
+
+
+def stored_paths(sda_file: str) -> list[str]:
+    """
+    returns the SDA paths of the segments and the manifest of sda_file, none if its manifest does not exist
+    """
+    if not sda.exists(manifest_path(sda_file)):
+        return []
+    return [segment['path'] for segment in read_manifest(sda_file)['segments']] + [manifest_path(sda_file)]
+
+
+def delete(sda_file: str) -> None:
+    """
+    deletes the segments and the manifest of sda_file
+    """
+    paths = stored_paths(sda_file)
+    # the manifest is deleted last, so that the segments of a delete that failed can still be found
+    sda.delete_many(paths[:-1])
+    sda.delete_many(paths[-1:])
+
+
+class SegmentReader:
+    """
+    Reads the segments of a bundle in order as one stream, with one hsi process at a time.
+
+    seek() to a later segment skips the segments in between without reading them, so that SpanReader (see
+    extract.SpanReader) can read a few members of a segmented bundle. Within a segment, seeking forward reads and
+    discards the bytes in between.
+    """
+
+    def __init__(self, manifest: dict):
+        self.segments = manifest['segments']
+        self.position = 0
+        self._index = None
+        self._cm = None
+        self._stream = None
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.position
+
+    def _segment_at(self, offset: int) -> int | None:
+        for i, segment in enumerate(self.segments):
+            if segment['offset'] <= offset < segment['offset'] + segment['size']:
+                return i
+        return None
+
+    def _close_segment(self):
+        if self._cm is not None:
+            # the segment may not have been read to its end - its hsi process is killed
+            self._cm.__exit__(None, None, None)
+        self._index = self._cm = self._stream = None
+
+    def _open_segment(self, index: int):
+        self._close_segment()
+        self._cm = sda.get_stream(self.segments[index]['path'], check=False)
+        self._stream = self._cm.__enter__()
+        self._index = index
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        if whence != os.SEEK_SET:
+            raise ValueError('SegmentReader only supports seeking from the start')
+        index = self._segment_at(offset)
+        if index is None:
+            self._close_segment()
+            self.position = offset
+            return offset
+        if index != self._index or offset < self.position:
+            self._open_segment(index)
+            self.position = self.segments[index]['offset']
+        while self.position < offset:
+            data = self._stream.read(min(BLOCK_SIZE, offset - self.position))
+            if not data:
+                raise EOFError(f'segment {self.segments[index]["path"]} ended at offset {self.position}')
+            self.position += len(data)
+        return self.position
+
+    def read(self, size: int = -1) -> bytes:
+        index = self._segment_at(self.position)
+        if index is None:
+            return b''
+        if index != self._index:
+            self.seek(self.position)
+        segment = self.segments[index]
+        remaining = segment['offset'] + segment['size'] - self.position
+        data = self._stream.read(remaining if size < 0 else min(size, remaining))
+        if not data:
+            raise EOFError(f'segment {segment["path"]} ended at offset {self.position}')
+        self.position += len(data)
+        return data
+
+    def close(self):
+        self._close_segment()
+
+
+@contextmanager
+def open_bundle(dataset: dict, check: bool = True) -> Iterator[BinaryIO]:
+    """
+    yields a binary file object to read the dataset's bundle from SDA sequentially, whether it is stored as one file,
+    as segments or as volumes (see sda.get_stream for check)
+    """
+    manifest = bundle_manifest(dataset)
+    if manifest is not None:
+        with closing(SegmentReader(manifest)) as reader:
+            yield reader
+    else:
+        with sda.get_stream(dataset['archive_path'], check=check) as stream:
+            yield stream
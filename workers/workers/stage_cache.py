@@ -0,0 +1,250 @@
+"""
+Staged data cache - keeps the stage filesystems within a disk budget by evicting the least recently used staged
+datasets and bundles
+
+The local data of a dataset is its staged directory (a full stage, or a partial one, see tasks.stage_files), the stage
+manifest, and the bundle and its member index in the bundle staging dir. A dataset's last access is the latest of the
+access times of its symlinks in the download dir (read whenever a download is served through them) and the change
+times of its staged directory and bundle (set when they are staged and when their permissions are granted).
+
+When the used space of a stage filesystem plus the space about to be written to it crosses
+config['stage']['cache']['high_water_mark'] (a fraction of the size of the filesystem), datasets are evicted in least
+recently used order until the estimate is below low_water_mark. Datasets accessed in the last min_idle_seconds are not
+evicted.
+"""
+from __future__ import annotations
+
+import logging
+import os
+import shutil
+import time
+from collections.abc import Iterable
+from dataclasses import dataclass, field
+from pathlib import Path
+
+from glom import glom
+
+import workers.api as api
+import workers.bundle as bundle_lib
+import workers.treewalk as treewalk
+from workers import exceptions as exc
+from workers.config import config
+from workers.dataset import get_bundle_name, get_bundle_staged_path, get_stage_manifest_path
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class CachedDataset:
+    dataset: dict
+    # local paths that hold the dataset's data
+    paths: list[Path]
+    # estimated bytes of the dataset's data on each filesystem (st_dev)
+    bytes_by_device: dict[int, int] = field(default_factory=dict)
+    last_access: float = 0
+
+
+def staged_paths(dataset: dict) -> list[Path]:
+    """
+    returns the staged directories of a dataset: the full stage and the partial stage, if any
+    """
+    paths = []
+    for staged_path in [dataset.get('staged_path'), glom(dataset, 'metadata.partial_stage.staged_path', default=None)]:
+        if staged_path and Path(staged_path) not in paths:
+            paths.append(Path(staged_path))
+    return paths
+
+
+def download_links(dataset: dict) -> list[Path]:
+    download_dir = Path(config['paths']['download_dir'])
+    links = [download_dir / get_bundle_name(dataset)]
+    alias = glom(dataset, 'metadata.stage_alias', default=None)
+    if alias:
+        links.append(download_dir / alias)
+    return links
+
+
+def cached_dataset(dataset: dict) -> CachedDataset | None:
+    """
+    returns the local data of a dataset, its estimated size and its last access, None if nothing is on local disk
+    """
+    entry = CachedDataset(dataset=dataset, paths=[])
+    times = []
+
+    def add(path: Path, num_bytes: int, st: os.stat_result):
+        entry.paths.append(path)
+        entry.bytes_by_device[st.st_dev] = entry.bytes_by_device.get(st.st_dev, 0) + num_bytes
+        times.append(st.st_ctime)
+
+    for staged_path in staged_paths(dataset):
+        try:
+            st = os.lstat(staged_path)
+        except FileNotFoundError:
+            continue
+        if str(staged_path) == dataset.get('staged_path') and dataset.get('is_staged') and dataset.get('du_size'):
+            num_bytes = int(dataset['du_size'])
+        else:
+            # partial stages are small, or the stage did not complete - measure them
+            usage = treewalk.DiskUsage()
+            for e in treewalk.walk(staged_path, include_root=True):
+                usage.add(e)
+            num_bytes = usage.allocated_size
+        add(staged_path, num_bytes, st)
+        manifest_path = get_stage_manifest_path(staged_path)
+        if manifest_path.exists():
+            entry.paths.append(manifest_path)
+
+    bundle_path = Path(get_bundle_staged_path(dataset=dataset))
+    for path in [bundle_path, bundle_lib.get_index_path(bundle_path)]:
+        try:
+            st = os.lstat(path)
+        except FileNotFoundError:
+            continue
+        add(path, st.st_blocks * 512, st)
+
+    if not entry.paths:
+        return None
+    for link in download_links(dataset):
+        try:
+            times.append(os.lstat(link).st_atime)
+        except FileNotFoundError:
+            pass
+    entry.last_access = max(times)
+    return entry
+
+
+def cached_datasets(exclude: Iterable[int] = ()) -> list[CachedDataset]:
+    """
+    returns the archived datasets that have data on local disk, least recently used first
+    """
+    exclude = set(exclude)
+    entries = []
+    for dataset in api.get_all_datasets(archived=True, bundle=True):
+        if dataset['id'] in exclude:
+            continue
+        entry = cached_dataset(dataset)
+        if entry is not None:
+            entries.append(entry)
+    return sorted(entries, key=lambda e: e.last_access)
+
+
+def purge(dataset: dict) -> int:
+    """
+    deletes the staged directories, stage manifests, bundle and bundle index of the dataset from local disk
+    along with its download links, and marks the dataset as not staged
+
+    @return: number of bytes freed
+    """
+    purged_size = 0
+    for staged_path in staged_paths(dataset):
+        if staged_path.exists():
+            purged_size += sum(e.stat.st_size for e in treewalk.walk(staged_path, include_root=True))
+            shutil.rmtree(staged_path, ignore_errors=True)
+        get_stage_manifest_path(staged_path).unlink(missing_ok=True)
+
+    bundle_path = Path(get_bundle_staged_path(dataset=dataset))
+    for path in [bundle_path, bundle_lib.get_index_path(bundle_path)]:
+        if path.exists():
+            purged_size += path.stat().st_size
+            path.unlink(missing_ok=True)
+
+    for link in download_links(dataset):
+        if link.is_symlink():
+            link.unlink(missing_ok=True)
+
+    update_data = {
+        'is_staged': False,
+        'staged_path': None
+    }
+    if glom(dataset, 'metadata.partial_stage', default=None) is not None:
+        update_data['metadata'] = {'partial_stage': None}
+    api.update_dataset(dataset_id=dataset['id'], update_data=update_data)
+    api.add_state_to_dataset(dataset_id=dataset['id'], state='PURGED')
+    return purged_size
+
+
+def filesystem_path(path: Path) -> Path:
+    """
+    returns path or its closest existing ancestor
+    """
+    path = Path(path)
+    while not path.exists() and path != path.parent:
+        path = path.parent
+    return path
+
+
+def ensure_space(required: dict[Path, int], exclude: Iterable[int] = ()) -> None:
+    """
+    Evicts the least recently used datasets from the filesystems that would cross the high water mark
+    once the required bytes are written to them, until they are below the low water mark.
+
+    Raises RetryableException if the required bytes do not fit in the free space of a filesystem even after evicting
+    all the datasets that can be evicted - the caller is expected to try again later, once more datasets are idle.
+
+    @param required: bytes about to be written to each directory, 0 to only enforce the high water mark
+    @param exclude: ids of the datasets to not evict, e.g. the dataset being staged
+    """
+    cache_config = config['stage']['cache']
+    if not cache_config['enabled']:
+        return
+
+    # the directories may be on the same filesystem
+    needed = {}
+    filesystems = {}
+    for path, num_bytes in required.items():
+        path = filesystem_path(path)
+        dev = os.stat(path).st_dev
+        needed[dev] = needed.get(dev, 0) + num_bytes
+        filesystems[dev] = path
+
+    to_free = {}
+    for dev, path in filesystems.items():
+        usage = shutil.disk_usage(path)
+        if usage.used + needed[dev] > cache_config['high_water_mark'] * usage.total:
+            to_free[dev] = usage.used + needed[dev] - cache_config['low_water_mark'] * usage.total
+    if not to_free:
+        return
+
+    logger.info(f'stage cache is above the high water mark, bytes to free by device: {to_free}')
+    idle_since = time.time() - cache_config['min_idle_seconds']
+    for entry in cached_datasets(exclude=exclude):
+        if not to_free:
+            break
+        if entry.last_access > idle_since:
+            # the rest were accessed more recently
+            break
+        if not any(dev in to_free for dev in entry.bytes_by_device):
+            continue
+        dataset = entry.dataset
+        try:
+            freed = purge(dataset)
+        except Exception as e:
+            logger.error(f'Error evicting staged dataset #{dataset["id"]} {dataset["name"]}', exc_info=e)
+            continue
+        logger.info(f'evicted staged dataset id:{dataset["id"]} name:{dataset["name"]} '
+                    f'last access:{time.ctime(entry.last_access)} bytes freed:{freed}')
+        for dev, num_bytes in entry.bytes_by_device.items():
+            if dev in to_free:
+                to_free[dev] -= num_bytes
+                if to_free[dev] <= 0:
+                    del to_free[dev]
+
+    for dev, path in filesystems.items():
+        if shutil.disk_usage(path).free < needed[dev]:
+            raise exc.RetryableException(f'not enough space in {path} for {needed[dev]} bytes '
+                                         f'after evicting the idle staged datasets')
+    if to_free:
+        logger.warning(f'stage cache is above the low water mark after evicting all idle datasets, '
+                       f'bytes left to free by device: {to_free}')
+
+
+def enforce() -> None:
+    """
+    evicts datasets from the stage filesystems that are above the high water mark
+    """
+    stage_dirs = []
+    for dataset_type, paths in config['paths'].items():
+        if isinstance(paths, dict) and 'stage' in paths:
+            stage_dirs.append(Path(paths['stage']))
+            stage_dirs.append(Path(paths['bundle']['stage']))
+    ensure_space({p: 0 for p in stage_dirs})
@@ -2,12 +2,16 @@ import shutil
 from pathlib import Path
 from celery import Celery
 from celery.utils.log import get_task_logger
+from glom import glom
 from sca_rhythm import WorkflowTask
 import json
 
 import workers.api as api
+import workers.bundle as bundle_lib
 import workers.cmd as cmd
 import workers.config.celeryconfig as celeryconfig
+import workers.hash_cache as hash_cache
+import workers.sda_parallel as sda_parallel
 import workers.utils as utils
 import workers.workflow_utils as wf_utils
 from workers.config import config
@@ -17,14 +21,22 @@ app.config_from_object(celeryconfig)
 logger = get_task_logger(__name__)
 
 
-def make_tarfile(celery_task: WorkflowTask, tar_path: Path, source_dir: str, source_size: int):
+def make_tarfile(celery_task: WorkflowTask,
+                 tar_path: Path,
+                 source_dir: str,
+                 source_size: int,
+                 compute_checksum: bool = False,
+                 index_path: Path = None) -> str | None:
     """
 
     @param celery_task:
     @param tar_path:
     @param source_dir:
     @param source_size:
-    @return:
+    @param compute_checksum: if True, the tar is hashed while it is written and its md5 is returned
+    @param index_path: if provided, an index of the tar's members is written to this path while the tar is written
+                       (see bundle.build_index)
+    @return: md5 hex digest of the tar file if compute_checksum is True, else None
     """
     logger.info(f'creating tar of {source_dir} at {tar_path}')
     # if the tar file already exists, delete it
@@ -38,51 +50,199 @@ def make_tarfile(celery_task: WorkflowTask, tar_path: Path, source_dir: str, sou
                                           units='bytes'):
         # using python to create tar files does not support --sparse
         # SDA has trouble uploading sparse tar files
-        cmd.tar(tar_path=tar_path, source_dir=source_dir)
+        if compute_checksum or index_path is not None:
+            tar_checksum, _ = bundle_lib.write_bundle(tar_path=tar_path, source_dir=source_dir, index_path=index_path)
+            if not compute_checksum:
+                tar_checksum = None
+        else:
+            tar_checksum = None
+            cmd.tar(tar_path=tar_path, source_dir=source_dir)
 
     # TODO: validate files inside tar
-    return tar_path
+    return tar_checksum
+
+
+def split_volume_size(dataset: dict) -> int | None:
+    """
+    returns the size of the volumes to write the dataset's bundle as, None to write it as a single tar
+    (see config['archive']['split'])
+    """
+    split_config = config['archive']['split']
+    if split_config['enabled'] and int(dataset.get('du_size') or 0) >= split_config['min_size']:
+        return split_config['volume_size']
+    return None
+
+
+def make_volumes(celery_task: WorkflowTask,
+                 tar_path: Path,
+                 source_dir: str,
+                 source_size: int,
+                 volume_size: int,
+                 index_path: Path = None) -> dict:
+    """
+    creates the bundle as volumes next to tar_path (see bundle.write_bundle_volumes) and writes a manifest of them
+    to bundle.get_volumes_manifest_path(tar_path)
+
+    If the volumes and the manifest are left from an earlier run on the same source, with the same volume size,
+    they are reused, so that a failed upload does not tar the dataset again.
+
+    @return: the manifest: {"size": <bytes>, "md5": <md5 of the tar>, "volume_size": <bytes>, "volumes": [...]}
+    """
+    manifest_path = bundle_lib.get_volumes_manifest_path(tar_path)
+    if manifest_path.exists():
+        manifest = json.loads(manifest_path.read_text())
+        volume_paths = [tar_path.with_name(v['name']) for v in manifest['volumes']]
+        if (manifest['source_dir'] == str(source_dir)
+                and manifest['volume_size'] == volume_size
+                and (index_path is None or index_path.exists())
+                and all(p.exists() and p.stat().st_size == v['size']
+                        for p, v in zip(volume_paths, manifest['volumes']))):
+            logger.info(f'reusing the {len(volume_paths)} volumes of {tar_path}')
+            return manifest
+        manifest_path.unlink()
+
+    logger.info(f'creating tar of {source_dir} as volumes of {volume_size} bytes at {tar_path}')
+    with wf_utils.track_progress_parallel(celery_task=celery_task,
+                                          name='tar',
+                                          progress_fn=lambda: sum(p.stat().st_size for p in
+                                                                  tar_path.parent.glob(f'{tar_path.name}.vol[0-9]*')),
+                                          total=source_size,
+                                          units='bytes'):
+        md5, size, volumes = bundle_lib.write_bundle_volumes(tar_path=tar_path,
+                                                             source_dir=source_dir,
+                                                             volume_size=volume_size,
+                                                             index_path=index_path)
+    for volume in volumes:
+        # save the upload from reading the volumes again
+        hash_cache.put(tar_path.with_name(volume['name']).stat(), volume['md5'])
+    manifest = {
+        'source_dir': str(source_dir),
+        'size': size,
+        'md5': md5,
+        'volume_size': volume_size,
+        'volumes': volumes,
+    }
+    # written last - its presence means the volumes are complete
+    manifest_path.write_text(json.dumps(manifest))
+    return manifest
 
 
 def archive(celery_task: WorkflowTask, dataset: dict, delete_local_file: bool = False):
     # Tar the dataset directory and compute checksum
     bundle = Path(f'{config["paths"][dataset["type"]]["bundle"]["generate"]}/{dataset["name"]}.tar')
+    stream_checksum = config['archive']['stream_checksum']
+    index = bundle_lib.get_index_path(bundle) if config['archive']['index'] else None
+    volume_size = split_volume_size(dataset)
 
-    make_tarfile(celery_task=celery_task,
-                 tar_path=bundle,
-                 source_dir=dataset['origin_path'],
-                 source_size=dataset['du_size'])
+    sda_dir = wf_utils.get_archive_dir(dataset['type'])
+    sda_bundle_path = f'{sda_dir}/{bundle.name}'
+    segments_attrs = None
+    volumes_attrs = None
+
+    if volume_size is not None:
+        volumes_manifest = make_volumes(celery_task=celery_task,
+                                        tar_path=bundle,
+                                        source_dir=dataset['origin_path'],
+                                        source_size=dataset['du_size'],
+                                        volume_size=volume_size,
+                                        index_path=index)
+        bundle_size = volumes_manifest['size']
+        bundle_checksum = volumes_manifest['md5']
+        volumes = wf_utils.upload_volumes_to_sda(local_dir=bundle.parent,
+                                                 sda_dir=sda_dir,
+                                                 volumes=volumes_manifest['volumes'],
+                                                 celery_task=celery_task)
+        # the manifest is small - it is kept in SDA next to the volumes to find them without the API
+        volumes_manifest_path = bundle_lib.get_volumes_manifest_path(bundle)
+        sda_volumes_manifest_path = f'{sda_dir}/{volumes_manifest_path.name}'
+        wf_utils.upload_file_to_sda(local_file_path=volumes_manifest_path, sda_file_path=sda_volumes_manifest_path)
+        volumes_attrs = {
+            'manifest_path': sda_volumes_manifest_path,
+            'volume_size': volume_size,
+            'volumes': volumes,
+        }
+    else:
+        bundle_checksum = make_tarfile(celery_task=celery_task,
+                                       tar_path=bundle,
+                                       source_dir=dataset['origin_path'],
+                                       source_size=dataset['du_size'],
+                                       compute_checksum=stream_checksum,
+                                       index_path=index)
+
+        bundle_stat = bundle.stat()
+        bundle_size = bundle_stat.st_size
+        if stream_checksum:
+            # save the upload preflight check from reading the bundle again
+            hash_cache.put(bundle_stat, bundle_checksum)
+        else:
+            bundle_checksum = utils.checksum(bundle)
+
+        if sda_parallel.should_segment(bundle_size):
+            manifest = wf_utils.upload_file_to_sda_parallel(local_file_path=bundle,
+                                                            sda_file_path=sda_bundle_path,
+                                                            md5=bundle_checksum,
+                                                            celery_task=celery_task)
+            segments_attrs = {
+                'manifest_path': sda_parallel.manifest_path(sda_bundle_path),
+                'segment_size': manifest['segment_size'],
+                'count': len(manifest['segments']),
+            }
+        else:
+            wf_utils.upload_file_to_sda(local_file_path=bundle,
+                                        sda_file_path=sda_bundle_path,
+                                        celery_task=celery_task)
 
-    bundle_size = bundle.stat().st_size
-    bundle_checksum = utils.checksum(bundle)
     bundle_attrs = {
         'name': bundle.name,
         'size': bundle_size,
         'md5': bundle_checksum,
     }
 
-    sda_dir = wf_utils.get_archive_dir(dataset['type'])
-    sda_bundle_path = f'{sda_dir}/{bundle.name}'
-
-    wf_utils.upload_file_to_sda(local_file_path=bundle,
-                                sda_file_path=sda_bundle_path,
-                                celery_task=celery_task)
+    index_attrs = None
+    if index is not None:
+        # the index is small - it is kept next to the bundle and uploaded along with it
+        sda_index_path = f'{sda_dir}/{index.name}'
+        wf_utils.upload_file_to_sda(local_file_path=index, sda_file_path=sda_index_path)
+        index_attrs = {
+            'name': index.name,
+            'sda_path': sda_index_path,
+            'local_path': str(index),
+            'md5': utils.checksum(index),
+        }
 
     if delete_local_file:
         # file successfully uploaded to SDA, delete the local copy
         print("deleting local bundle")
-        bundle.unlink()
+        if volumes_attrs is not None:
+            for volume in volumes_attrs['volumes']:
+                bundle.with_name(volume['name']).unlink()
+            bundle_lib.get_volumes_manifest_path(bundle).unlink()
+        else:
+            bundle.unlink()
 
-    return sda_bundle_path, bundle_attrs
+    return sda_bundle_path, bundle_attrs, index_attrs, segments_attrs, volumes_attrs
 
 
 def archive_dataset(celery_task, dataset_id, **kwargs):
     dataset = api.get_dataset(dataset_id=dataset_id, bundle=True)
-    sda_bundle_path, bundle_attrs = archive(celery_task, dataset)
+    sda_bundle_path, bundle_attrs, index_attrs, segments_attrs, volumes_attrs = archive(celery_task, dataset)
     update_data = {
         'archive_path': sda_bundle_path,
         'bundle': bundle_attrs
     }
+    # the API deep merges metadata, lists by index - the attributes of an earlier archive are cleared first so
+    # that they are replaced wholesale, e.g. the volumes of a bundle split into more volumes than it is now
+    stale_keys = [key for key in ('bundle_index', 'bundle_segments', 'bundle_volumes')
+                  if glom(dataset, f'metadata.{key}', default=None) is not None]
+    if stale_keys:
+        api.update_dataset(dataset_id=dataset_id, update_data={'metadata': {key: None for key in stale_keys}})
+    metadata = {}
+    if index_attrs is not None:
+        metadata['bundle_index'] = index_attrs
+    # a bundle archived again as a single file is no longer segmented or split
+    metadata['bundle_segments'] = segments_attrs
+    metadata['bundle_volumes'] = volumes_attrs
+    update_data['metadata'] = metadata
     api.update_dataset(dataset_id=dataset_id, update_data=update_data)
     api.add_state_to_dataset(dataset_id=dataset_id, state='ARCHIVED')
 
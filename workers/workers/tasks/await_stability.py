@@ -1,5 +1,4 @@
 import datetime
-import itertools
 import time
 from pathlib import Path
 
@@ -8,6 +7,7 @@ from celery.utils.log import get_task_logger
 
 import workers.api as api
 import workers.config.celeryconfig as celeryconfig
+import workers.treewalk as treewalk
 from workers.config import config
 
 logger = get_task_logger(__name__)
@@ -34,9 +34,10 @@ def dir_last_modified_time(dataset_path: Path) -> float:
     Returns:
     float: The last modified time in epoch seconds.
     """
-    paths = itertools.chain([dataset_path], dataset_path.rglob('*'))
+    # dangling symlinks are skipped
+    entries = treewalk.walk(dataset_path, include_root=True)
     return max(
-        (max(p.lstat().st_mtime, p.lstat().st_ctime) for p in paths if p.exists()),
+        (max(e.stat.st_mtime, e.stat.st_ctime) for e in entries if e.followed_stat is not None),
         default=time.time()
     )
 
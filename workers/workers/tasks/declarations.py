@@ -59,12 +59,44 @@ def generate_qc(celery_task, dataset_id, **kwargs):
 
 
 @app.task(base=WorkflowTask, bind=True, name='stage_dataset',
-          autoretry_for=(Exception,),
           max_retries=3,
           default_retry_delay=5)
-def stage_dataset(celery_task, dataset_id, **kwargs):
+def stage_dataset(celery_task, dataset_id, deferrals: int = 0, **kwargs):
+    from workers.config import config
     from workers.tasks.stage import stage_dataset as task_body
-    return task_body(celery_task, dataset_id, **kwargs)
+    # waiting for space is not a failure - deferrals are counted in the deferrals kwarg with their own limit and
+    # countdown, and request.retries less the deferrals counts the failures, limited by max_retries.
+    # autoretry_for is not used since it would count the deferrals against max_retries. retry() is given a
+    # max_retries that allows this retry, since both limits are enforced here - max_retries=None would be replaced
+    # by the task's max_retries.
+    admission_config = config['stage']['admission']
+    try:
+        return task_body(celery_task, dataset_id, **kwargs)
+    except exc.Deferred as e:
+        if deferrals >= admission_config['max_deferrals']:
+            raise
+        raise celery_task.retry(exc=e, countdown=e.countdown or admission_config['defer_seconds'],
+                                kwargs={**kwargs, 'deferrals': deferrals + 1},
+                                max_retries=celery_task.request.retries + 1)
+    except Exception as e:
+        if celery_task.request.retries - deferrals >= celery_task.max_retries:
+            raise
+        raise celery_task.retry(exc=e, kwargs={**kwargs, 'deferrals': deferrals},
+                                max_retries=celery_task.request.retries + 1)
+
+
+@app.task(base=WorkflowTask, bind=True, name='stage_dataset_files',
+          autoretry_for=(exc.RetryableException,),
+          max_retries=3,
+          default_retry_delay=5)
+def stage_dataset_files(celery_task, dataset_id, **kwargs):
+    from workers.tasks.stage_files import stage_dataset_files as task_body
+    try:
+        return task_body(celery_task, dataset_id, **kwargs)
+    except exc.ValidationFailed:
+        raise
+    except Exception as e:
+        raise exc.RetryableException(e)
 
 
 @app.task(base=WorkflowTask, bind=True, name='validate_dataset',
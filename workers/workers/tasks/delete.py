@@ -1,8 +1,10 @@
 from celery import Celery
+from glom import glom
 
 import workers.api as api
 import workers.config.celeryconfig as celeryconfig
 import workers.sda as sda
+import workers.sda_parallel as sda_parallel
 
 app = Celery("tasks")
 app.config_from_object(celeryconfig)
@@ -11,7 +13,18 @@ app.config_from_object(celeryconfig)
 def delete_dataset(celery_task, dataset_id, **kwargs):
     dataset = api.get_dataset(dataset_id=dataset_id)
     sda_path = dataset['archive_path']
-    sda.delete(sda_path)
+    if sda_parallel.is_split(dataset):
+        volumes = dataset['metadata']['bundle_volumes']
+        paths = [volume['path'] for volume in volumes['volumes']] + [volumes['manifest_path']]
+    elif sda_parallel.is_segmented(dataset):
+        paths = sda_parallel.stored_paths(sda_path)
+    else:
+        paths = [sda_path]
+    # the member index of the bundle (see bundle.build_index) is archived next to it
+    index_sda_path = glom(dataset, 'metadata.bundle_index.sda_path', default=None)
+    if index_sda_path is not None:
+        paths.append(index_sda_path)
+    sda.delete_many(paths)
     # id is appended to name to make it unique (database constraint) to allow new datasets to have this same name
     update_data = {
         'archive_path': None,
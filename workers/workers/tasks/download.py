@@ -1,4 +1,4 @@
-import itertools
+import os
 import shutil
 import stat
 from pathlib import Path
@@ -9,6 +9,7 @@ from glom import glom
 
 import workers.api as api
 import workers.config.celeryconfig as celeryconfig
+import workers.treewalk as treewalk
 from workers.config import config
 from workers.exceptions import ValidationFailed
 from workers.dataset import get_bundle_staged_path, get_bundle_name
@@ -30,11 +31,16 @@ def rm(p: Path):
 
 
 def grant_read_permissions_to_others(root: Path):
-    for p in itertools.chain([root], root.rglob('*')):
-        if p.is_dir():
-            p.chmod(p.stat().st_mode | stat.S_IROTH | stat.S_IXOTH)
+    for entry in treewalk.walk(root, include_root=True):
+        # chmod follows symlinks, so the permissions are computed from the target's mode
+        st = entry.followed_stat
+        if st is None:
+            # dangling symlink
+            continue
+        if entry.is_dir:
+            os.chmod(entry.path, st.st_mode | stat.S_IROTH | stat.S_IXOTH)
         else:
-            p.chmod(p.stat().st_mode | stat.S_IROTH)
+            os.chmod(entry.path, st.st_mode | stat.S_IROTH)
 
 
 def grant_access_to_parent_chain(leaf: Path, root: Path):
@@ -46,7 +52,11 @@ def grant_access_to_parent_chain(leaf: Path, root: Path):
 
 def setup_download(celery_task, dataset_id, **kwargs):
     dataset = api.get_dataset(dataset_id=dataset_id, bundle=True)
-    staged_path, alias = Path(dataset['staged_path']), glom(dataset, 'metadata.stage_alias')
+    # datasets of which only some files were staged (see tasks.stage_files) have their staged path in the metadata
+    staged_path = dataset.get('staged_path') or glom(dataset, 'metadata.partial_stage.staged_path', default=None)
+    if staged_path is None:
+        raise ValidationFailed(f'Dataset {dataset_id} is not staged')
+    staged_path, alias = Path(staged_path), glom(dataset, 'metadata.stage_alias')
 
     bundle_path = Path(get_bundle_staged_path(dataset=dataset))
 
@@ -63,11 +73,14 @@ def setup_download(celery_task, dataset_id, **kwargs):
     download_path.symlink_to(staged_path, target_is_directory=True)
     # do the same for bundle file
     rm(bundle_download_path)
-    bundle_download_path.symlink_to(bundle_path)
+    # the bundle is not kept locally when the dataset was staged by streaming it from SDA
+    if bundle_path.exists():
+        bundle_download_path.symlink_to(bundle_path)
 
     # enable others to read and cd into stage directory
     grant_read_permissions_to_others(staged_path)
-    grant_read_permissions_to_others(bundle_download_path)
+    if bundle_path.exists():
+        grant_read_permissions_to_others(bundle_download_path)
 
     # enable others to navigate to leaf by granting execute permission on parent directories
     grant_access_to_parent_chain(staged_path, root=Path(config['paths']['root']))
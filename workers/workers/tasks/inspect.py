@@ -1,90 +1,219 @@
+from __future__ import annotations
+
+from collections import deque
+from collections.abc import Iterable, Iterator
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 from celery import Celery
 from celery.utils.log import get_task_logger
+from glom import glom
 from sca_rhythm.progress import Progress
 
 import workers.api as api
-import workers.cmd as cmd
 import workers.config.celeryconfig as celeryconfig
+import workers.digest as digest
+import workers.treewalk as treewalk
 import workers.utils as utils
 from workers import exceptions as exc
+from workers.checkpoint import InspectionCheckpoint
 from workers.config import config
 
 app = Celery("tasks")
 app.config_from_object(celeryconfig)
 logger = get_task_logger(__name__)
 
+# number of unreadable paths recorded in the dataset's metadata when the inspection fails
+MAX_RECORDED_ERRORS = 100
+
+
+def digest_algorithms() -> list[str]:
+    """
+    md5 followed by the other algorithms configured in config['digest']['algorithms']
+    """
+    return ['md5'] + [a for a in config['digest']['algorithms'] if a != 'md5']
+
 
-def generate_metadata(celery_task, source: Path):
+def generate_metadata(celery_task, source: Path, summary: dict, checkpoint: InspectionCheckpoint = None) \
+        -> Iterator[dict]:
     """
     source is a directory that exists and has to readable and executable (see files inside)
     all the files and directories under source should be readable
-    returns:    number of files, 
-                number of directories, 
-                sum of stat size of all files, 
-                number of genome data files,
-                the md5 digest and relative filenames of genome data files
+
+    Pipeline stages: directory walk (see treewalk.walk) -> checksum (see digest.map_bounded) -> yield file metadata.
+    Files are yielded in walk order, as soon as they are hashed, so the caller can post them while the remaining
+    files are being hashed. Only a bounded number of files is held in memory at any time.
+
+    if a checkpoint is provided, the metadata of the files recorded in it by a previous attempt is reused and the
+    metadata of every yielded file is added to it.
+
+    summary is populated once all files are yielded with:
+                du_size: apparent size of the tree, like du -sb
+                allocated_size: allocated size of the tree in bytes, like du -s --block-size=1
+                num_files: number of files,
+                num_directories: number of directories,
+                size: sum of stat size of all files,
+                num_genome_files: number of genome data files
+                errors: the files and directories that were unreadable, the caller has to fail the inspection if
+                        there are any
     """
     num_files, num_directories, size, num_genome_files = 0, 0, 0, 0
-    metadata = []
-    errors = []
+    # keyed on path - an unreadable directory is reported both when it is seen and when the walk fails to list it
+    errors = {}
     if not utils.is_readable(source):
         msg = f'source {source} is either not readable or not traversable'
         raise exc.InspectionFailed(msg)
 
-    paths = list(source.rglob('*'))
     progress = Progress(celery_task=celery_task, name='', units='items')
 
-    for p in progress(paths):
-        if utils.is_readable(p):
-            if p.is_file():
-                num_files += 1
-                # if symlink, only add the size of the symlink, not the pointed file
-                file_size = p.lstat().st_size
-                size += file_size
-                # do not compute checksum for symlinks
-                hex_digest = utils.checksum(p) if not p.is_symlink() else None
-                relpath = p.relative_to(source)
-                metadata.append({
-                    'path': str(relpath),
-                    'md5': hex_digest,
-                    'size': file_size,
-                    'type': utils.filetype(p)
-                })
-                if ''.join(p.suffixes) in config['genome_file_types'] and not p.is_symlink():
-                    num_genome_files += 1
-            elif p.is_dir():
-                num_directories += 1
-        else:
-            errors.append(f'{p} is not readable/traversable')
-
-    if len(errors) > 0:
-        raise exc.InspectionFailed(errors)
-
-    return num_files, num_directories, size, num_genome_files, metadata
+    def add_error(path: str):
+        errors[path] = f'{path} is not readable/traversable'
+
+    # du counts the source directory itself too
+    usage = treewalk.DiskUsage()
+    usage.add(treewalk.stat_entry(str(source)))
+
+    def files():
+        nonlocal num_files, num_directories, size, num_genome_files
+        for i, entry in enumerate(treewalk.walk(source, onerror=lambda path, e: add_error(path))):
+            progress.update(i + 1)
+            usage.add(entry)
+            if entry.readable:
+                if entry.is_file:
+                    num_files += 1
+                    # if symlink, only add the size of the symlink, not the pointed file
+                    file_size = entry.stat.st_size
+                    size += file_size
+                    p = Path(entry.path)
+                    if ''.join(p.suffixes) in config['genome_file_types'] and not entry.is_symlink:
+                        num_genome_files += 1
+
+                    relpath = str(p.relative_to(source))
+                    checkpointed = checkpoint.lookup(relpath, entry.stat) if checkpoint is not None else None
+                    file_metadata = checkpointed or {
+                        'path': relpath,
+                        'md5': None,
+                        'size': file_size,
+                        'type': entry.filetype
+                    }
+                    # do not compute checksum for symlinks
+                    needs_checksum = checkpointed is None and not entry.is_symlink
+                    # the size is the number of bytes read to compute the checksum
+                    yield (p, entry.stat, file_metadata, needs_checksum), file_size if needs_checksum else 0
+                elif entry.is_dir:
+                    num_directories += 1
+            else:
+                add_error(entry.path)
+
+    algorithms = digest_algorithms()
+
+    def checksum(item) -> dict | None:
+        p, _, _, needs_checksum = item
+        return utils.digests(p, algorithms) if needs_checksum else None
+
+    checksum_progress = Progress(celery_task=celery_task, name='checksum', units='bytes')
+    hashed = digest.map_bounded(checksum,
+                                files(),
+                                max_workers=config['inspect']['checksum']['max_workers'],
+                                max_inflight_bytes=config['inspect']['checksum']['max_inflight_bytes'],
+                                progress=checksum_progress)
+    for (p, st, file_metadata, _), hex_digests in hashed:
+        if hex_digests is not None:
+            file_metadata['md5'] = hex_digests.pop('md5')
+            if hex_digests:
+                # the other digests are stored in the file's metadata
+                file_metadata['metadata'] = {'digests': hex_digests}
+        if checkpoint is not None:
+            checkpoint.add_file(file_metadata, st)
+        yield file_metadata
+
+    summary.update({
+        'errors': list(errors.values()),
+        'du_size': usage.apparent_size,
+        'allocated_size': usage.allocated_size,
+        'num_files': num_files,
+        'num_directories': num_directories,
+        'size': size,
+        'num_genome_files': num_genome_files,
+    })
+
+
+def post_file_metadata(dataset_id, metadata: Iterable[dict], checkpoint: InspectionCheckpoint) -> None:
+    """
+    Split metadata into batches and add them to the dataset - this is to avoid large payloads to the API.
+
+    Batches are posted by a pool of threads while metadata is still being generated. At most
+    config['inspect']['post_concurrency'] batches are in flight; when that many are pending, consuming more
+    metadata waits for the oldest to finish.
+
+    Files that were posted by a previous attempt of the task (according to the checkpoint) are skipped.
+    """
+    batch_size = config['inspect']['file_metadata_batch_size']
+    max_workers = config['inspect']['post_concurrency']
+    # (number of files posted once this batch is done, future) in posting order
+    pending = deque()
+
+    def wait_oldest():
+        num_posted, future = pending.popleft()
+        future.result()
+        # only a contiguous prefix of the files is marked as posted
+        checkpoint.mark_posted(num_posted)
+
+    def unposted():
+        for i, file_metadata in enumerate(metadata):
+            if i >= checkpoint.num_posted:
+                yield i, file_metadata
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        try:
+            for batch in utils.batched(unposted(), n=batch_size):
+                if len(pending) >= max_workers:
+                    wait_oldest()
+                last_index = batch[-1][0]
+                files = [file_metadata for _, file_metadata in batch]
+                pending.append((last_index + 1, pool.submit(api.add_files_to_dataset, dataset_id=dataset_id,
+                                                            files=files)))
+            while pending:
+                wait_oldest()
+        finally:
+            for _, future in pending:
+                future.cancel()
 
 
 def inspect_dataset(celery_task, dataset_id, **kwargs):
     dataset = api.get_dataset(dataset_id=dataset_id)
     source = Path(dataset['origin_path']).resolve()
-    du_size = cmd.total_size(source)
-    num_files, num_directories, size, num_genome_files, metadata = generate_metadata(celery_task, source)
+    checkpoint = InspectionCheckpoint(dataset_id=dataset_id)
+    summary = {}
+    try:
+        metadata = generate_metadata(celery_task, source, summary, checkpoint)
+        post_file_metadata(dataset_id, metadata, checkpoint)
+    finally:
+        checkpoint.close()
+
+    if summary['errors']:
+        # the readable files are posted by now - the dataset is marked so that it is not taken as inspected,
+        # and the checkpoint is kept for a retry once the files are readable
+        metadata = {'inspection_errors': summary['errors'][:MAX_RECORDED_ERRORS]}
+        api.update_dataset(dataset_id=dataset_id, update_data={'metadata': metadata})
+        raise exc.InspectionFailed(summary['errors'])
 
     update_data = {
-        'du_size': du_size,
-        'size': size,
-        'num_files': num_files,
-        'num_directories': num_directories,
+        'du_size': summary['du_size'],
+        'size': summary['size'],
+        'num_files': summary['num_files'],
+        'num_directories': summary['num_directories'],
         'metadata': {
-            'num_genome_files': num_genome_files,
+            'num_genome_files': summary['num_genome_files'],
+            'allocated_size': summary['allocated_size'],
+            'digest_algorithms': digest_algorithms(),
         }
 
     }
+    if glom(dataset, 'metadata.inspection_errors', default=None) is not None:
+        update_data['metadata']['inspection_errors'] = None
     api.update_dataset(dataset_id=dataset_id, update_data=update_data)
-    # split metadata into batches and add to dataset
-    # this is to avoid large payloads to the API
-    for batch in utils.batched(metadata, n=config['inspect']['file_metadata_batch_size']):
-        api.add_files_to_dataset(dataset_id=dataset_id, files=batch)
 
+    # the inspection is complete, a retry of this task has to start over
+    checkpoint.discard()
     return dataset_id,
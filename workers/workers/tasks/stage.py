@@ -1,20 +1,29 @@
+from __future__ import annotations
+
+import contextlib
+import json
 import os
 import shutil
-import tarfile
 import tempfile
 from pathlib import Path
+from typing import BinaryIO
 
 from celery import Celery
 from celery.utils.log import get_task_logger
 from sca_rhythm import WorkflowTask
+from sca_rhythm.progress import Progress
 
+import workers.admission as admission
 import workers.api as api
+import workers.extract as extract_lib
+import workers.sda_parallel as sda_parallel
 import workers.utils as utils
 from workers.config import config
 import workers.config.celeryconfig as celeryconfig
 import workers.workflow_utils as wf_utils
 from workers.dataset import compute_staging_path
 from workers.dataset import get_bundle_staged_path
+from workers.dataset import get_stage_manifest_path
 from workers import exceptions as exc
 
 app = Celery("tasks")
@@ -39,23 +48,138 @@ def extract_tarfile(tar_path: Path, target_dir: Path, override_arcname=False):
     @param target_dir:
     @param override_arcname:
     """
-    with tarfile.open(tar_path, mode='r') as archive:
-        # find the top-level directory in the extracted archive
-        archive_name = os.path.commonprefix(archive.getnames())
-        extraction_dir = target_dir if override_arcname else (target_dir.parent / archive_name)
+    # the tar is extracted by the same engine as extract_tarfile_with_manifest, without writing a manifest
+    extract_tarfile_with_manifest(source=tar_path,
+                                  target_dir=target_dir,
+                                  manifest_path=None,
+                                  override_arcname=override_arcname)
+
+
+def manifest_algorithms() -> list[str]:
+    """
+    digests recorded in the stage manifest: md5 and the fixity algorithm validate checks files against
+    """
+    return list(dict.fromkeys(['md5', config['digest']['fixity_algorithm']]))
+
+
+def extract_tarfile_with_manifest(source: Path | BinaryIO,
+                                  target_dir: Path,
+                                  manifest_path: Path | None,
+                                  override_arcname=False,
+                                  expected_md5: str = None,
+                                  progress: Progress = None):
+    """
+    Same as extract_tarfile, but the files are hashed while they are extracted (see extract.extract_tar) and
+    a manifest (JSON lines) of their paths relative to the extracted directory, sizes and digests is written
+    to manifest_path. The tar is read sequentially, so source can also be a stream (see sda.get_stream).
+
+    The tar is extracted to a temp directory next to the extraction directory, which is renamed to the extraction
+    directory only after the whole tar was read (and its md5 matched expected_md5 if provided). If anything fails,
+    an existing extraction directory is left untouched.
 
-        # if extraction_dir exists then delete it
-        if extraction_dir.exists():
-            shutil.rmtree(extraction_dir)
+    The manifest is written only after the extraction directory is in place; an existing manifest is deleted first.
 
-        # create parent directories if missing
-        extraction_dir.parent.mkdir(parents=True, exist_ok=True)
+    @param source: path of the tar file or a binary file object to read the tar from
+    @param target_dir: see extract_tarfile
+    @param manifest_path: path to write the manifest to, None to not write a manifest
+    @param override_arcname: see extract_tarfile
+    @param expected_md5: if provided, md5 of the tar that is verified at the end of the stream.
+                         ValidationFailed is raised if it does not match.
+    @param progress: if provided, updated with the number of bytes of the tar read so far
+    """
+    if manifest_path is not None:
+        manifest_path.unlink(missing_ok=True)
+    target_dir.parent.mkdir(parents=True, exist_ok=True)
+    archive_name = None
+    with contextlib.ExitStack() as stack:
+        if isinstance(source, (str, Path)):
+            source = stack.enter_context(open(source, 'rb'))
+        # the tar is only hashed to be verified - a bundle on local disk has been verified before it is extracted
+        reader = extract_lib.HashingReader(source, algorithm='md5' if expected_md5 is not None else None,
+                                           progress=progress)
+        tmp_dir = stack.enter_context(tempfile.TemporaryDirectory(dir=target_dir.parent))
+        spool = stack.enter_context(tempfile.TemporaryFile('w+', dir=target_dir.parent))
 
         # extracts the tar contents to a temp directory
-        # move the contents to the extraction_dir
-        with tempfile.TemporaryDirectory(dir=extraction_dir.parent) as tmp_dir:
-            archive.extractall(path=tmp_dir)
-            shutil.move(Path(tmp_dir) / archive_name, extraction_dir)
+        # the top-level directory of the archive is only known after all members are seen
+        # the files are only hashed for the manifest
+        records = extract_lib.extract_tar(reader, Path(tmp_dir),
+                                          algorithms=manifest_algorithms() if manifest_path is not None else [],
+                                          **config['stage']['extract'])
+        for record in records:
+            name = record['path']
+            archive_name = name if archive_name is None else os.path.commonpath([archive_name, name])
+            spool.write(json.dumps(record) + '\n')
+        archive_name = archive_name or '.'
+
+        reader.drain()
+        if expected_md5 is not None and reader.hexdigest() != expected_md5:
+            raise exc.ValidationFailed(f'Expected checksum of the bundle to be {expected_md5},'
+                                       f' but evaluated checksum was {reader.hexdigest()}')
+
+        extraction_dir = target_dir if override_arcname else (target_dir.parent / archive_name)
+        promote(Path(tmp_dir) / archive_name, extraction_dir)
+
+        if manifest_path is not None:
+            # rewrite the manifest with paths relative to the extracted directory
+            spool.seek(0)
+            tmp_manifest_path = manifest_path.with_name(manifest_path.name + '.tmp')
+            with open(tmp_manifest_path, 'w') as manifest:
+                for line in spool:
+                    record = json.loads(line)
+                    record['path'] = os.path.relpath(record['path'], archive_name)
+                    manifest.write(json.dumps(record) + '\n')
+            os.replace(tmp_manifest_path, manifest_path)
+
+
+def promote(src: Path, dst: Path):
+    """
+    renames directory src to dst, replacing dst if it exists. src and dst must be on the same filesystem.
+
+    dst is only missing between two renames - its previous contents are deleted after the new directory is in place.
+    """
+    if not dst.exists():
+        os.rename(src, dst)
+        return
+    trash_dir = Path(tempfile.mkdtemp(dir=dst.parent, prefix=f'.{dst.name}.previous.'))
+    os.rename(dst, trash_dir / dst.name)
+    os.rename(src, dst)
+    shutil.rmtree(trash_dir)
+
+
+def stream_stage(celery_task: WorkflowTask, dataset: dict, staging_dir: Path) -> None:
+    """
+    streams the bundle from SDA into extract_tarfile_with_manifest, without writing the bundle to local disk
+    the md5 of the bundle is verified at the end of the stream, before the staged directory is put in place
+    """
+    bundle = dataset['bundle']
+    sda_bundle_path = dataset['archive_path']
+    progress = Progress(celery_task=celery_task, name='sda get', total=bundle.get('size'), units='bytes')
+    manifest_path = get_stage_manifest_path(staging_dir) if config['stage']['manifest'] else None
+
+    logger.info(f'streaming bundle {sda_bundle_path} from SDA to {staging_dir}')
+    with sda_parallel.open_bundle(dataset) as stream:
+        extract_tarfile_with_manifest(source=stream,
+                                      target_dir=staging_dir,
+                                      manifest_path=manifest_path,
+                                      override_arcname=True,
+                                      expected_md5=bundle['md5'],
+                                      progress=progress)
+
+
+def required_space(dataset: dict) -> dict[Path, int]:
+    """
+    returns the bytes that staging the dataset writes to the stage and bundle staging directories: the extracted
+    files and the bundle, unless it is streamed or already on local disk
+    """
+    staging_dir, _ = compute_staging_path(dataset)
+    required = {staging_dir.parent: int(dataset.get('du_size') or 0)}
+    if not config['stage']['streaming']:
+        bundle_path = Path(get_bundle_staged_path(dataset=dataset))
+        bundle_size = int(dataset['bundle']['size'])
+        if not (bundle_path.exists() and bundle_path.stat().st_size == bundle_size):
+            required[bundle_path.parent] = bundle_size
+    return required
 
 
 def stage(celery_task: WorkflowTask, dataset: dict) -> (str, str):
@@ -71,13 +195,28 @@ def stage(celery_task: WorkflowTask, dataset: dict) -> (str, str):
     alias_dir = staging_dir.parent
     alias_dir.mkdir(parents=True, exist_ok=True)
 
+    if config['stage']['streaming']:
+        stream_stage(celery_task, dataset, staging_dir)
+        if not config['stage']['manifest']:
+            get_stage_manifest_path(staging_dir).unlink(missing_ok=True)
+        return str(staging_dir), alias
+
     bundle = dataset["bundle"]
     bundle_md5 = bundle["md5"]
     bundle_download_path = Path(get_bundle_staged_path(dataset=dataset))
 
-    wf_utils.download_file_from_sda(sda_file_path=sda_bundle_path,
-                                    local_file_path=bundle_download_path,
-                                    celery_task=celery_task)
+    # the volumes or segments of a split or segmented bundle are downloaded concurrently into the bundle
+    bundle_manifest = sda_parallel.bundle_manifest(dataset)
+    if bundle_manifest is not None:
+        wf_utils.download_file_from_sda_parallel(sda_file_path=sda_bundle_path,
+                                                 local_file_path=bundle_download_path,
+                                                 celery_task=celery_task,
+                                                 size=int(bundle['size']),
+                                                 manifest=bundle_manifest)
+    else:
+        wf_utils.download_file_from_sda(sda_file_path=sda_bundle_path,
+                                        local_file_path=bundle_download_path,
+                                        celery_task=celery_task)
 
     evaluated_checksum = utils.checksum(bundle_download_path)
     if evaluated_checksum != bundle_md5:
@@ -86,7 +225,14 @@ def stage(celery_task: WorkflowTask, dataset: dict) -> (str, str):
 
     # extract the tar file to stage directory
     logger.info(f'extracting tar {bundle_download_path} to {staging_dir}')
-    extract_tarfile(tar_path=bundle_download_path, target_dir=staging_dir, override_arcname=True)
+    if config['stage']['manifest']:
+        extract_tarfile_with_manifest(source=bundle_download_path,
+                                      target_dir=staging_dir,
+                                      manifest_path=get_stage_manifest_path(staging_dir),
+                                      override_arcname=True)
+    else:
+        get_stage_manifest_path(staging_dir).unlink(missing_ok=True)
+        extract_tarfile(tar_path=bundle_download_path, target_dir=staging_dir, override_arcname=True)
 
     # delete the local tar copy after extraction
     # bundle_path.unlink()
@@ -96,7 +242,9 @@ def stage(celery_task: WorkflowTask, dataset: dict) -> (str, str):
 
 def stage_dataset(celery_task, dataset_id, **kwargs):
     dataset = api.get_dataset(dataset_id=dataset_id, bundle=True)
-    staged_path, alias = stage(celery_task, dataset)
+    # raises Deferred if the stage filesystems do not have room for the dataset
+    with admission.reserve(f'stage:{dataset_id}', required_space(dataset), exclude=[dataset_id]):
+        staged_path, alias = stage(celery_task, dataset)
 
     update_data = {
         'staged_path': staged_path,
@@ -0,0 +1,226 @@
+"""
+Selective staging - stage a few files of a dataset without retrieving and extracting the whole bundle
+
+The byte ranges of the requested files in the bundle are looked up in the bundle's member index (see
+bundle.build_index). Only those ranges are read: from the local copy of the bundle if it was staged before,
+else from SDA. The files are extracted to the dataset's usual staging path (see compute_staging_path) and
+verified against the md5s in the index.
+
+hsi has no ranged get, so what is transferred from SDA depends on how the bundle is stored:
+    segments or volumes     only the segments / volumes that hold a range are fetched, each from its start up to
+                            the end of the last range in it (see sda_parallel.SegmentReader)
+    one file                the bundle is streamed from its start and the stream is stopped after the last range,
+                            so staging a file near the end of a large bundle transfers almost all of it
+Bundles of at least config['sda']['parallel']['min_size'] bytes are stored as segments or volumes, which bounds
+the transfer to about one segment per range for the large datasets this is meant for.
+"""
+from __future__ import annotations
+
+import fnmatch
+import gzip
+import os
+import tarfile
+import tempfile
+from pathlib import Path, PurePosixPath
+
+from celery import Celery
+from celery.utils.log import get_task_logger
+from glom import glom
+from sca_rhythm import WorkflowTask
+from sca_rhythm.progress import Progress
+
+import workers.api as api
+import workers.bundle as bundle_lib
+import workers.config.celeryconfig as celeryconfig
+import workers.extract as extract_lib
+import workers.sda_parallel as sda_parallel
+import workers.stage_cache as stage_cache
+import workers.utils as utils
+import workers.workflow_utils as wf_utils
+from workers import exceptions as exc
+from workers.config import config
+from workers.dataset import compute_staging_path
+from workers.dataset import get_bundle_staged_path
+
+app = Celery("tasks")
+app.config_from_object(celeryconfig)
+logger = get_task_logger(__name__)
+
+# member types in the bundle index
+DIRECTORY_TYPE = tarfile.DIRTYPE.decode()
+LINK_TYPE = tarfile.LNKTYPE.decode()
+
+
+def local_bundle_path(dataset: dict) -> Path | None:
+    """
+    returns the path of the bundle in the bundle staging dir if a complete copy is present
+    """
+    bundle_path = Path(get_bundle_staged_path(dataset=dataset))
+    if bundle_path.exists() and bundle_path.stat().st_size == int(dataset['bundle']['size']):
+        return bundle_path
+    return None
+
+
+def get_bundle_index(celery_task: WorkflowTask, dataset: dict) -> Path:
+    """
+    returns the local path of the member index of the dataset's bundle
+
+    The index written when the bundle was archived is used if it is still on local disk, else its copy in SDA is
+    downloaded. For bundles archived without an index, the index is built by reading the bundle once (streamed from
+    SDA if there is no local copy), saved next to the staged bundle and uploaded to SDA.
+    """
+    index_attrs = glom(dataset, 'metadata.bundle_index', default=None)
+    index_path = bundle_lib.get_index_path(Path(get_bundle_staged_path(dataset=dataset)))
+
+    if index_attrs is not None:
+        for p in [Path(index_attrs['local_path']), index_path]:
+            if p.exists() and utils.checksum(p) == index_attrs['md5']:
+                return p
+        wf_utils.download_file_from_sda(sda_file_path=index_attrs['sda_path'],
+                                        local_file_path=index_path,
+                                        celery_task=celery_task)
+        evaluated_checksum = utils.checksum(index_path)
+        if evaluated_checksum != index_attrs['md5']:
+            raise exc.ValidationFailed(f'Expected checksum of the bundle index to be {index_attrs["md5"]},'
+                                       f' but evaluated checksum was {evaluated_checksum}')
+        return index_path
+
+    logger.info(f'bundle of dataset {dataset["id"]} has no index, building it from the bundle')
+    bundle = dataset['bundle']
+    progress = Progress(celery_task=celery_task, name='index bundle', total=int(bundle['size']), units='bytes')
+    index_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_index_path = index_path.with_name(index_path.name + '.tmp')
+    bundle_path = local_bundle_path(dataset)
+    with (open(bundle_path, 'rb') if bundle_path else sda_parallel.open_bundle(dataset)) as stream, \
+            gzip.open(tmp_index_path, 'wt') as index_file:
+        reader = extract_lib.HashingReader(stream, progress=progress)
+        bundle_lib.build_index(reader, index_file)
+        reader.drain()
+    if reader.hexdigest() != bundle['md5']:
+        raise exc.ValidationFailed(f'Expected checksum of the bundle to be {bundle["md5"]},'
+                                   f' but evaluated checksum was {reader.hexdigest()}')
+    os.replace(tmp_index_path, index_path)
+
+    sda_index_path = f'{os.path.dirname(dataset["archive_path"])}/{index_path.name}'
+    wf_utils.upload_file_to_sda(local_file_path=index_path, sda_file_path=sda_index_path)
+    api.update_dataset(dataset_id=dataset['id'], update_data={
+        'metadata': {
+            'bundle_index': {
+                'name': index_path.name,
+                'sda_path': sda_index_path,
+                'local_path': str(index_path),
+                'md5': utils.checksum(index_path),
+            }
+        }
+    })
+    return index_path
+
+
+def matches(path: str, patterns: list[str]) -> bool:
+    """
+    True if path or any of its parent directories matches one of the glob patterns
+    """
+    p = PurePosixPath(path)
+    candidates = [p, *list(p.parents)[:-1]]
+    return any(fnmatch.fnmatchcase(str(c), pattern) for c in candidates for pattern in patterns)
+
+
+def select_members(index_path: Path, patterns: list[str]) -> tuple[str, list[dict]]:
+    """
+    returns the top-level directory of the bundle and the index records of the members that match the patterns,
+    along with the members that hard links among them point to
+    """
+    records = list(bundle_lib.read_index(index_path))
+    archive_name = os.path.commonpath([r['path'] for r in records]) if records else ''
+    archive_name = archive_name or '.'
+    by_path = {r['path']: r for r in records}
+
+    selected = {}
+    for r in records:
+        if matches(os.path.relpath(r['path'], archive_name), patterns):
+            selected[r['path']] = r
+            if r['type'] == LINK_TYPE:
+                # hard links are extracted by linking to a member that appears earlier in the bundle
+                target = str(PurePosixPath(r['linkname'])) if 'linkname' in r else None
+                if target in by_path:
+                    selected[target] = by_path[target]
+    return archive_name, sorted(selected.values(), key=lambda r: r['offset'])
+
+
+def stage_files(celery_task: WorkflowTask, dataset: dict, patterns: list[str]) -> tuple[Path, str, list[dict]]:
+    """
+    stages the files of the dataset that match patterns (paths or glob patterns relative to the dataset root)
+
+    returns the staging path, the stage alias and the index records of the staged members
+
+    when the bundle is read from SDA as one file, every byte before the end of the last matching member is
+    transferred (see the module docstring)
+    """
+    staging_dir, alias = compute_staging_path(dataset)
+    index_path = get_bundle_index(celery_task, dataset)
+    archive_name, members = select_members(index_path, patterns)
+    if not members:
+        raise exc.ValidationFailed(f'no files in dataset {dataset["id"]} match {patterns}')
+
+    spans = [bundle_lib.member_span(r) for r in members]
+    total = sum(end - start for start, end in extract_lib.merge_spans(spans))
+    logger.info(f'staging {len(members)} members ({total} bytes of the bundle) of dataset {dataset["id"]} '
+                f'to {staging_dir}')
+    progress = Progress(celery_task=celery_task, name='stage files', total=total, units='bytes')
+    expected = {r['path']: r['md5'] for r in members if 'md5' in r}
+
+    staging_dir.mkdir(parents=True, exist_ok=True)
+    stage_cache.ensure_space({staging_dir: sum(int(r['size']) for r in members)}, exclude=[dataset['id']])
+    bundle_path = local_bundle_path(dataset)
+    if bundle_path is None and not (sda_parallel.is_split(dataset) or sda_parallel.is_segmented(dataset)):
+        logger.info(f'the bundle of dataset {dataset["id"]} is one file in SDA, its first '
+                    f'{max(end for _, end in spans)} bytes will be transferred')
+    # the stream is not read to its end - hsi's exit status is not checked, the md5 of every file is
+    stream_cm = open(bundle_path, 'rb') if bundle_path else sda_parallel.open_bundle(dataset, check=False)
+    with tempfile.TemporaryDirectory(dir=staging_dir.parent) as tmp_dir, stream_cm as stream:
+        reader = extract_lib.SpanReader(stream, spans, progress=progress)
+        records = extract_lib.extract_tar(reader, Path(tmp_dir), algorithms=['md5'], **config['stage']['extract'])
+        for record in records:
+            if record['path'] in expected and record['md5'] != expected[record['path']]:
+                raise exc.ValidationFailed(f'checksum mismatch for {record["path"]} in the bundle of dataset '
+                                           f'{dataset["id"]}')
+
+        # move the extracted files into the staging dir, next to files staged earlier
+        extracted_root = Path(tmp_dir) / archive_name
+        for dir_path, dir_names, file_names in os.walk(extracted_root):
+            rel_dir = Path(dir_path).relative_to(extracted_root)
+            (staging_dir / rel_dir).mkdir(parents=True, exist_ok=True)
+            # symbolic links to directories are listed in dir_names and are not walked into
+            for name in file_names + [d for d in dir_names if (Path(dir_path) / d).is_symlink()]:
+                os.replace(Path(dir_path) / name, staging_dir / rel_dir / name)
+
+    return staging_dir, alias, members
+
+
+def stage_dataset_files(celery_task, dataset_id, paths: list[str] = None, **kwargs):
+    """
+    paths: paths or glob patterns of the files to stage, relative to the dataset root.
+           If not provided, they are read from the dataset's metadata.stage_files_request.paths
+    """
+    dataset = api.get_dataset(dataset_id=dataset_id, bundle=True)
+    patterns = paths or glom(dataset, 'metadata.stage_files_request.paths', default=None)
+    if not patterns:
+        raise exc.ValidationFailed(f'no paths to stage were requested for dataset {dataset_id}')
+
+    staged_path = dataset.get('staged_path')
+    if dataset.get('is_staged') and staged_path and Path(staged_path).exists():
+        logger.info(f'dataset {dataset_id} is already staged at {staged_path}')
+        return dataset_id,
+
+    staging_dir, alias, members = stage_files(celery_task, dataset, patterns)
+    update_data = {
+        'metadata': {
+            'stage_alias': alias,
+            'partial_stage': {
+                'staged_path': str(staging_dir),
+                'num_files': sum(1 for r in members if r['type'] != DIRECTORY_TYPE),
+            }
+        }
+    }
+    api.update_dataset(dataset_id=dataset_id, update_data=update_data)
+    return dataset_id,
@@ -1,45 +1,240 @@
+from __future__ import annotations
+
+import random
+from contextlib import closing
 from pathlib import Path
 
 from celery import Celery
 from celery.utils.log import get_task_logger
+from glom import glom
 from sca_rhythm import WorkflowTask
 from sca_rhythm.progress import Progress
 
 import workers.api as api
 import workers.config.celeryconfig as celeryconfig
+import workers.digest as digest
+import workers.extract as extract_lib
 import workers.utils as utils
 from workers import exceptions as exc
+from workers.config import config
+from workers.dataset import get_stage_manifest_path
 
 app = Celery("tasks")
 app.config_from_object(celeryconfig)
 logger = get_task_logger(__name__)
 
+# validation levels, from the least to the most thorough (see validate_dataset)
+LEVELS = ('manifest', 'sampled', 'full')
+
+
+def expected_digest(file_metadata: dict) -> tuple[str, str]:
+    """
+    returns the algorithm and the digest to validate the file against:
+    the fixity algorithm's digest if it was stored when the dataset was inspected, else md5
+    """
+    algorithm = config['digest']['fixity_algorithm']
+    stored_digests = glom(file_metadata, 'metadata.digests', default=None) or {}
+    if algorithm in stored_digests:
+        return algorithm, stored_digests[algorithm]
+    return 'md5', file_metadata['md5']
+
+
+def check_file(dataset_dir: Path, file_metadata: dict) -> tuple[str, str] | None:
+    """
+    returns a validation error (path, reason) or None if the file is valid
+    """
+    path = dataset_dir / file_metadata['path']
+    if not path.exists():
+        return str(path), 'file does not exist'
+    # for symlnks skip checksum validation
+    if path.is_symlink():
+        return None
+    algorithm, expected = expected_digest(file_metadata)
+    # a fixity check reads the file - a cached digest would vouch for bytes that are no longer read back
+    digest = utils.digests(path, [algorithm], use_cache=False)[algorithm]
+    if digest != expected:
+        return str(path), 'checksum mismatch'
+    return None
+
 
-def check_files(celery_task: WorkflowTask, dataset_dir: Path, files_metadata: list[dict]):
-    progress = Progress(celery_task=celery_task, units='files')
+def check_files(celery_task: WorkflowTask,
+                dataset_dir: Path,
+                files_metadata: list[dict],
+                max_workers: int = None,
+                max_inflight_bytes: int = None,
+                max_errors: int = None) -> list[tuple[str, str]]:
+    """
+    Checks that the files exist under dataset_dir and that their digests match the ones computed during inspection.
+    Files are checked concurrently (see digest.map_bounded), the errors are returned in the order of files_metadata.
+
+    @param max_workers: number of files checked concurrently, defaults to config['validate']['max_workers']
+    @param max_inflight_bytes: cap on the total size of the files being hashed at once,
+                               defaults to config['validate']['max_inflight_bytes']
+    @param max_errors: stop checking the remaining files once these many errors are found,
+                       defaults to config['validate']['max_errors']. None or 0 checks all files.
+    @return: list of (path, reason) tuples
+    """
+    validate_config = config['validate']
+    max_workers = max_workers or validate_config['max_workers']
+    max_inflight_bytes = max_inflight_bytes or validate_config['max_inflight_bytes']
+    max_errors = max_errors if max_errors is not None else validate_config['max_errors']
+
+    progress = Progress(celery_task=celery_task, units='files', total=len(files_metadata))
+    # size is used to throttle the number of bytes being hashed at once
+    items = ((f, int(f.get('size') or 0)) for f in files_metadata)
     validation_errors = []
-    for file_metadata in progress(files_metadata):
-        rel_path = file_metadata['path']
-        path = dataset_dir / rel_path
-        if path.exists():
-            # for symlnks skip checksum validation
-            if path.is_symlink():
-                continue
-            digest = utils.checksum(path)
-            if digest != file_metadata['md5']:
-                validation_errors.append((str(path), 'checksum mismatch'))
+    results = digest.map_bounded(lambda f: check_file(dataset_dir, f),
+                                 items,
+                                 max_workers=max_workers,
+                                 max_inflight_bytes=max_inflight_bytes)
+    # closing the generator on an early exit cancels the files queued for checking
+    with closing(results):
+        for i, (_, error) in enumerate(results):
+            progress.update(i + 1)
+            if error is not None:
+                validation_errors.append(error)
+                if max_errors and len(validation_errors) >= max_errors:
+                    logger.warning(f'stopping validation of {dataset_dir} after {len(validation_errors)} errors, '
+                                   f'{len(files_metadata) - i - 1} files were not checked')
+                    break
+    return validation_errors
+
+
+def check_manifest(celery_task: WorkflowTask,
+                   dataset_dir: Path,
+                   manifest_path: Path,
+                   files_metadata: list[dict],
+                   max_errors: int = None) -> list[tuple[str, str]]:
+    """
+    Checks the files against the manifest written when the bundle was extracted (see stage.extract_tarfile_with_manifest)
+    instead of reading them again. Returns errors in the same format and order as check_files.
+
+    Files whose expected digest was not recorded in the manifest are checked by reading them (see check_file).
+    Symbolic links are checked for existence like check_files does.
+    """
+    max_errors = max_errors if max_errors is not None else config['validate']['max_errors']
+    manifest = {record['path']: record for record in extract_lib.read_manifest(manifest_path)}
+
+    progress = Progress(celery_task=celery_task, units='files', total=len(files_metadata))
+    validation_errors = []
+    for i, file_metadata in enumerate(files_metadata):
+        progress.update(i + 1)
+        path = dataset_dir / file_metadata['path']
+        record = manifest.get(file_metadata['path'])
+        algorithm, expected = expected_digest(file_metadata)
+        if record is None:
+            error = str(path), 'file does not exist'
+        elif record['type'] == utils.FileType.SYMBOLIC_LINK.value:
+            error = None if path.exists() else (str(path), 'file does not exist')
+        elif algorithm in record:
+            error = None if record[algorithm] == expected else (str(path), 'checksum mismatch')
         else:
-            validation_errors.append((str(path), 'file does not exist'))
+            error = check_file(dataset_dir, file_metadata)
+
+        if error is not None:
+            validation_errors.append(error)
+            if max_errors and len(validation_errors) >= max_errors:
+                logger.warning(f'stopping validation of {dataset_dir} after {len(validation_errors)} errors, '
+                               f'{len(files_metadata) - i - 1} files were not checked')
+                break
     return validation_errors
 
 
-def validate_dataset(celery_task, dataset_id, **kwargs):
+def check_sizes(celery_task: WorkflowTask,
+                dataset_dir: Path,
+                files_metadata: list[dict],
+                max_errors: int = None) -> list[tuple[str, str]]:
+    """
+    Checks that the files exist under dataset_dir and have the sizes recorded during inspection, without reading them.
+    Symbolic links are only checked for existence. Returns errors in the same format and order as check_files.
+    """
+    max_errors = max_errors if max_errors is not None else config['validate']['max_errors']
+    progress = Progress(celery_task=celery_task, units='files', total=len(files_metadata))
+    validation_errors = []
+    for i, file_metadata in enumerate(files_metadata):
+        progress.update(i + 1)
+        path = dataset_dir / file_metadata['path']
+        error = None
+        if not path.exists():
+            error = str(path), 'file does not exist'
+        elif not path.is_symlink() and file_metadata.get('size') is not None \
+                and path.stat().st_size != int(file_metadata['size']):
+            error = str(path), 'size mismatch'
+
+        if error is not None:
+            validation_errors.append(error)
+            if max_errors and len(validation_errors) >= max_errors:
+                logger.warning(f'stopping validation of {dataset_dir} after {len(validation_errors)} errors, '
+                               f'{len(files_metadata) - i - 1} files were not checked')
+                break
+    return validation_errors
+
+
+def sample_files(files_metadata: list[dict],
+                 sample_size: int,
+                 weighting: str = 'size',
+                 rng: random.Random = None) -> list[dict]:
+    """
+    returns a random sample of sample_size files (all files if there are fewer), in the order of files_metadata
+
+    weighting='uniform' picks every file with the same probability, weighting='size' picks files with a probability
+    proportional to their size (weighted sampling without replacement, Efraimidis-Spirakis), so that the sample
+    covers a larger fraction of the dataset's bytes.
+    """
+    if weighting not in ('uniform', 'size'):
+        raise ValueError(f'unknown sample weighting: {weighting}')
+    rng = rng or random.Random()
+    if len(files_metadata) <= sample_size:
+        return list(files_metadata)
+    if weighting == 'uniform':
+        indices = rng.sample(range(len(files_metadata)), sample_size)
+    else:
+        # empty files get the weight of a one byte file so that they can still be picked
+        keys = [(rng.random() ** (1 / max(int(f.get('size') or 0), 1)), i) for i, f in enumerate(files_metadata)]
+        indices = [i for _, i in sorted(keys, reverse=True)[:sample_size]]
+    return [files_metadata[i] for i in sorted(indices)]
+
+
+def validate_dataset(celery_task, dataset_id, level: str = None, **kwargs):
+    """
+    level: how thoroughly the staged files are checked, defaults to config['validate']['level'].
+           It is set per workflow with the step's kwargs in the workflow registry.
+        manifest: the files exist and have the sizes recorded during inspection - no file is read
+        sampled: as manifest, and the digests of a random sample of the files (see sample_files) are verified
+                 by reading them
+        full: the digests of all files are verified - against the stage manifest if the bundle was extracted with
+              one, else by reading the files
+    """
+    level = level or config['validate']['level']
+    if level not in LEVELS:
+        raise ValueError(f'unknown validation level: {level}, expected one of {LEVELS}')
     dataset = api.get_dataset(dataset_id=dataset_id, files=True)
     staged_path = Path(dataset['staged_path'])
+    logger.info(f'validating dataset id: {dataset_id} path: {staged_path} level: {level}')
 
-    validation_errors = check_files(celery_task=celery_task,
-                                    dataset_dir=staged_path,
-                                    files_metadata=dataset['files'])
+    manifest_path = get_stage_manifest_path(staged_path)
+    if level in ('manifest', 'sampled'):
+        validation_errors = check_sizes(celery_task=celery_task,
+                                        dataset_dir=staged_path,
+                                        files_metadata=dataset['files'])
+        if level == 'sampled' and len(validation_errors) == 0:
+            sample = sample_files(dataset['files'],
+                                  sample_size=config['validate']['sample_size'],
+                                  weighting=config['validate']['sample_weighting'])
+            logger.info(f'verifying the digests of {len(sample)} of {len(dataset["files"])} files')
+            validation_errors = check_files(celery_task=celery_task,
+                                            dataset_dir=staged_path,
+                                            files_metadata=sample)
+    elif manifest_path.exists():
+        logger.info(f'validating {staged_path} against the stage manifest {manifest_path}')
+        validation_errors = check_manifest(celery_task=celery_task,
+                                           dataset_dir=staged_path,
+                                           manifest_path=manifest_path,
+                                           files_metadata=dataset['files'])
+    else:
+        validation_errors = check_files(celery_task=celery_task,
+                                        dataset_dir=staged_path,
+                                        files_metadata=dataset['files'])
 
     if len(validation_errors) > 0:
         logger.warning(f'{len(validation_errors)} validation errors for dataset id: {dataset_id} path: {staged_path}')
@@ -0,0 +1,202 @@
+"""
+Directory tree walker built on os.scandir
+
+Each entry is stat-ed once (lstat). Symbolic links are also stat-ed through, to describe what they point to.
+The other attributes that traversal code needs (type, size, readability, times) are derived from these stat results
+instead of separate is_file / is_dir / is_symlink / access calls, which matters on filesystems like Lustre where
+every metadata call is a round trip to a metadata server.
+"""
+from __future__ import annotations
+
+import logging
+import os
+import stat
+from collections.abc import Callable, Iterator
+from pathlib import Path
+from typing import NamedTuple
+
+from workers.utils import FileType
+
+logger = logging.getLogger(__name__)
+
+
+class Entry(NamedTuple):
+    path: str
+    # stat of the entry itself (lstat)
+    stat: os.stat_result
+    # for symbolic links, stat of the link target, None if the link is dangling
+    target_stat: os.stat_result | None = None
+
+    @property
+    def is_symlink(self) -> bool:
+        return stat.S_ISLNK(self.stat.st_mode)
+
+    @property
+    def followed_stat(self) -> os.stat_result | None:
+        """
+        stat following symbolic links, None for dangling links
+        """
+        return self.target_stat if self.is_symlink else self.stat
+
+    @property
+    def is_dir(self) -> bool:
+        """
+        True for directories and symbolic links to directories, like Path.is_dir()
+        """
+        st = self.followed_stat
+        return st is not None and stat.S_ISDIR(st.st_mode)
+
+    @property
+    def is_file(self) -> bool:
+        """
+        True for regular files and symbolic links to regular files, like Path.is_file()
+        """
+        st = self.followed_stat
+        return st is not None and stat.S_ISREG(st.st_mode)
+
+    @property
+    def filetype(self) -> FileType:
+        if self.is_symlink:
+            return FileType.SYMBOLIC_LINK
+        if stat.S_ISREG(self.stat.st_mode):
+            return FileType.FILE
+        if stat.S_ISDIR(self.stat.st_mode):
+            return FileType.DIRECTORY
+        return FileType.OTHER
+
+    @property
+    def readable(self) -> bool:
+        """
+        Like utils.is_readable: files have to be readable and directories readable and traversable.
+        Evaluated from the permission bits of the stat result, ACLs are not considered.
+        """
+        st = self.followed_stat
+        if st is None:
+            return False
+        if stat.S_ISDIR(st.st_mode):
+            return has_permission(st, os.R_OK | os.X_OK)
+        if stat.S_ISREG(st.st_mode):
+            return has_permission(st, os.R_OK)
+        return False
+
+
+class DiskUsage:
+    """
+    Accumulates the sizes that du reports for the entries added to it:
+        apparent_size: sum of the stat sizes (du -sb)
+        allocated_size: sum of the allocated blocks in bytes (du -s --block-size=1)
+    Like du, files with multiple hard links are counted once and symbolic links are not followed.
+    """
+
+    def __init__(self):
+        self.apparent_size = 0
+        self.allocated_size = 0
+        # (device, inode) of the hard-linked files that were counted
+        self._linked = set()
+
+    def add(self, entry: Entry) -> None:
+        st = entry.stat
+        if st.st_nlink > 1 and not stat.S_ISDIR(st.st_mode):
+            key = (st.st_dev, st.st_ino)
+            if key in self._linked:
+                return
+            self._linked.add(key)
+        self.apparent_size += st.st_size
+        # st_blocks is in 512-byte units irrespective of the filesystem block size
+        self.allocated_size += st.st_blocks * 512
+
+
+_credentials = {}
+
+
+def has_permission(st: os.stat_result, mode: int) -> bool:
+    """
+    evaluates os.access-like permission (mode is a combination of os.R_OK, os.W_OK, os.X_OK)
+    for the effective user of this process from the permission bits in st
+    """
+    pid = os.getpid()
+    if _credentials.get('pid') != pid:
+        _credentials.update(pid=pid, uid=os.geteuid(), gids=set(os.getgroups()) | {os.getegid()})
+
+    if _credentials['uid'] == 0:
+        return True
+    if st.st_uid == _credentials['uid']:
+        shift = 6
+    elif st.st_gid in _credentials['gids']:
+        shift = 3
+    else:
+        shift = 0
+    # os.R_OK, os.W_OK and os.X_OK have the same values as the "other" permission bits
+    return (st.st_mode >> shift) & mode == mode
+
+
+def stat_entry(path: str) -> Entry:
+    st = os.lstat(path)
+    return Entry(path=path, stat=st, target_stat=_target_stat(path, st))
+
+
+def _target_stat(path: str, st: os.stat_result) -> os.stat_result | None:
+    if not stat.S_ISLNK(st.st_mode):
+        return None
+    try:
+        return os.stat(path)
+    except OSError:
+        return None
+
+
+def walk(root: Path | str,
+         include_root: bool = False,
+         onerror: Callable[[str, OSError], None] = None) -> Iterator[Entry]:
+    """
+    Walk the tree under root depth first, yielding the entries of each directory in sorted order before descending
+    into the next sibling. The order is deterministic for an unchanged tree.
+
+    root is followed if it is a symbolic link; symbolic links under root are yielded but not followed.
+
+    @param root: directory to walk. If root is not a directory, only root itself is yielded (if include_root).
+    @param include_root: yield an entry for root itself first
+    @param onerror: called with the path and the exception for directories that cannot be listed and
+                    entries that cannot be stat-ed. If not provided, such errors are logged and skipped.
+    @return: generator of Entry
+    """
+    root = str(root)
+
+    def handle_error(path: str, e: OSError):
+        if onerror is not None:
+            onerror(path, e)
+        else:
+            logger.warning(f'unable to walk {path}: {e}')
+
+    try:
+        root_entry = stat_entry(root)
+    except OSError as e:
+        handle_error(root, e)
+        return
+    if include_root:
+        yield root_entry
+    if not root_entry.is_dir:
+        return
+
+    stack = [root]
+    while stack:
+        dir_path = stack.pop()
+        try:
+            with os.scandir(dir_path) as it:
+                dir_entries = sorted(it, key=lambda e: e.name)
+        except OSError as e:
+            handle_error(dir_path, e)
+            continue
+
+        sub_dirs = []
+        for dir_entry in dir_entries:
+            try:
+                st = dir_entry.stat(follow_symlinks=False)
+            except OSError as e:
+                handle_error(dir_entry.path, e)
+                continue
+            entry = Entry(path=dir_entry.path, stat=st, target_stat=_target_stat(dir_entry.path, st))
+            yield entry
+            if stat.S_ISDIR(st.st_mode):
+                sub_dirs.append(dir_entry.path)
+        # pushed in reverse so that the sub directories are walked in sorted order
+        stack.extend(reversed(sub_dirs))
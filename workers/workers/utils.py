@@ -3,6 +3,7 @@ from __future__ import annotations  # type unions by | are only available in ver
 import hashlib
 import json
 import os
+import threading
 from collections.abc import Iterable
 from contextlib import contextmanager
 from datetime import datetime, timezone, date, time
@@ -17,12 +18,94 @@ def str_func_call(func, args, kwargs):
     return f"{func.__name__}({args_str})"
 
 
-def checksum(fname: Path | str):
-    m = hashlib.md5()
-    with open(str(fname), "rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
-            m.update(chunk)
-    return m.hexdigest()
+def checksum(fname: Path | str, use_cache: bool = True):
+    """
+    returns the md5 hex digest of the file
+
+    If use_cache is True, the digest is looked up in / stored to the persistent hash cache (workers.hash_cache),
+    so files that have not changed since they were last hashed are not read again.
+    """
+    return digests(fname, ['md5'], use_cache=use_cache)['md5']
+
+
+def digests(fname: Path | str, algorithms: Iterable[str], use_cache: bool = True) -> dict[str, str]:
+    """
+    returns the hex digests of the file for each of the hashlib algorithms, computed in one read of the file
+
+    see checksum for use_cache
+    """
+    # imported here because workers.config imports this module
+    from workers.config import config
+
+    def compute(_fname, _algorithms):
+        return file_digests(_fname, _algorithms,
+                            block_size=config['digest']['block_size'],
+                            drop_cache=config['digest']['drop_cache'])
+
+    if use_cache:
+        from workers import hash_cache
+        return hash_cache.cached_digests(fname, algorithms, compute=compute)
+    return compute(fname, algorithms)
+
+
+# read buffers are reused across files hashed by the same thread
+_read_buffers = threading.local()
+
+# how often pages that were hashed are dropped from the page cache
+DROP_CACHE_INTERVAL = 64 * 1024 * 1024
+# None on platforms without posix_fadvise
+FADV_SEQUENTIAL = getattr(os, 'POSIX_FADV_SEQUENTIAL', None)
+FADV_DONTNEED = getattr(os, 'POSIX_FADV_DONTNEED', None)
+
+
+def file_digests(fname: Path | str,
+                 algorithms: Iterable[str],
+                 block_size: int = 8 * 1024 * 1024,
+                 drop_cache: bool = False) -> dict[str, str]:
+    """
+    returns the hex digests of the file for each of the hashlib algorithms, computed in one read of the file
+
+    The file is read into a preallocated buffer in blocks of block_size bytes. The kernel is advised that the file is
+    read sequentially (more aggressive readahead), and if drop_cache is True, the pages that were hashed are dropped
+    from the page cache so that hashing large files does not evict data that other processes use.
+    """
+    hashers = [(algorithm, hashlib.new(algorithm)) for algorithm in algorithms]
+    buffer = getattr(_read_buffers, 'buffer', None)
+    if buffer is None or len(buffer) != block_size:
+        buffer = _read_buffers.buffer = bytearray(block_size)
+    view = memoryview(buffer)
+
+    with open(str(fname), 'rb', buffering=0) as f:
+        fd = f.fileno()
+        fadvise(fd, FADV_SEQUENTIAL)
+        offset = 0
+        dropped = 0
+        while True:
+            n = f.readinto(view)
+            if not n:
+                break
+            chunk = view[:n]
+            for _, m in hashers:
+                m.update(chunk)
+            offset += n
+            if drop_cache and offset - dropped >= DROP_CACHE_INTERVAL:
+                fadvise(fd, FADV_DONTNEED, dropped, offset - dropped)
+                dropped = offset
+        if drop_cache and offset > dropped:
+            fadvise(fd, FADV_DONTNEED, dropped, offset - dropped)
+    return {algorithm: m.hexdigest() for algorithm, m in hashers}
+
+
+def fadvise(fd: int, advice: int | None, offset: int = 0, length: int = 0) -> None:
+    """
+    os.posix_fadvise that ignores platforms and filesystems that do not support it - the advice is only a hint
+    """
+    if advice is None or not hasattr(os, 'posix_fadvise'):
+        return
+    try:
+        os.posix_fadvise(fd, offset, length, advice)
+    except OSError:
+        pass
 
 
 #
@@ -1,7 +1,9 @@
 from __future__ import annotations
 
 import logging
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 from pathlib import Path
 
@@ -11,7 +13,8 @@ import billiard as multiprocessing
 from sca_rhythm import WorkflowTask
 from sca_rhythm.progress import Progress
 
-from workers import sda, utils
+from workers import exceptions as exc
+from workers import proc_io, sda, sda_parallel, utils
 from workers.config import config
 
 logger = logging.getLogger(__name__)
@@ -70,6 +73,20 @@ def track_progress_parallel(celery_task: WorkflowTask,
             p.terminate()
 
 
+def transfer_monitor(progress: Progress, local_file_path: Path, direction: str):
+    """
+    returns a monitor for sda.put / sda.get that updates progress with the bytes of local_file_path the hsi process
+    has read or written (see proc_io.bytes_transferred)
+    """
+
+    def monitor(pid: int):
+        done = proc_io.bytes_transferred(pid, local_file_path, direction)
+        if done is not None:
+            progress.update(done)
+
+    return monitor
+
+
 def upload_file_to_sda(local_file_path: Path,
                        sda_file_path: str,
                        *,
@@ -97,18 +114,15 @@ def upload_file_to_sda(local_file_path: Path,
         logger.warning(f'The checksums of local file {local_file_path} and SDA file {sda_file_path} match - not '
                        f'uploading')
     else:
+        monitor = None
         if celery_task is not None:
-            local_file_size = local_file_path.stat().st_size
-            cm = track_progress_parallel(celery_task=celery_task,
-                                         name='sda put',
-                                         progress_fn=lambda: sda.get_size(sda_file_path),
-                                         total=local_file_size,
-                                         units='bytes')
-        else:
-            cm = utils.empty_context_manager()
-        with cm:
-            logging.info(f'putting {local_file_path} on SDA at {sda_file_path}')
-            sda.put(local_file=str(local_file_path), sda_file=sda_file_path, verify_checksum=verify_checksum)
+            # progress is the bytes of the local file hsi has read - SDA is not asked how much it has received
+            progress = Progress(celery_task=celery_task, name='sda put', total=local_file_path.stat().st_size,
+                                units='bytes')
+            monitor = transfer_monitor(progress, local_file_path, 'read')
+        logging.info(f'putting {local_file_path} on SDA at {sda_file_path}')
+        sda.put(local_file=str(local_file_path), sda_file=sda_file_path, verify_checksum=verify_checksum,
+                monitor=monitor)
 
 
 def download_file_from_sda(sda_file_path: str,
@@ -144,15 +158,112 @@ def download_file_from_sda(sda_file_path: str,
         # delete the local file if possible
         local_file_path.unlink(missing_ok=True)
 
+        monitor = None
         if celery_task is not None:
             source_size = sda.get_size(sda_file_path)
-            cm = track_progress_parallel(celery_task=celery_task,
-                                         name='sda get',
-                                         progress_fn=lambda: local_file_path.stat().st_size,
-                                         total=source_size,
-                                         units='bytes')
-        else:
-            cm = utils.empty_context_manager()
-        with cm:
-            logger.info(f'getting file from SDA {sda_file_path} to {local_file_path}')
-            sda.get(sda_file=sda_file_path, local_file=str(local_file_path), verify_checksum=verify_checksum)
+            progress = Progress(celery_task=celery_task, name='sda get', total=source_size, units='bytes')
+            monitor = transfer_monitor(progress, local_file_path, 'write')
+        logger.info(f'getting file from SDA {sda_file_path} to {local_file_path}')
+        sda.get(sda_file=sda_file_path, local_file=str(local_file_path), verify_checksum=verify_checksum,
+                monitor=monitor)
+
+
+def upload_file_to_sda_parallel(local_file_path: Path,
+                                sda_file_path: str,
+                                *,
+                                md5: str,
+                                celery_task: WorkflowTask = None,
+                                preflight_check: bool = True) -> dict:
+    """
+    Uploads local_file_path to SDA as segments moved by concurrent hsi transfers (see sda_parallel.put).
+
+    @param local_file_path:
+    @param sda_file_path: path the file is known by in SDA, the segments and the manifest are stored next to it
+    @param md5: md5 of the local file
+    @param celery_task:
+    @param preflight_check: if True, the upload is skipped when SDA already has the segments of a file with this md5
+    @return: the manifest of the segments
+    """
+    if preflight_check and sda.exists(sda_parallel.manifest_path(sda_file_path)):
+        manifest = sda_parallel.read_manifest(sda_file_path)
+        if manifest.get('md5') == md5 and manifest['size'] == local_file_path.stat().st_size:
+            logger.warning(f'SDA has the segments of {local_file_path} at {sda_file_path} - not uploading')
+            return manifest
+        # the segments of a previous version of the file may outnumber the new ones
+        sda_parallel.delete(sda_file_path)
+
+    progress = None
+    if celery_task is not None:
+        progress = Progress(celery_task=celery_task, name='sda put', total=local_file_path.stat().st_size,
+                            units='bytes')
+    return sda_parallel.put(local_file=local_file_path, sda_file=sda_file_path, md5=md5, progress=progress)
+
+
+def download_file_from_sda_parallel(sda_file_path: str,
+                                    local_file_path: Path,
+                                    *,
+                                    celery_task: WorkflowTask = None,
+                                    size: int = None,
+                                    manifest: dict = None) -> dict:
+    """
+    Downloads the segments of sda_file_path into local_file_path with concurrent hsi transfers
+    (see sda_parallel.get). The checksum of every segment is verified as it is downloaded.
+
+    @param sda_file_path:
+    @param local_file_path:
+    @param celery_task:
+    @param size: size of the file, for progress reporting
+    @param manifest: the manifest of the segments, read from SDA if not provided
+    @return: the manifest of the segments
+    """
+    progress = None
+    if celery_task is not None:
+        progress = Progress(celery_task=celery_task, name='sda get', total=size, units='bytes')
+    local_file_path.parent.mkdir(parents=True, exist_ok=True)
+    return sda_parallel.get(sda_file=sda_file_path, local_file=local_file_path, progress=progress, manifest=manifest)
+
+
+def upload_volumes_to_sda(local_dir: Path,
+                          sda_dir: str,
+                          volumes: list[dict],
+                          *,
+                          celery_task: WorkflowTask = None) -> list[dict]:
+    """
+    Uploads the volumes of a bundle (see bundle.write_bundle_volumes) from local_dir to sda_dir, with
+    config['archive']['split']['max_workers'] concurrent hsi transfers.
+
+    Volumes that SDA already has with the same md5 are not uploaded again, so a failed archive is resumed from the
+    volumes that were not uploaded. The md5s SDA computed are checked after the upload.
+
+    @return: the volumes, each with its SDA path under 'path'
+    """
+    volumes = [{**volume, 'path': f'{sda_dir}/{volume["name"]}'} for volume in volumes]
+    sda_hashes = sda.get_hashes([volume['path'] for volume in volumes], missing_ok=True)
+    pending = [volume for volume in volumes if sda_hashes[volume['path']] != volume['md5']]
+    logger.info(f'uploading {len(pending)} of {len(volumes)} volumes to {sda_dir}')
+
+    progress = None
+    if celery_task is not None:
+        progress = Progress(celery_task=celery_task, name='sda put', total=sum(v['size'] for v in volumes),
+                            units='bytes')
+    done = sum(volume['size'] for volume in volumes if volume not in pending)
+    lock = threading.Lock()
+
+    def upload(volume: dict):
+        nonlocal done
+        sda.put(local_file=str(local_dir / volume['name']), sda_file=volume['path'], verify_checksum=True)
+        with lock:
+            done += volume['size']
+            if progress is not None:
+                progress.update(done)
+
+    with ThreadPoolExecutor(max_workers=config['archive']['split']['max_workers']) as pool:
+        for future in [pool.submit(upload, volume) for volume in pending]:
+            future.result()
+
+    sda_hashes = sda.get_hashes([volume['path'] for volume in pending])
+    for volume in pending:
+        if sda_hashes[volume['path']] != volume['md5']:
+            raise exc.ValidationFailed(f'Expected checksum of volume {volume["path"]} in SDA to be {volume["md5"]},'
+                                       f' but SDA reports {sda_hashes[volume["path"]]}')
+    return volumes